@@ -1,11 +1,33 @@
 """
-This small module is used to go back and forth
+This small module is used to go back and forth between the compact table
+of contrast annotations (ibc_data/all_contrasts.tsv, one list of tags per
+contrast) and its sparse version (one column per tag).
+
+Nothing is computed at import: use get_compact_table and get_sparse_table
+(cached), or run this module as a script to write all_contrasts_sparse.tsv.
 """
 import os
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 import ibc_public
 
+# get the pass of the all_contrasts file
+_package_directory = os.path.dirname(
+    os.path.abspath(ibc_public.__file__))
+all_contrasts = os.path.join(
+    _package_directory, '../ibc_data', 'all_contrasts.tsv')
+
+# get the corresponding directory
+write_dir = os.path.dirname(all_contrasts)
+
+# path of the sparse table
+sparse_contrasts = os.path.join(
+    _package_directory, '../ibc_data', 'all_contrasts_sparse.tsv')
+
+_COLUMNS = ['task', 'contrast', 'pretty name', 'negative label',
+            'positive label']
+
 
 def make_compact_table(cs, output_file=None):
     """ Create a compact list of labels per contrast
@@ -30,11 +52,8 @@ def make_compact_table(cs, output_file=None):
 
     """
     # define the tags to be associated with each contrast
-    tags = []
-    
-    for index, con in cs.iterrows():
-        tag = con.loc[con == 1.0].index
-        tags.append(list(tag))
+    is_tag = cs.eq(1.0).values
+    tags = [list(cs.columns[row]) for row in is_tag]
 
     # generate the output as a dictionary
     output = {'contrast': cs.contrast.values,
@@ -57,18 +76,42 @@ def make_compact_table(cs, output_file=None):
     return output_df
 
 
-def _clean_tag(tag):
-    """ """
-    bad_chars = [']', '[', "'"]
-    tag = tag.replace("'", "")
-    tag = tag.replace('"', '')
-    tag = tag.replace(',', '')
-    for bc in bad_chars:
-        tag = tag.strip(bc)
-    tag_ = [] 
-    for t in tag.split(' '):
-        tag_.append(t)
-    return tag_
+def _clean_tags(tags):
+    """ Turn the tags of each contrast, stored as the string of a list,
+    into space-separated tags"""
+    tags = tags.fillna('').astype(str)
+    for char in ["'", '"', ',']:
+        tags = tags.str.replace(char, '', regex=False)
+    for char in [']', '[', "'"]:
+        tags = tags.str.strip(char)
+    return tags
+
+
+def tag_matrix(compact_table, tag_columns=None):
+    """ One-hot encoding of the tags of a compact table
+
+    Parameters
+    ----------
+    compact_table: Pandas Dataframe,
+                   with a 'tags' column yielding lists of cognitive labels
+    tag_columns: list or None, optional,
+                 the tags to be encoded, in this order. By default, all
+                 the tags of the table, sorted
+
+    Returns
+    -------
+    matrix: scipy.sparse csr matrix of shape (n_contrasts, n_tags),
+            with ones where a contrast has a tag
+    tag_columns: array of strings,
+                 the tags corresponding to the columns of matrix
+    """
+    from scipy import sparse
+    dummies = _clean_tags(compact_table.tags).str.get_dummies(sep=' ')
+    if tag_columns is None:
+        tag_columns = np.unique(dummies.columns)
+    dummies = dummies.reindex(columns=tag_columns, fill_value=0)
+    matrix = sparse.csr_matrix(dummies.values.astype(np.int8))
+    return matrix, np.asarray(tag_columns)
 
 
 def expand_table(compact_table, output_file=None, tag_columns=None):
@@ -91,44 +134,16 @@ def expand_table(compact_table, output_file=None, tag_columns=None):
                represents the sem structure.
                has keys ('task', 'contrast', 'pretty name',
                          'negative label', 'positive label'),
-               plus one column per tag
+               plus one column per tag, holding '1' or ''
     """
-    # define the tags to be associated with each contrast
-    if tag_columns is None:
-        tag_list = list(compact_table.tags.values)
-        all_tags = []
-        for tag in tag_list:
-            for t in _clean_tag(tag):
-                if len(t):
-                    all_tags.append(t)
-        tag_columns = np.unique(all_tags)
-        
-    # create dictionary
-    output = {'contrast': compact_table.contrast.values,
-              'task':compact_table.task.values,
-              'pretty name': compact_table['pretty name'].values,
-              'negative label': compact_table['negative label'].values,
-              'positive label': compact_table['positive label'].values,
-    }
-    # initialize values with -1
-    for tc in tag_columns:
-        output[tc] = -np.ones(shape=len(compact_table))
+    matrix, tag_columns = tag_matrix(compact_table, tag_columns)
 
     # create output dataframe
-    columns = ['task', 'contrast', 'pretty name', 'negative label',
-               'positive label'] + list(tag_columns)
-    output_df = pd.DataFrame(output, columns=columns)
-
-    # fill with ones where it makes sense
-    for index, con in compact_table.iterrows():
-        tags = _clean_tag(con['tags'])
-        for tag in tags:
-            output_df.at[index, output_df.columns == tag] = 1
-
-    # replace -1 with empty values
-    output_df = output_df.replace(-1, '')
-    # replace 1.0 with 1
-    output_df = output_df.replace(1, '1')
+    columns = _COLUMNS + list(tag_columns)
+    output_df = pd.concat([
+        compact_table[_COLUMNS].reset_index(drop=True),
+        pd.DataFrame(np.where(matrix.toarray() > 0, '1', ''),
+                     columns=tag_columns)], axis=1)[columns]
 
     # if ajn output path is provided, write it there
     if output_file is not None:
@@ -138,38 +153,26 @@ def expand_table(compact_table, output_file=None, tag_columns=None):
     return output_df
 
 
-# get the pass of the all_contrasts file
-_package_directory = os.path.dirname(
-    os.path.abspath(ibc_public.__file__))
-all_contrasts = os.path.join(
-    _package_directory, '../ibc_data', 'all_contrasts.tsv')
+@lru_cache(maxsize=None)
+def _read_compact_table(path):
+    return pd.read_csv(path, sep='\t')
 
-# get the corresponding directory
-write_dir = os.path.dirname(all_contrasts)
 
-# read the sparse table as a dataframe
-sparse_contrasts = os.path.join(
-    _package_directory, '../ibc_data', 'all_contrasts_sparse.tsv')
-cs = pd.read_csv(all_contrasts, sep='\t')
+def get_compact_table(path=all_contrasts):
+    """ Return the compact table of contrast annotations (read once)"""
+    return _read_compact_table(path).copy()
 
-# take the tag names (useful to preserve ordering)
-ref_columns = cs.columns[5:]
 
-rewrite = True
-"""
-# create a compact table
-if rewrite:
-    compact_table = make_compact_table(
-        cs, os.path.join(write_dir, 'all_contrasts.tsv'))
-else:
-    compact_table = make_compact_table(cs)
-"""
-compact_contrasts = os.path.join(write_dir, 'all_contrasts.tsv')
-compact_table = pd.read_csv(compact_contrasts, sep='\t')
-
-# create a sparse table
-if rewrite:
-    sparse_table = expand_table(
-        compact_table, os.path.join(write_dir, 'all_contrasts_sparse.tsv'))
-else:
-    sparse_table = expand_table(compact_table)
+@lru_cache(maxsize=None)
+def _sparse_table(path):
+    return expand_table(_read_compact_table(path))
+
+
+def get_sparse_table(path=all_contrasts):
+    """ Return the sparse table of contrast annotations (computed once)"""
+    return _sparse_table(path).copy()
+
+
+if __name__ == '__main__':
+    # write the sparse table next to the compact one
+    get_sparse_table().to_csv(sparse_contrasts, sep='\t', index=False)
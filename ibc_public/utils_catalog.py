@@ -0,0 +1,232 @@
+"""
+Persistent catalog of the files of BIDS derivatives directories.
+
+The catalog is an SQLite database holding, for each indexed file, its BIDS
+entities, size, modification time and map type. It is refreshed
+incrementally: a directory is listed again only when its modification time
+changed, i.e. when files were added to it or removed from it. The
+derivatives queries of data_parser and make_surf_db can then be answered
+without walking the whole tree again (see DerivativesIndex).
+"""
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from ibc_public.utils_index import (INDEXED_SUBFOLDERS, IndexEntry,
+                                    _parse_entities)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY, root TEXT, mtime_ns INTEGER, children TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, root TEXT, dir TEXT, subject TEXT, session TEXT,
+    folder TEXT, subfolder TEXT, name TEXT, prefix TEXT, sub TEXT,
+    task TEXT, dir_entity TEXT, acq TEXT, map_type TEXT, size INTEGER,
+    mtime_ns INTEGER);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_root_subject ON files (root, subject);
+"""
+
+_FILE_COLUMNS = ['path', 'root', 'dir', 'subject', 'session', 'folder',
+                 'subfolder', 'name', 'prefix', 'sub', 'task', 'dir_entity',
+                 'acq', 'map_type', 'size', 'mtime_ns']
+
+
+def _map_type(folder, subfolder, name):
+    """ Kind of a derivative file: anat, bold, motion, or the subfolder of
+    the res_* directory holding it (e.g. stat_maps)"""
+    if subfolder:
+        return subfolder
+    if folder == 'func':
+        return 'motion' if name.startswith('rp_') else 'bold'
+    return folder
+
+
+def _follow(depth, name, subfolders):
+    """ Whether a subdirectory at a given depth below the root is part of
+    the catalog: root/sub-*/<session>/{anat, func, res_*/<subfolder>}"""
+    if depth == 1:
+        return name.startswith('sub-')
+    if depth == 2:
+        return True
+    if depth == 3:
+        return name in ['anat', 'func'] or name.startswith('res_')
+    if depth == 4:
+        return name in subfolders
+    return False
+
+
+def _is_leaf(depth, name):
+    return depth == 4 or (depth == 3 and name in ['anat', 'func'])
+
+
+def _list_dir(root, path, depth, known, updates):
+    """ Return the subdirectories of a directory of the catalog, listing it
+    again only if its modification time changed
+
+    known maps the paths of the directories in the catalog to their
+    (mtime_ns, children). The changes are appended to updates."""
+    record = known.get(path)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        if record is not None:
+            updates['removed'].append(path)
+        return []
+    if record is not None and record[0] == mtime_ns:
+        return record[1]
+    leaf = _is_leaf(depth, os.path.basename(path))
+    children = []
+    files = []
+    for entry in os.scandir(path):
+        if entry.name.startswith('.'):
+            continue
+        if not leaf:
+            if entry.is_dir():
+                children.append(entry.name)
+            continue
+        if not entry.is_file():
+            continue
+        parts = os.path.relpath(path, root).split(os.sep)
+        subject, session, folder = parts[:3]
+        subfolder = parts[3] if len(parts) > 3 else ''
+        entities = ('', None, None, None, None)
+        if not subfolder:
+            entities = _parse_entities(entry.name)
+        stat = entry.stat()
+        files.append(
+            (entry.path, root, path, subject, session, folder, subfolder,
+             entry.name) + entities +
+            (_map_type(folder, subfolder, entry.name), stat.st_size,
+             stat.st_mtime_ns))
+    children.sort()
+    if leaf:
+        updates['files'][path] = files
+    if record is not None:
+        updates['removed'] += [os.path.join(path, child) for child in
+                               set(record[1]) - set(children)]
+    updates['dirs'].append((path, root, mtime_ns, json.dumps(children)))
+    return children
+
+
+def _refresh_dir(root, path, depth, known, subfolders, updates):
+    """ Refresh the records of a directory and of its subdirectories"""
+    for child in _list_dir(root, path, depth, known, updates):
+        if _follow(depth + 1, child, subfolders):
+            _refresh_dir(root, os.path.join(path, child), depth + 1, known,
+                         subfolders, updates)
+
+
+class DerivativesCatalog(object):
+    """ Persistent catalog of derivatives files
+
+    Parameters
+    ----------
+    path: string,
+          path of the SQLite database; created if needed. Several
+          derivatives directories can be catalogued in the same database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=600)
+
+    def refresh(self, derivatives, subject_list=None, n_jobs=8,
+                subfolders=INDEXED_SUBFOLDERS):
+        """ Bring the catalog of a derivatives directory up to date
+
+        Only the directories whose modification time changed since the
+        last refresh are listed again. Files rewritten in place keep
+        their former size and mtime in the catalog, as this does not
+        change the modification time of their directory.
+
+        Parameters
+        ----------
+        derivatives: string,
+                     path of the derivatives directory
+        subject_list: list or None, optional,
+                      subjects to refresh; all the sub-* directories by
+                      default
+        n_jobs: int, optional,
+                number of subjects refreshed concurrently
+        subfolders: tuple of strings, optional,
+                    subdirectories of the res_* directories to be catalogued
+        """
+        root = os.path.abspath(derivatives)
+        with self._connect() as connection:
+            known = dict(
+                (path, (mtime_ns, json.loads(children))) for
+                (path, mtime_ns, children) in connection.execute(
+                    'SELECT path, mtime_ns, children FROM dirs '
+                    'WHERE root = ?', (root,)))
+        updates = {'dirs': [], 'files': {}, 'removed': []}
+        if subject_list is None:
+            subject_list = [
+                subject for subject in _list_dir(root, root, 0, known, updates)
+                if _follow(1, subject, subfolders)]
+
+        def refresh_subject(subject):
+            updates_ = {'dirs': [], 'files': {}, 'removed': []}
+            _refresh_dir(root, os.path.join(root, subject), 1, known,
+                         subfolders, updates_)
+            return updates_
+
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+            for updates_ in executor.map(refresh_subject, subject_list):
+                for key in ['dirs', 'removed']:
+                    updates[key] += updates_[key]
+                updates['files'].update(updates_['files'])
+        self._apply(updates)
+
+    def _apply(self, updates):
+        """ Write the changes found by a refresh in one transaction"""
+        with self._connect() as connection:
+            for path in updates['removed']:
+                prefix = path + os.sep
+                for table, column in [('dirs', 'path'), ('files', 'dir')]:
+                    connection.execute(
+                        'DELETE FROM %s WHERE %s = ? OR substr(%s, 1, ?) = ?'
+                        % (table, column, column),
+                        (path, len(prefix), prefix))
+            connection.executemany(
+                'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                updates['dirs'])
+            for path, files in updates['files'].items():
+                connection.execute('DELETE FROM files WHERE dir = ?', (path,))
+                connection.executemany(
+                    'INSERT OR REPLACE INTO files VALUES (%s)' %
+                    ', '.join(['?'] * len(_FILE_COLUMNS)), files)
+
+    def entries(self, derivatives, subject_list=None):
+        """ Return the catalogued files of a derivatives directory, as a
+        sorted list of IndexEntry (see DerivativesIndex)"""
+        root = os.path.abspath(derivatives)
+        query = ('SELECT path, subject, session, folder, subfolder, name, '
+                 'prefix, sub, task, dir_entity, acq FROM files '
+                 'WHERE root = ?')
+        with self._connect() as connection:
+            rows = connection.execute(query, (root,)).fetchall()
+        if subject_list is not None:
+            subject_list = set(subject_list)
+            rows = [row for row in rows if row[1] in subject_list]
+        return sorted(IndexEntry(*row) for row in rows)
+
+    def table(self, derivatives=None):
+        """ Return the catalog (of one derivatives directory, or of all) as
+        a DataFrame, with file sizes, modification times and map types"""
+        query = 'SELECT * FROM files'
+        params = ()
+        if derivatives is not None:
+            query += ' WHERE root = ?'
+            params = (os.path.abspath(derivatives),)
+        with self._connect() as connection:
+            return pd.read_sql_query(query, connection, params=params)
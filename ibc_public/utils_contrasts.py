@@ -3,135 +3,21 @@
 Author: Bertrand Thirion, Ana Luisa Pinho 2014--2020
 """
 
+import functools
+
 import numpy as np
 
 
 def make_contrasts(paradigm_id, design_matrix_columns=None):
-    """ return the contrasts matching a string"""
-    if paradigm_id == 'archi_standard':
-        return archi_standard(design_matrix_columns)
-    elif paradigm_id == 'archi_social':
-        return archi_social(design_matrix_columns)
-    elif paradigm_id == 'archi_spatial':
-        return archi_spatial(design_matrix_columns)
-    elif paradigm_id == 'archi_emotional':
-        return archi_emotional(design_matrix_columns)
-    elif paradigm_id == 'hcp_emotion':
-        return hcp_emotion(design_matrix_columns)
-    elif paradigm_id == 'hcp_gambling':
-        return hcp_gambling(design_matrix_columns)
-    elif paradigm_id == 'hcp_language':
-        return hcp_language(design_matrix_columns)
-    elif paradigm_id == 'hcp_motor':
-        return hcp_motor(design_matrix_columns)
-    elif paradigm_id == 'hcp_wm':
-        return hcp_wm(design_matrix_columns)
-    elif paradigm_id == 'hcp_relational':
-        return hcp_relational(design_matrix_columns)
-    elif paradigm_id == 'hcp_social':
-        return hcp_social(design_matrix_columns)
-    elif paradigm_id == 'language':
-        return rsvp_language(design_matrix_columns)
-    elif paradigm_id == 'colour':
-        return colour(design_matrix_columns)
-    elif paradigm_id in ['cont_ring', 'exp_ring', 'wedge_clock', ###
-                         'wedge_anti', 'wedge', 'ring']:###
-        return retino(design_matrix_columns)###
-    elif paradigm_id in ['wedge', 'wedge_anti', 'wedge_clock']:
-        return wedge(design_matrix_columns)
-    elif paradigm_id in ['ring', 'cont_ring', 'exp_ring']:
-        return ring(design_matrix_columns)
-    elif paradigm_id[:10] == 'preference':
-        domain = paradigm_id[11:]
-        if domain[-1] == 's':
-            domain = domain[: -1]
-        return preferences(design_matrix_columns, domain)
-    elif paradigm_id == 'MTTWE':
-        return mtt_we_relative(design_matrix_columns)
-    elif paradigm_id == 'MTTNS':
-        return mtt_sn_relative(design_matrix_columns)
-    elif paradigm_id == 'emotional_pain':
-        return emotional_pain(design_matrix_columns)
-    elif paradigm_id == 'pain_movie':
-        return pain_movie(design_matrix_columns)
-    elif paradigm_id == 'theory_of_mind':
-        return theory_of_mind(design_matrix_columns)
-    elif paradigm_id == 'VSTM':
-        return vstm(design_matrix_columns)
-    elif paradigm_id == 'enumeration':
-        return enumeration(design_matrix_columns)
-    elif paradigm_id == 'clips_trn':
-        return dict([])
-    elif paradigm_id == 'self':
-        return self_localizer(design_matrix_columns)
-    elif paradigm_id == 'lyon_moto':
-        return lyon_moto(design_matrix_columns)
-    elif paradigm_id == 'lyon_mcse':
-        return lyon_mcse(design_matrix_columns)
-    elif paradigm_id == 'lyon_mveb':
-        return lyon_mveb(design_matrix_columns)
-    elif paradigm_id == 'lyon_mvis':
-        return lyon_mvis(design_matrix_columns)
-    elif paradigm_id == 'lyon_lec1':
-        return lyon_lec1(design_matrix_columns)
-    elif paradigm_id == 'lyon_lec2':
-        return lyon_lec2(design_matrix_columns)
-    elif paradigm_id == 'lyon_audi':
-        return lyon_audi(design_matrix_columns)
-    elif paradigm_id == 'lyon_visu':
-        return lyon_visu(design_matrix_columns)
-    elif paradigm_id == 'audio':
-        return audio(design_matrix_columns)
-    elif paradigm_id == 'bang':
-        return bang(design_matrix_columns)
-    elif paradigm_id == 'selective_stop_signal':
-        return selective_stop_signal(design_matrix_columns)
-    elif paradigm_id == 'stop_signal':
-        return stop_signal(design_matrix_columns)
-    elif paradigm_id == 'stroop':
-        return stroop(design_matrix_columns)
-    elif paradigm_id == 'discount':
-        return discount(design_matrix_columns)
-    elif paradigm_id == 'attention':
-        return attention(design_matrix_columns)
-    elif paradigm_id == 'ward_and_aliport':
-        return towertask(design_matrix_columns)
-    elif paradigm_id == 'two_by_two':
-        return two_by_two(design_matrix_columns)
-    elif paradigm_id == 'columbia_cards':
-        return columbia_cards(design_matrix_columns)
-    elif paradigm_id == 'dot_patterns':
-        return dot_patterns(design_matrix_columns)
-    elif paradigm_id == 'biological_motion1':
-        return biological_motion1(design_matrix_columns)
-    elif paradigm_id == 'biological_motion2':
-        return biological_motion2(design_matrix_columns)
-    elif paradigm_id == 'mathlang':
-        return math_language(design_matrix_columns)
-    elif paradigm_id == 'spatial_navigation':
-        return spatial_navigation(design_matrix_columns)
-    elif paradigm_id == 'EmoMem':
-        return emotional_memory(design_matrix_columns)
-    elif paradigm_id == 'EmoReco':
-        return emotion_recognition(design_matrix_columns)
-    elif paradigm_id == 'StopNogo':
-        return stop_nogo(design_matrix_columns)
-    elif paradigm_id == 'Catell':
-        return oddball(design_matrix_columns)
-    elif paradigm_id == 'VSTMC':
-        return vstmc(design_matrix_columns)
-    elif paradigm_id == 'FingerTapping':
-        return finger_tapping(design_matrix_columns)
-    elif paradigm_id == 'RewProc':
-        return reward_processing(design_matrix_columns)
-    elif paradigm_id == 'NARPS':
-        return narps(design_matrix_columns)
-    elif paradigm_id == 'FaceBody':
-        return face_body(design_matrix_columns)
-    elif paradigm_id == 'Scene':
-        return scenes(design_matrix_columns)
-    else:
-        raise ValueError('%s Unknown paradigm' % paradigm_id)
+    """ return the contrasts matching a string
+
+    Without design_matrix_columns, only the contrast names are returned
+    (as keys of a dictionary of empty lists), see contrast_names.
+    The contrasts of a given design are compiled once, see
+    compile_contrasts."""
+    if design_matrix_columns is None:
+        return dict([(name, []) for name in contrast_names(paradigm_id)])
+    return compile_contrasts(paradigm_id, design_matrix_columns).as_dict()
 
 
 def _elementary_contrasts(design_matrix_columns):
@@ -1943,3 +1829,154 @@ def hcp_wm(design_matrix_columns):
     _append_derivative_contrast(design_matrix_columns, contrasts)
     _append_effects_interest_contrast(design_matrix_columns, contrasts)
     return contrasts
+
+
+def clips_trn(design_matrix_columns):
+    """ No contrasts for the clips training sessions"""
+    return dict([])
+
+
+# paradigm id -> function specifying its contrasts
+PARADIGM_CONTRASTS = dict([
+    ('archi_standard', archi_standard),
+    ('archi_social', archi_social),
+    ('archi_spatial', archi_spatial),
+    ('archi_emotional', archi_emotional),
+    ('hcp_emotion', hcp_emotion),
+    ('hcp_gambling', hcp_gambling),
+    ('hcp_language', hcp_language),
+    ('hcp_motor', hcp_motor),
+    ('hcp_wm', hcp_wm),
+    ('hcp_relational', hcp_relational),
+    ('hcp_social', hcp_social),
+    ('language', rsvp_language),
+    ('colour', colour),
+    ('MTTWE', mtt_we_relative),
+    ('MTTNS', mtt_sn_relative),
+    ('emotional_pain', emotional_pain),
+    ('pain_movie', pain_movie),
+    ('theory_of_mind', theory_of_mind),
+    ('VSTM', vstm),
+    ('enumeration', enumeration),
+    ('self', self_localizer),
+    ('lyon_moto', lyon_moto),
+    ('lyon_mcse', lyon_mcse),
+    ('lyon_mveb', lyon_mveb),
+    ('lyon_mvis', lyon_mvis),
+    ('lyon_lec1', lyon_lec1),
+    ('lyon_lec2', lyon_lec2),
+    ('lyon_audi', lyon_audi),
+    ('lyon_visu', lyon_visu),
+    ('audio', audio),
+    ('bang', bang),
+    ('selective_stop_signal', selective_stop_signal),
+    ('stop_signal', stop_signal),
+    ('stroop', stroop),
+    ('discount', discount),
+    ('attention', attention),
+    ('ward_and_aliport', towertask),
+    ('two_by_two', two_by_two),
+    ('columbia_cards', columbia_cards),
+    ('dot_patterns', dot_patterns),
+    ('biological_motion1', biological_motion1),
+    ('biological_motion2', biological_motion2),
+    ('mathlang', math_language),
+    ('spatial_navigation', spatial_navigation),
+    ('EmoMem', emotional_memory),
+    ('EmoReco', emotion_recognition),
+    ('StopNogo', stop_nogo),
+    ('Catell', oddball),
+    ('VSTMC', vstmc),
+    ('FingerTapping', finger_tapping),
+    ('RewProc', reward_processing),
+    ('NARPS', narps),
+    ('FaceBody', face_body),
+    ('Scene', scenes),
+    ('clips_trn', clips_trn)])
+PARADIGM_CONTRASTS.update(dict([
+    (paradigm_id, retino) for paradigm_id in
+    ['cont_ring', 'exp_ring', 'wedge_clock', 'wedge_anti', 'wedge',
+     'ring']]))
+
+
+def _contrast_function(paradigm_id):
+    """ Return the function specifying the contrasts of a paradigm"""
+    if paradigm_id in PARADIGM_CONTRASTS:
+        return PARADIGM_CONTRASTS[paradigm_id]
+    if paradigm_id[:10] == 'preference':
+        domain = paradigm_id[11:]
+        if domain[-1] == 's':
+            domain = domain[: -1]
+        return functools.partial(preferences, domain=domain)
+    raise ValueError('%s Unknown paradigm' % paradigm_id)
+
+
+@functools.lru_cache(maxsize=None)
+def _contrast_names(paradigm_id):
+    return tuple(_contrast_function(paradigm_id)(None).keys())
+
+
+def contrast_names(paradigm_id):
+    """ Return the names of the contrasts of a paradigm, without building
+    any contrast vector"""
+    return list(_contrast_names(paradigm_id))
+
+
+class CompiledContrasts(object):
+    """ Contrasts of a paradigm for a given design matrix layout
+
+    Parameters
+    ----------
+    paradigm_id: string,
+                 identifier of the paradigm
+    design_matrix_columns: list of strings,
+                           columns of the design matrix
+
+    Attributes
+    ----------
+    names: list of strings,
+           names of all the contrasts, in specification order
+    t_names: list of strings,
+             names of the t contrasts, i.e. the rows of matrix
+    matrix: array of shape (n_t_contrasts, n_columns),
+            the t contrast vectors (read-only)
+    f_contrasts: dict,
+                 the F contrasts (2D arrays), e.g. effects_interest
+    """
+
+    def __init__(self, paradigm_id, design_matrix_columns):
+        self.paradigm_id = paradigm_id
+        self.columns = list(design_matrix_columns)
+        contrasts = _contrast_function(paradigm_id)(self.columns)
+        self.names = list(contrasts.keys())
+        self.t_names = [name for name in self.names
+                        if np.ndim(contrasts[name]) == 1]
+        self.matrix = np.array(
+            [np.asarray(contrasts[name], dtype=np.float64)
+             for name in self.t_names]).reshape(
+                 len(self.t_names), len(self.columns))
+        self.matrix.setflags(write=False)
+        self.f_contrasts = dict([
+            (name, np.asarray(contrasts[name])) for name in self.names
+            if name not in self.t_names])
+        for value in self.f_contrasts.values():
+            value.setflags(write=False)
+
+    def as_dict(self):
+        """ Return the contrasts as a dictionary of (writable) arrays, as
+        expected by the GLM code"""
+        rows = dict(zip(self.t_names, self.matrix))
+        return dict([(name, rows[name].copy() if name in rows else
+                      self.f_contrasts[name].copy())
+                     for name in self.names])
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_contrasts(paradigm_id, design_matrix_columns):
+    return CompiledContrasts(paradigm_id, design_matrix_columns)
+
+
+def compile_contrasts(paradigm_id, design_matrix_columns):
+    """ Return the CompiledContrasts of a paradigm for a design matrix
+    layout; compiled once per (paradigm, columns) and then reused"""
+    return _compile_contrasts(paradigm_id, tuple(design_matrix_columns))
@@ -3,18 +3,16 @@ Common utilities to all scripts
 
 Author: Bertrand Thirion, Ana Luisa Pinho 2016-2020
 
-Compatibility: Python 3.5
+Compatibility: Python 3.7
 
 """
 
 import os
-import glob
 import warnings
 import pandas as pd
 import shutil
 import numpy as np
-from ibc_public.utils_annotations import expand_table
-from tqdm import tqdm
+from functools import lru_cache
 
 main_parent_dir = '/neurospin/ibc'
 alt_parent_dir = '/storage/store2/data/ibc'
@@ -27,43 +25,82 @@ else:
 DERIVATIVES = os.path.join(ibc, 'derivatives')
 SMOOTH_DERIVATIVES = os.path.join(ibc, 'smooth_derivatives')
 THREE_MM = os.path.join(ibc, '3mm')
+# persistent catalog of the derivatives files, see utils_catalog
+CATALOG = os.path.join(os.path.expanduser('~'), '.cache', 'ibc_public',
+                       'derivatives_catalog.sqlite')
 
 SUBJECTS = ['sub-%02d' % i for i in
             [1, 2, 4, 5, 6, 7, 8, 9, 11, 12, 13, 14, 15]]
 _package_directory = os.path.dirname(os.path.abspath(__file__))
-# Useful for the very simple examples
-CONDITIONS = pd.read_csv(os.path.join(
-    _package_directory, '..', 'ibc_data', 'conditions.tsv'), sep='\t')
-CONTRASTS = pd.read_csv(os.path.join(
-    _package_directory, '..', 'ibc_data', 'main_contrasts.tsv'), sep='\t')
-#  ALL_CONTRASTS = expand_table(pd.read_csv(os.path.join(
-#    _package_directory, '..', 'ibc_data', 'all_contrasts.tsv'),
-#                                         sep='\t'))
 ALL_CONTRASTS = os.path.join(
     _package_directory, '..', 'ibc_data', 'all_contrasts.tsv')
 
-
-# Note that LABELS and BETTER NAMES ARE RELATIVE TO CONTRASTS
-LABELS = {}
-BETTER_NAMES = {}
-all_contrasts = pd.read_csv(ALL_CONTRASTS, sep='\t')
-for i in range(len(CONTRASTS)):
-    task = CONTRASTS.task[i]
-    contrast = CONTRASTS.contrast[i]
-    target = all_contrasts[
-        (all_contrasts.task == task) &
-        (all_contrasts.contrast == contrast)
-    ]
-    if len(target['pretty name'].values):
-        BETTER_NAMES[contrast] = target['pretty name'].values[0]
-    else:
-        BETTER_NAMES[contrast] = contrast
-    pos, neg = contrast, ''
-    if len(target['negative label'].values):
-        neg = target['negative label'].values[0]
-    if len(target['positive label'].values):
-        pos = target['positive label'].values[0]
-    LABELS[contrast] = [neg, pos]
+# CONDITIONS, CONTRASTS, all_contrasts, LABELS and BETTER_NAMES are read
+# from ibc_data on first access only (see __getattr__), so that importing
+# this module, e.g. in every worker process, stays cheap.
+
+
+@lru_cache(maxsize=None)
+def get_conditions():
+    """ Table of the conditions (ibc_data/conditions.tsv)"""
+    return pd.read_csv(os.path.join(
+        _package_directory, '..', 'ibc_data', 'conditions.tsv'), sep='\t')
+
+
+@lru_cache(maxsize=None)
+def get_contrasts():
+    """ Table of the main contrasts (ibc_data/main_contrasts.tsv)"""
+    return pd.read_csv(os.path.join(
+        _package_directory, '..', 'ibc_data', 'main_contrasts.tsv'),
+        sep='\t')
+
+
+@lru_cache(maxsize=None)
+def get_all_contrasts():
+    """ Table of all the contrasts with their annotations
+    (ibc_data/all_contrasts.tsv)"""
+    return pd.read_csv(ALL_CONTRASTS, sep='\t')
+
+
+@lru_cache(maxsize=None)
+def _labels_and_better_names():
+    """ Build LABELS and BETTER_NAMES, relative to the main contrasts
+
+    Each main contrast is matched to the first (task, contrast) row of
+    all_contrasts with a single merge. Unmatched contrasts keep their own
+    name and get [neg, pos] = ['', contrast] labels."""
+    all_contrasts = get_all_contrasts().drop_duplicates(
+        ['task', 'contrast'])
+    merged = get_contrasts()[['task', 'contrast']].merge(
+        all_contrasts[['task', 'contrast', 'pretty name', 'negative label',
+                       'positive label']],
+        on=['task', 'contrast'], how='left', indicator=True)
+    matched = (merged['_merge'] == 'both').values
+    contrasts = merged['contrast'].values
+    better_names = np.where(matched, merged['pretty name'].values, contrasts)
+    negs = np.where(matched, merged['negative label'].values, '')
+    poss = np.where(matched, merged['positive label'].values, contrasts)
+    labels = dict((contrast, [neg, pos])
+                  for contrast, neg, pos in zip(contrasts, negs, poss))
+    better_names = dict(zip(contrasts, better_names))
+    return labels, better_names
+
+
+def __getattr__(name):
+    """ Lazy, cached module attributes (PEP 562)"""
+    if name == 'CONDITIONS':
+        # Useful for the very simple examples
+        return get_conditions()
+    if name == 'CONTRASTS':
+        return get_contrasts()
+    if name == 'all_contrasts':
+        return get_all_contrasts()
+    # Note that LABELS and BETTER NAMES ARE RELATIVE TO CONTRASTS
+    if name == 'LABELS':
+        return _labels_and_better_names()[0]
+    if name == 'BETTER_NAMES':
+        return _labels_and_better_names()[1]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 def get_subject_session(protocols):
@@ -102,8 +139,20 @@ def get_subject_session(protocols):
     return subject_session
 
 
-def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
-                subject_list=SUBJECTS, task_list=False, verbose=0):
+def _derivatives_indexes(derivatives, index=None, catalog=None):
+    """ Indexes of the DERIVATIVES directory (anatomical images and
+    motion parameters) and of derivatives, walking each directory once"""
+    from ibc_public.utils_index import DerivativesIndex
+    if index is None or index.derivatives != derivatives:
+        index = DerivativesIndex(derivatives, catalog=catalog)
+    if os.path.realpath(derivatives) == os.path.realpath(DERIVATIVES):
+        return index, index
+    return DerivativesIndex(DERIVATIVES, catalog=catalog), index
+
+
+def data_parser(derivatives=DERIVATIVES, conditions=None,
+                subject_list=SUBJECTS, task_list=False, verbose=0,
+                index=None, catalog=None):
     """Generate a dataframe that contains all the data corresponding
     to the archi, hcp and rsvp_language acquisitions
 
@@ -113,7 +162,8 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
         path toward a valid BIDS derivatives directory
 
     conditions: pandas DataFrame, optional,
-        dataframe describing the conditions under considerations
+        dataframe describing the conditions under considerations,
+        CONDITIONS by default
 
     subject_list: list, optional,
         list of subjects to be included in the analysis
@@ -124,6 +174,15 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
     verbose: Bool, optional,
              verbosity mode
 
+    index: DerivativesIndex or None, optional,
+           index of the derivatives directory, e.g. shared by several
+           calls. By default, the directory is walked once to build it
+
+    catalog: string or None, optional,
+             path of a persistent catalog of the derivatives (e.g.
+             CATALOG), refreshed incrementally and used instead of walking
+             the directories
+
     Returns
     -------
     db: pandas DataFrame,
@@ -131,6 +190,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
         subject, modality, contrast, session, task, acquisition)
         on the images under consideration
     """
+    if conditions is None:
+        conditions = get_conditions()
+    anat_index, index = _derivatives_indexes(derivatives, index, catalog)
     paths = []
     subjects = []
     sessions = []
@@ -141,9 +203,8 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
 
     # T1 images
     for subject in subject_list:
-        t1_path = 'sub-*/ses-*/anat/w%s_ses-00_T1w.nii.gz' % subject
-        t1_abs_path = os.path.join(DERIVATIVES, t1_path)
-        t1_imgs_ = glob.glob(os.path.join(t1_abs_path))
+        t1_imgs_ = anat_index.find('w%s_ses-00_T1w.nii.gz' % subject,
+                                   folder='anat', session='ses-*')
         for img in t1_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -156,9 +217,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
             acquisitions.append('')
 
     for subject in subject_list:
-        t1bet_path = 'sub-*/ses-*/anat/w%s_ses-00_T1w_bet.nii.gz' % subject
-        t1bet_abs_path = os.path.join(DERIVATIVES, t1bet_path)
-        t1bet_imgs_ = glob.glob(os.path.join(t1bet_abs_path))
+        t1bet_imgs_ = anat_index.find(
+            'w%s_ses-00_T1w_bet.nii.gz' % subject, folder='anat',
+            session='ses-*')
         for img in t1bet_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -171,9 +232,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
             acquisitions.append('')
 
     for subject in subject_list:
-        ht1_path = 'sub-*/ses-*/anat/w%s*_acq-highres_T1w_bet.nii.gz' % subject
-        ht1_abs_path = os.path.join(DERIVATIVES, ht1_path)
-        ht1_imgs_ = glob.glob(os.path.join(ht1_abs_path))
+        ht1_imgs_ = anat_index.find(
+            'w%s*_acq-highres_T1w_bet.nii.gz' % subject, folder='anat',
+            session='ses-*')
         for img in ht1_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -187,9 +248,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
 
     # gray-matter images
     for subject in subject_list:
-        mwc1_path = 'sub-*/ses-*/anat/mwc1%s_ses-00_T1w.nii.gz' % subject
-        mwc1_abs_path = os.path.join(DERIVATIVES, mwc1_path)
-        mwc1_imgs_ = glob.glob(os.path.join(mwc1_abs_path))
+        mwc1_imgs_ = anat_index.find(
+            'mwc1%s_ses-00_T1w.nii.gz' % subject, folder='anat',
+            session='ses-*')
         for img in mwc1_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -202,9 +263,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
             acquisitions.append('')
 
     for subject in subject_list:
-        hmwc1_path = 'sub-*/ses-*/anat/mwc1%s*_acq-highres_T1w.nii.gz' % subject
-        hmwc1_abs_path = os.path.join(DERIVATIVES, hmwc1_path)
-        hmwc1_imgs_ = glob.glob(os.path.join(hmwc1_abs_path))
+        hmwc1_imgs_ = anat_index.find(
+            'mwc1%s*_acq-highres_T1w.nii.gz' % subject, folder='anat',
+            session='ses-*')
         for img in hmwc1_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -218,9 +279,9 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
 
     # white-matter image
     for subject in subject_list:
-        mwc2_path = 'sub-*/ses-*/anat/mwc2%s_ses-00_T1w.nii.gz' % subject
-        mwc2_abs_path = os.path.join(DERIVATIVES, mwc2_path)
-        mwc2_imgs_ = glob.glob(os.path.join(mwc2_abs_path))
+        mwc2_imgs_ = anat_index.find(
+            'mwc2%s_ses-00_T1w.nii.gz' % subject, folder='anat',
+            session='ses-*')
         for img in mwc2_imgs_:
             session = img.split('/')[-3]
             subject_id = img.split('/')[-4]
@@ -239,9 +300,8 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
                 for task in task_list:
                     bold_name = 'wrdc%s_ses*_task-%s_dir-%s*_bold.nii.gz' \
                                 % (sbj, task, acq)
-                    bold_path = os.path.join(derivatives, 'sub-*/ses-*/func',
-                                             bold_name)
-                    bold = glob.glob(bold_path)
+                    bold = index.find(bold_name, folder='func',
+                                      session='ses-*', sub=sbj)
                     if not bold:
                         # Add exception for 'bang' task, since 'ap' was
                         # never part of acq planning
@@ -276,9 +336,8 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
 
                     rps_name = 'rp_dc%s_ses*_task-%s_dir-%s*_bold.txt' \
                                % (sbj, task, acq)
-                    rps_path = os.path.join(DERIVATIVES, 'sub-*/ses-*/func',
-                                            rps_name)
-                    rps = glob.glob(rps_path)
+                    rps = anat_index.find(rps_name, folder='func',
+                                          session='ses-*', sub=sbj)
                     if not rps:
                         # Add exception for 'bang' task, since 'ap' was
                         # never part of acq planning
@@ -345,7 +404,10 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
                     derivatives, subject, '*',
                     'res_stats_%s*_%s*' % (task, acq),
                     'stat_maps', '%s.nii.gz' % contrast)
-                imgs_ = glob.glob(wildcard)
+                imgs_ = index.find(
+                    '%s.nii.gz' % contrast, subject=subject,
+                    folder='res_stats_%s*_%s*' % (task, acq),
+                    subfolder='stat_maps')
                 if len(imgs_) == 0:
                     print('Missing %s' % wildcard)
                 imgs_.sort()
@@ -377,37 +439,56 @@ def data_parser(derivatives=DERIVATIVES, conditions=CONDITIONS,
     return db
 
 
-def average_anat(db):
+def average_anat(db, n_jobs=1):
     """ return the average anatomical image """
-    from nilearn.image import mean_img
+    from ibc_public.utils_resample import mean_images
     anat_imgs = db[db.contrast == 't1'].path.values
-    mean_anat = mean_img(anat_imgs)
+    mean_anat = mean_images(list(anat_imgs), n_jobs=n_jobs)
     return mean_anat
 
 
-def gm_mask(db, ref_affine, ref_shape, threshold=.25):
+def gm_mask(db, ref_affine, ref_shape, threshold=.25, n_jobs=1):
     """ Utility to create a gm mask by averaging glm images from the db """
-    from nilearn.image import mean_img
+    from ibc_public.utils_resample import mean_images
     import nibabel as nib
     gm_imgs = db[db.contrast == 'gm'].path.values
-    mean_gm = mean_img(
-        gm_imgs, target_affine=ref_affine, target_shape=ref_shape)
-    gm_mask = nib.Nifti1Image((mean_gm.get_data() > .25).astype('uint8'),
-                              ref_affine)
+    mean_gm = mean_images(list(gm_imgs), ref_affine, ref_shape,
+                          n_jobs=n_jobs)
+    gm_mask = nib.Nifti1Image(
+        (np.asanyarray(mean_gm.dataobj) > threshold).astype('uint8'),
+        ref_affine)
     return mean_gm, gm_mask
 
 
-def resample_images(paths, ref_affine, ref_shape):
-    """ Utility to resample images provided as paths and return an image"""
-    from nilearn.image import resample_img
+def anat_templates(db, ref_affine, ref_shape, threshold=.25, n_jobs=1):
+    """ Average anatomy, average gm and gm mask, reading each image once
+
+    Same outputs as average_anat and gm_mask, computed in a single
+    pass over the t1 and gm images of the db (see
+    utils_resample.running_means)"""
+    from ibc_public.utils_resample import running_means
     import nibabel as nib
-    imgs = []
-    for path in paths:
-        fmri_image = resample_img(
-            path, target_affine=ref_affine, target_shape=ref_shape)
-        imgs.append(fmri_image)
-    img = nib.concat_images(imgs)
-    return img
+    means = running_means(
+        {'t1': (list(db[db.contrast == 't1'].path.values), None, None),
+         'gm': (list(db[db.contrast == 'gm'].path.values), ref_affine,
+                ref_shape)}, n_jobs=n_jobs)
+    gm_mask = nib.Nifti1Image(
+        (np.asanyarray(means['gm'].dataobj) > threshold).astype('uint8'),
+        ref_affine)
+    return means['t1'], means['gm'], gm_mask
+
+
+def resample_images(paths, ref_affine, ref_shape, output_file=None,
+                    n_jobs=1):
+    """ Utility to resample images provided as paths and return an image
+
+    The images are resampled directly into a preallocated 4D array (see
+    utils_resample.resample_to_stack).
+    If output_file (an uncompressed .nii path) is provided, the array is a
+    memory map of that file and the returned image is lazily loaded."""
+    from ibc_public.utils_resample import resample_to_stack
+    return resample_to_stack(paths, ref_affine, ref_shape,
+                             output_file=output_file, n_jobs=n_jobs)
 
 
 def summarize_db(df, plot=True):
@@ -491,6 +572,7 @@ def horizontal_fingerprint(coef, roi_name, labels_bottom, labels_top,
 
 def copy_db(df, write_dir, filename='result_db.csv'):
     """Create a copy of all the files to create a portable database."""
+    from tqdm import tqdm
     # Create output folder if it doesn't already exist
     if not os.path.exists(write_dir):
         os.mkdir(write_dir)
@@ -534,8 +616,9 @@ def copy_db(df, write_dir, filename='result_db.csv'):
     return df1
 
 
-def make_surf_db(derivatives=DERIVATIVES, conditions=CONDITIONS,
-                 subject_list=SUBJECTS, task_list=False, mesh="fsaverage5"):
+def make_surf_db(derivatives=DERIVATIVES, conditions=None,
+                 subject_list=SUBJECTS, task_list=False, mesh="fsaverage5",
+                 index=None, catalog=None):
     """ Create a database for surface data (gifti files)
 
     derivatives: string,
@@ -559,6 +642,15 @@ def make_surf_db(derivatives=DERIVATIVES, conditions=CONDITIONS,
           default behaviour will be that of "fsaverage5" if no value
           or incorrect value is given
 
+    index: DerivativesIndex or None, optional,
+           index of the derivatives directory. By default, the directory
+           is walked once to build it
+
+    catalog: string or None, optional,
+             path of a persistent catalog of the derivatives (e.g.
+             CATALOG), refreshed incrementally and used instead of walking
+             the directories
+
     Returns
     -------
     db: pandas DataFrame,
@@ -586,7 +678,12 @@ def make_surf_db(derivatives=DERIVATIVES, conditions=CONDITIONS,
             'Mesh value (%s) unknown ; should be one of %s'
             % (mesh, available_meshes)
         )
-
+    from tqdm import tqdm
+    from ibc_public.utils_index import DerivativesIndex
+    if conditions is None:
+        conditions = get_conditions()
+    if index is None or index.derivatives != derivatives:
+        index = DerivativesIndex(derivatives, subject_list, catalog=catalog)
 
     # fixed-effects activation images
     con_df = conditions
@@ -626,10 +723,9 @@ def make_surf_db(derivatives=DERIVATIVES, conditions=CONDITIONS,
                 dir_ = 'res_individual_%s_ffx' % task
 
             for side in ['lh', 'rh']:
-                wc = os.path.join(
-                    derivatives, subject, '*', dir_, 'stat_surf',
-                    '%s_%s.gii' % (contrast, side))
-                imgs_ = glob.glob(wc)
+                imgs_ = index.find(
+                    '%s_%s.gii' % (contrast, side), subject=subject,
+                    folder=dir_, subfolder='stat_surf')
 
                 imgs_.sort()
 
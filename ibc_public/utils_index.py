@@ -0,0 +1,174 @@
+"""
+In-memory index of the files of a BIDS derivatives directory.
+
+The derivatives directory is walked once (in parallel across subjects)
+with os.scandir, and the queries of data_parser and make_surf_db are then
+answered from the index instead of issuing one recursive glob per subject,
+task and contrast.
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+import pandas as pd
+
+# subdirectories of the res_* directories that are indexed
+INDEXED_SUBFOLDERS = ('stat_maps', 'stat_surf')
+
+IndexEntry = namedtuple(
+    'IndexEntry', ['path', 'subject', 'session', 'folder', 'subfolder',
+                   'name', 'prefix', 'sub', 'task', 'dir', 'acq'])
+
+
+def _has_magic(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+def _parse_entities(name):
+    """ Parse the BIDS entities of a file name
+
+    Returns the prefix added by the preprocessing (e.g. 'wrdc'), and the
+    sub, task, dir and acq entities (None when absent)."""
+    start = name.find('sub-')
+    if start < 0:
+        return '', None, None, None, None
+    entities = {}
+    for part in name[start:].split('.')[0].split('_'):
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[key] = value
+    sub = entities.get('sub')
+    if sub is not None:
+        sub = 'sub-%s' % sub
+    return (name[:start], sub, entities.get('task'), entities.get('dir'),
+            entities.get('acq'))
+
+
+def _scan_files(path):
+    """ Names and paths of the (non hidden, as for glob) files of a
+    directory"""
+    try:
+        return [(entry.name, entry.path) for entry in os.scandir(path)
+                if entry.is_file() and not entry.name.startswith('.')]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _index_subject(subject_dir, subfolders=INDEXED_SUBFOLDERS):
+    """ Index the anat, func and res_*/<subfolder> files of a subject"""
+    subject = os.path.basename(subject_dir)
+    entries = []
+    for session in os.scandir(subject_dir):
+        if not session.is_dir():
+            continue
+        for folder in os.scandir(session.path):
+            if not folder.is_dir():
+                continue
+            if folder.name in ['anat', 'func']:
+                for name, path in _scan_files(folder.path):
+                    entries.append(IndexEntry(
+                        path, subject, session.name, folder.name, '', name,
+                        *_parse_entities(name)))
+            elif folder.name.startswith('res_'):
+                for subfolder in subfolders:
+                    for name, path in _scan_files(
+                            os.path.join(folder.path, subfolder)):
+                        entries.append(IndexEntry(
+                            path, subject, session.name, folder.name,
+                            subfolder, name, '', None, None, None, None))
+    return entries
+
+
+class DerivativesIndex(object):
+    """ Index of the files of a derivatives directory
+
+    Parameters
+    ----------
+    derivatives: string,
+                 path of the derivatives directory
+    subject_list: list or None, optional,
+                  subjects to index; all the sub-* directories by default
+    n_jobs: int, optional,
+            number of subjects walked concurrently
+    subfolders: tuple of strings, optional,
+                subdirectories of the res_* directories to be indexed
+    catalog: string or DerivativesCatalog or None, optional,
+             if provided, the files are read from this persistent catalog
+             (see utils_catalog), after an incremental refresh, instead of
+             walking the whole directory
+
+    Attributes
+    ----------
+    table: pandas DataFrame,
+           one row per file, with its path, subject, session, folder
+           (anat, func or res_* directory), subfolder, file name and the
+           BIDS entities parsed from the file name
+    """
+
+    def __init__(self, derivatives, subject_list=None, n_jobs=8,
+                 subfolders=INDEXED_SUBFOLDERS, catalog=None):
+        self.derivatives = derivatives
+        if catalog is not None:
+            from ibc_public.utils_catalog import DerivativesCatalog
+            if isinstance(catalog, str):
+                catalog = DerivativesCatalog(catalog)
+            catalog.refresh(derivatives, subject_list, n_jobs, subfolders)
+            self._set_entries(catalog.entries(derivatives, subject_list))
+            return
+        if subject_list is None:
+            try:
+                subject_list = sorted(
+                    entry.name for entry in os.scandir(derivatives)
+                    if entry.name.startswith('sub-') and entry.is_dir())
+            except FileNotFoundError:
+                subject_list = []
+        subject_dirs = [os.path.join(derivatives, subject)
+                        for subject in subject_list
+                        if os.path.isdir(os.path.join(derivatives, subject))]
+        # os.scandir releases the GIL, so that threads are enough to
+        # overlap the latency of a networked filesystem
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+            entries = executor.map(
+                lambda subject_dir: _index_subject(subject_dir, subfolders),
+                subject_dirs)
+            self._set_entries(sorted(entry for entries_ in entries
+                                     for entry in entries_))
+
+    def _set_entries(self, entries):
+        """ Store the sorted entries of the index and group them"""
+        self.entries = entries
+        self.table = pd.DataFrame(self.entries, columns=IndexEntry._fields)
+        self._by_name, self._by_subject, self._by_folder = {}, {}, {}
+        for entry in self.entries:
+            self._by_name.setdefault(
+                (entry.subject, entry.name), []).append(entry)
+            self._by_subject.setdefault(
+                (entry.folder, entry.sub), []).append(entry)
+            self._by_folder.setdefault(entry.folder, []).append(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, pattern, folder='*', subfolder='', subject=None,
+             session='*', sub=None):
+        """ Return the sorted paths of the files matching a query
+
+        The query <derivatives>/<subject>/<session>/<folder>/<subfolder>/
+        <pattern> accepts the same shell-style wildcards as glob. The
+        optional sub entity (e.g. 'sub-01') narrows the candidate files,
+        and must be consistent with pattern.
+        """
+        if subject is not None and not _has_magic(pattern):
+            candidates = self._by_name.get((subject, pattern), [])
+        elif sub is not None and not _has_magic(folder):
+            candidates = self._by_subject.get((folder, sub), [])
+        elif not _has_magic(folder):
+            candidates = self._by_folder.get(folder, [])
+        else:
+            candidates = self.entries
+        return [entry.path for entry in candidates
+                if (subject is None or entry.subject == subject) and
+                entry.subfolder == subfolder and
+                fnmatchcase(entry.session, session) and
+                fnmatchcase(entry.folder, folder) and
+                fnmatchcase(entry.name, pattern)]
@@ -0,0 +1,395 @@
+"""
+Input/output utilities for the maps produced by the IBC pipeline.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import iterparse
+import numpy as np
+
+_GIFTI_DTYPES = {
+    'NIFTI_TYPE_UINT8': 'u1', 'NIFTI_TYPE_INT8': 'i1',
+    'NIFTI_TYPE_UINT16': 'u2', 'NIFTI_TYPE_INT16': 'i2',
+    'NIFTI_TYPE_UINT32': 'u4', 'NIFTI_TYPE_INT32': 'i4',
+    'NIFTI_TYPE_UINT64': 'u8', 'NIFTI_TYPE_INT64': 'i8',
+    'NIFTI_TYPE_FLOAT32': 'f4', 'NIFTI_TYPE_FLOAT64': 'f8'}
+
+
+class MapWriter(object):
+    """ Writer for the output maps of the GLM and fixed-effects analyses
+
+    By default, maps are written synchronously, exactly as
+    `img.to_filename(path)` would do. When `n_threads > 0`, maps are
+    queued to a pool of background threads, so that the computation of
+    the next maps (or the fit of the next session) overlaps with writing;
+    `flush` must then be called before the outputs are read back.
+
+    Parameters
+    ----------
+    n_threads: int, optional,
+               number of writing threads. 0 means synchronous writing
+    compress_level: int or None, optional,
+                    gzip compression level (0-9) for .nii.gz outputs.
+                    None keeps nibabel's default. 0 stores the data
+                    uncompressed in a valid gzip container, so that the
+                    file names, and thus all readers, are unchanged.
+    max_pending: int, optional,
+                 maximal number of maps waiting to be written; bounds the
+                 memory held by the queue
+    """
+
+    def __init__(self, n_threads=0, compress_level=None, max_pending=64):
+        if compress_level is not None and not 0 <= compress_level <= 9:
+            raise ValueError('compress_level should be between 0 and 9, '
+                             'got %s' % compress_level)
+        self.n_threads = n_threads
+        self.compress_level = compress_level
+        self.max_pending = max_pending
+        self._pending = []
+        self._executor = None
+        if n_threads > 0:
+            self._executor = ThreadPoolExecutor(max_workers=n_threads)
+
+    def _write(self, img, path):
+        """ Write one image to disk"""
+        if (self.compress_level is not None and path.endswith('.nii.gz')):
+            with gzip.open(path, 'wb',
+                           compresslevel=self.compress_level) as fid:
+                fid.write(img.to_bytes())
+        else:
+            img.to_filename(path)
+        return path
+
+    def write(self, img, path):
+        """ Write (or queue for writing) a Nifti or Gifti image to path"""
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        if self._executor is None:
+            return self._write(img, path)
+        if len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(self._write, img, path))
+        return path
+
+    def flush(self):
+        """ Wait until all queued maps are written.
+
+        Errors raised in the writing threads are raised here."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """ Flush the queue and release the writing threads"""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def file_hash(path, block_size=2 ** 20):
+    """ Return the sha1 hex digest of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _stat_hash(path):
+    """ Cheap identifier of a file version: path, size and mtime.
+
+    Used instead of `file_hash` for large images, that should not be read
+    in full just to be identified."""
+    stat = os.stat(path)
+    key = '%s:%d:%d' % (os.path.realpath(path), stat.st_size,
+                        stat.st_mtime_ns)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def image_hash(img):
+    """ Return an identifier of the content of an image (or image path)"""
+    if isinstance(img, str):
+        return file_hash(img)
+    sha1 = hashlib.sha1(np.ascontiguousarray(img.dataobj).tobytes())
+    sha1.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _is_manifest(path):
+    """ Whether a file of an output directory is a manifest"""
+    return path.startswith('manifest') and path.endswith('.json')
+
+
+def read_manifest(output_dir, name=MANIFEST_NAME):
+    """ Return the manifest of an output directory, or None if there is
+    no (readable) manifest"""
+    path = os.path.join(output_dir, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fid:
+            return json.load(fid)
+    except ValueError:
+        return None
+
+
+def write_manifest(output_dir, inputs, outputs=None, name=MANIFEST_NAME):
+    """ Record the inputs and outputs of the analysis stored in output_dir
+
+    Parameters
+    ----------
+    output_dir: string,
+                the output directory, e.g. a res_stats_* directory
+    inputs: dict,
+            json-serializable description of everything the outputs depend
+            on: hashes of the input files, settings, code version
+    outputs: list or dict or None, optional,
+             paths of the outputs, relative to output_dir. If None, all the
+             files currently in output_dir (but the manifests) are listed
+    name: string, optional,
+          file name of the manifest, to keep several manifests in the same
+          directory (e.g. one per hemisphere)
+    """
+    if outputs is None:
+        outputs = []
+        for root, _, files in os.walk(output_dir):
+            for file_ in files:
+                path = os.path.relpath(os.path.join(root, file_), output_dir)
+                if not _is_manifest(path):
+                    outputs.append(path)
+        outputs.sort()
+    manifest = {'inputs': inputs, 'outputs': outputs}
+    path = os.path.join(output_dir, name)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as fid:
+        json.dump(manifest, fid, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _outputs_exist(output_dir, outputs):
+    """ Whether all the outputs listed in a manifest exist"""
+    return all(os.path.exists(os.path.join(output_dir, output))
+               for output in outputs)
+
+
+def is_up_to_date(output_dir, inputs, name=MANIFEST_NAME):
+    """ Whether output_dir holds all the outputs of a run on these inputs
+
+    True if the manifest (name) of output_dir was written with the same
+    inputs, and all the outputs it lists still exist."""
+    manifest = read_manifest(output_dir, name)
+    if manifest is None:
+        return False
+    # compare the json forms, as tuples are read back as lists
+    inputs = json.loads(json.dumps(inputs))
+    return (manifest['inputs'] == inputs and
+            _outputs_exist(output_dir, manifest['outputs']))
+
+
+def uncompressed_image(path, cache_dir):
+    """ Return the path of an uncompressed copy of a gzipped Nifti image
+
+    The copy is created on the first call, in cache_dir, and reused
+    afterwards as long as the source file is unchanged. Uncompressed
+    images are memory-mapped by nibabel, so that repeated fits on the same
+    run (e.g. smoothed and unsmoothed GLMs) do not inflate the data again.
+
+    Parameters
+    ----------
+    path: string,
+          path of a .nii.gz image. Other paths are returned unchanged
+    cache_dir: string,
+               directory where uncompressed copies are stored
+
+    Returns
+    -------
+    cached_path: string,
+                 path of the uncompressed .nii image
+    """
+    if not path.endswith('.nii.gz'):
+        return path
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    cached_path = os.path.join(
+        cache_dir, '%s_%s' % (_stat_hash(path)[:16],
+                              os.path.basename(path)[:-3]))
+    if not os.path.exists(cached_path):
+        # decompress to a temporary file first, so that concurrent jobs
+        # never see a partially written image
+        tmp_path = '%s.%d.tmp' % (cached_path, os.getpid())
+        with gzip.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 2 ** 24)
+        os.replace(tmp_path, cached_path)
+    return cached_path
+
+
+def purge_cache(cache_dir, max_size):
+    """ Remove the least recently used files of a cache directory
+
+    Files are removed, oldest access first, until the cache holds at most
+    max_size MB. Copies of former versions of a file are never used again,
+    so they are the first to go. Leftover temporary files of interrupted
+    writes are always removed. This is meant for the caches of
+    `uncompressed_image` and `SessionTimeseriesStore`, and must not run
+    while jobs use the cache.
+
+    Parameters
+    ----------
+    cache_dir: string,
+               directory of the cache
+    max_size: float,
+              maximal size of the cache, in MB
+
+    Returns
+    -------
+    removed: list of strings,
+             paths of the removed files
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries, removed = [], []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isfile(path):
+            continue
+        if '.tmp' in name:
+            os.remove(path)
+            removed.append(path)
+            continue
+        stat = os.stat(path)
+        entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size,
+                        path))
+    size = sum(entry[1] for entry in entries)
+    for _, file_size, path in sorted(entries):
+        if size <= max_size * 2 ** 20:
+            break
+        os.remove(path)
+        removed.append(path)
+        size -= file_size
+    return removed
+
+
+def gifti_n_timepoints(path, block_size=2 ** 22):
+    """ Return the number of data arrays (timepoints) of a gifti file
+
+    The data arrays are counted without being decoded."""
+    tag = b'<DataArray'
+    count = 0
+    tail = b''
+    with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            block = tail + block
+            count += block.count(tag)
+            # keep the end of the block in case a tag spans two blocks,
+            # without counting a complete tag twice
+            tail = block[- len(tag) + 1:]
+    return count
+
+
+def _iter_gifti_data(path):
+    """ Yield the attributes and the encoded data of each data array
+    of a gifti file, one array at a time"""
+    attributes = None
+    for event, elem in iterparse(path, events=('start', 'end')):
+        if event == 'start' and elem.tag == 'DataArray':
+            attributes = dict(elem.attrib)
+        elif event == 'end' and elem.tag == 'Data':
+            yield attributes, elem.text
+            elem.clear()
+        elif event == 'end' and elem.tag == 'DataArray':
+            elem.clear()
+
+
+def _decode_gifti_data(attributes, text):
+    """ Decode the content of a gifti <Data> element as a flat array"""
+    dtype = np.dtype(_GIFTI_DTYPES[attributes['DataType']])
+    if attributes.get('Endian', 'LittleEndian') == 'BigEndian':
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+    encoding = attributes.get('Encoding', 'ASCII')
+    if encoding == 'ASCII':
+        return np.array(text.split(), dtype=dtype)
+    raw = base64.b64decode(text)
+    if encoding == 'GZipBase64Binary':
+        raw = zlib.decompress(raw)
+    elif encoding != 'Base64Binary':
+        raise ValueError('Unsupported gifti encoding %s' % encoding)
+    return np.frombuffer(raw, dtype=dtype)
+
+
+def read_gifti_timeseries(path, cache_dir=None):
+    """ Read the data arrays of a gifti file into one float32 array
+
+    Each data array is decoded directly into its row of a preallocated
+    contiguous array, instead of stacking a list of per-timepoint arrays.
+
+    Parameters
+    ----------
+    path: string,
+          path of the gifti file
+    cache_dir: string or None, optional,
+               if provided, the converted array is stored there as a .npy
+               file, and memory-mapped on subsequent calls as long as the
+               gifti file is unchanged
+
+    Returns
+    -------
+    data: array of shape (n_timepoints, n_vertices), float32
+    """
+    if cache_dir is not None:
+        cached_path = os.path.join(cache_dir, '%s_%s.npy' % (
+            _stat_hash(path)[:16], os.path.basename(path)[:-4]))
+        if not os.path.exists(cached_path):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '%s.%d.tmp.npy' % (cached_path[:-4], os.getpid())
+            np.save(tmp_path, read_gifti_timeseries(path))
+            os.replace(tmp_path, cached_path)
+        return np.load(cached_path, mmap_mode='r')
+
+    n_timepoints = gifti_n_timepoints(path)
+    data = None
+    for i, (attributes, text) in enumerate(_iter_gifti_data(path)):
+        if attributes.get('Encoding') == 'ExternalFileBinary':
+            # rare case, let nibabel handle it
+            from nibabel.gifti import read
+            return np.array([darray.data.ravel() for darray in
+                             read(path).darrays], dtype=np.float32)
+        values = _decode_gifti_data(attributes, text)
+        if data is None:
+            data = np.empty((n_timepoints, values.size), dtype=np.float32)
+        data[i] = values
+    if data is None:
+        data = np.empty((0, 0), dtype=np.float32)
+    return data
+
+
+def read_gifti_textures(paths):
+    """ Read a list of textures into an array of shape (n_paths, n_vertices)
+
+    All the data arrays of a texture are concatenated, so that each file
+    yields one row."""
+    data = None
+    for i, path in enumerate(paths):
+        values = read_gifti_timeseries(path).ravel()
+        if data is None:
+            data = np.empty((len(paths), values.size), dtype=np.float32)
+        data[i] = values
+    return data
@@ -12,6 +12,215 @@ _package_directory = os.path.dirname(os.path.abspath(__file__))
 ALL_CONTRASTS = os.path.join(_package_directory, '..', 'ibc_data',
                              'all_contrasts.tsv')
 
+# columns of the label file that are not labels
+_BASE_COLUMNS = ['task', 'contrast', 'positive label', 'negative label',
+                 'pretty name', 'tags']
+
+
+def _parse_tags(tags):
+    """ Parse the tags column of a compact table, e.g. "['a', 'b c']"
+
+    Tolerates missing quotes, as found in some rows of the file."""
+    if not isinstance(tags, str):
+        return []
+    tags = [tag.strip().strip('\'"').strip()
+            for tag in tags.strip().strip('[]').split(',')]
+    return [tag for tag in tags if tag]
+
+
+class LabelIndex(object):
+    """ In-memory index of the cognitive labels of the contrasts
+
+    The label file is read once into a sparse boolean matrix of shape
+    (n_contrasts, n_labels), whose rows follow the (task, contrast) rows of
+    the file. Both the compact format (one 'tags' column holding the list
+    of labels of each contrast) and the sparse format (one column per
+    label) are supported, and edits are written back in the format of the
+    file.
+
+    Parameters
+    ----------
+    path: str, default ALL_CONTRASTS
+          Path of the label file
+
+    Attributes
+    ----------
+    keys: pd.DataFrame
+          The task and contrast of each row of the matrix
+    labels: list of str
+            The labels corresponding to the columns of the matrix
+    matrix: scipy.sparse.csr_matrix of bool, shape (n_contrasts, n_labels)
+    """
+
+    def __init__(self, path=ALL_CONTRASTS):
+        from scipy import sparse
+        self.path = path
+        self._df = pd.read_csv(path, sep='\t')
+        self.compact = 'tags' in self._df.columns
+        self.keys = self._df[['task', 'contrast']].copy()
+        if self.compact:
+            self._row_labels = [_parse_tags(tags) for tags in self._df.tags]
+            self.labels = sorted(set(
+                label for labels in self._row_labels for label in labels))
+            columns = dict((label, j) for j, label in enumerate(self.labels))
+            rows = np.repeat(np.arange(len(self._row_labels)),
+                             [len(labels) for labels in self._row_labels])
+            cols = np.array([columns[label] for labels in self._row_labels
+                             for label in labels], dtype=int)
+            self.matrix = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=bool), (rows, cols)),
+                shape=(len(self._df), len(self.labels)))
+        else:
+            self.labels = [column for column in self._df.columns
+                           if column not in _BASE_COLUMNS]
+            self.matrix = sparse.csr_matrix(
+                (self._df[self.labels] == 1.0).values)
+        self._columns = dict((label, j) for j, label in
+                             enumerate(self.labels))
+
+    def _contrast_mask(self, contrasts='all'):
+        """ Boolean mask of the rows of the given contrast names"""
+        if isinstance(contrasts, str) and contrasts == 'all':
+            return np.ones(len(self.keys), dtype=bool)
+        if isinstance(contrasts, str):
+            contrasts = [contrasts]
+        mask = self.keys['contrast'].isin(contrasts).values
+        not_found = np.setdiff1d(contrasts, self.keys['contrast'][mask])
+        if not_found.size != 0:
+            warnings.warn("The following contrast names were not "
+                          "found: {}".format(not_found))
+        return mask
+
+    def get_labels(self, contrasts='all'):
+        """ Labels of the given contrasts, see get_labels"""
+        mask = self._contrast_mask(contrasts)
+        contrast_dict = {}
+        matrix = self.matrix[np.where(mask)[0]]
+        for (task, contrast), start, stop in zip(
+                self.keys[mask].values, matrix.indptr[:-1],
+                matrix.indptr[1:]):
+            con_name = "({}) {}".format(task, contrast)
+            contrast_dict[con_name] = [
+                self.labels[j] for j in np.sort(matrix.indices[start:stop])]
+        return contrast_dict
+
+    def find_contrasts(self, labels, how='all'):
+        """ Contrasts annotated with a set of labels
+
+        Parameters
+        ----------
+        labels: list of str
+                The labels to look for
+        how: str, 'all' or 'any', default 'all'
+             Whether the contrasts must have all the labels or at least one
+
+        Returns
+        -------
+        contrasts: pd.DataFrame
+                   Task and contrast of the matching contrasts
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        known = [self._columns[label] for label in labels
+                 if label in self._columns]
+        if how == 'all':
+            if len(known) < len(labels):
+                # an unknown label is carried by no contrast
+                return self.keys.iloc[:0]
+            counts = np.asarray(self.matrix[:, known].sum(1)).ravel()
+            mask = counts == len(known)
+        elif how == 'any':
+            mask = np.asarray(self.matrix[:, known].sum(1)).ravel() > 0
+        else:
+            raise ValueError("how should be 'all' or 'any', got %s" % how)
+        return self.keys[mask]
+
+    def cooccurrence(self, labels=None):
+        """ Number of contrasts annotated with each pair of labels
+
+        Parameters
+        ----------
+        labels: list of str or None
+                The labels to consider, all of them by default
+
+        Returns
+        -------
+        cooccurrence: pd.DataFrame, shape (n_labels, n_labels)
+                      The diagonal holds the number of contrasts per label
+        """
+        if labels is None:
+            labels = self.labels
+        matrix = self.matrix[:, [self._columns[label] for label in labels]]
+        matrix = matrix.astype(np.int64)
+        return pd.DataFrame(matrix.T.dot(matrix).toarray(), index=labels,
+                            columns=labels)
+
+    def add_labels(self, edits):
+        """ Add labels to contrasts, in memory (see save)
+
+        Parameters
+        ----------
+        edits: dict
+               Labels to add (list of str) indexed by contrast name. Labels
+               that do not exist yet are created.
+        """
+        from scipy import sparse
+        new_labels = []
+        for labels in edits.values():
+            for label in labels:
+                if label not in self._columns and label not in new_labels:
+                    print("No label with the name {} could be found"
+                          .format(label))
+                    new_labels.append(label)
+                    print("Added {}\n".format(label))
+        for label in new_labels:
+            self._columns[label] = len(self.labels)
+            self.labels.append(label)
+            if not self.compact:
+                self._df[label] = 0.0
+
+        matrix = sparse.lil_matrix(
+            (self.matrix.shape[0], len(self.labels)), dtype=bool)
+        matrix[:, :self.matrix.shape[1]] = self.matrix
+        for contrast, labels in edits.items():
+            rows = np.where(self.keys['contrast'].values == contrast)[0]
+            cols = [self._columns[label] for label in labels]
+            matrix[np.ix_(rows, cols)] = True
+            if self.compact:
+                for row in rows:
+                    self._row_labels[row] += [
+                        label for label in labels
+                        if label not in self._row_labels[row]]
+                    self._df.at[row, 'tags'] = str(self._row_labels[row])
+            else:
+                self._df.loc[rows, labels] = 1.0
+        self.matrix = matrix.tocsr()
+
+    def save(self, output_file=None):
+        """ Write the labels, in the format of the original file
+
+        Parameters
+        ----------
+        output_file: str or path object
+                     Path of the new label file, the original one by default
+        """
+        if output_file is None:
+            output_file = self.path
+        self._df.to_csv(output_file, sep='\t', index=False)
+
+
+_LABEL_INDEXES = {}
+
+
+def get_label_index(path=ALL_CONTRASTS):
+    """ Return the LabelIndex of a label file, loaded once
+
+    The index is loaded again if the file was modified on disk."""
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _LABEL_INDEXES or _LABEL_INDEXES[path][0] != mtime:
+        _LABEL_INDEXES[path] = (mtime, LabelIndex(path))
+    return _LABEL_INDEXES[path][1]
+
 
 def get_labels(contrasts='all'):
     """
@@ -29,32 +238,16 @@ def get_labels(contrasts='all'):
                    Dictionary containing the contrasts provided by the user
                    as keys, and their corresponding labels as values
     """
-    df = pd.read_csv(ALL_CONTRASTS, sep='\t')
-    if contrasts == 'all':
-        contrasts = df['contrast'].values
-
-    contrast_dict = {}
-
-    con_slice = df[df['contrast'].isin(contrasts)]
-    not_found = np.setdiff1d(contrasts, con_slice['contrast'])
-
-    if not_found.size != 0:
-        warnings.warn("The following contrast names were not "
-                      "found: {}".format(not_found))
-
-    for index, con in con_slice.iterrows():
-
-        labels = con.loc[con == 1.0].index
-        con_name = "({}) {}".format(con.task, con.contrast)
-        contrast_dict[con_name] = [label for label in labels]
-
-    return contrast_dict
+    return get_label_index().get_labels(contrasts)
 
 
 def add_labels(contrast, labels, output_file=ALL_CONTRASTS):
     """
     Adds all the passed labels to the selected contrast
 
+    To edit several contrasts with a single write, use
+    LabelIndex.add_labels then LabelIndex.save.
+
     Paramenters
     -----------
     contrast: str
@@ -68,18 +261,18 @@ def add_labels(contrast, labels, output_file=ALL_CONTRASTS):
                  Path to csv file where the new label database is to be saved
                  with the changed
     """
-    df = pd.read_csv(ALL_CONTRASTS, sep='\t')
-    con_index = df[df['contrast'] == contrast].index
-    for label in labels:
-        if label in df.columns:
-            df.at[con_index, label] = 1.0
-        else:
-            print("No label with the name {} could be found".format(label))
-            df.at[con_index, label] = 1.0
-            df.fillna(0.0, inplace=True)
-            print("Added {}\n".format(label))
-
-    df.to_csv(output_file, sep='\t', index=False)
+    in_place = os.path.abspath(output_file) == os.path.abspath(ALL_CONTRASTS)
+    if in_place:
+        index = get_label_index()
+    else:
+        # leave the cached index of ALL_CONTRASTS untouched
+        index = LabelIndex(ALL_CONTRASTS)
+    index.add_labels({contrast: labels})
+    index.save(output_file)
+    if in_place:
+        # the cached index already reflects the new file
+        _LABEL_INDEXES[ALL_CONTRASTS] = (
+            os.stat(ALL_CONTRASTS).st_mtime_ns, index)
 
 
 def _flatten_contrast(contrast):
@@ -116,11 +309,10 @@ def sparse_labels(output_dir=os.path.dirname(ALL_CONTRASTS), save=True):
     labels_dict = get_labels()
     sparse_list = list(map(_flatten_contrast, labels_dict.items()))
 
+    n_labels = max([len(labels) for labels in labels_dict.values()] + [0])
     col_names = ['Task', 'Contrast']
-    col_names.extend(["Label{}".format(i + 1 for i in range(10))])
+    col_names.extend(["Label{}".format(i + 1) for i in range(n_labels)])
 
     sparse_df = pd.DataFrame(sparse_list, columns=col_names)
 
     return sparse_df
-
-
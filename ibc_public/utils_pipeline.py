@@ -5,6 +5,7 @@ to run fMRI data analyses.
 Author: Bertrand Thirion, 2015
 """
 import os
+import json
 import time
 import numpy as np
 import nibabel as nib
@@ -12,6 +13,7 @@ import warnings
 from pandas import read_csv
 from nilearn.masking import compute_multi_epi_mask
 from nilearn.image import high_variance_confounds
+from nilearn import signal
 
 from nilearn.glm.first_level.design_matrix import (
     make_first_level_design_matrix,
@@ -20,7 +22,11 @@ from nilearn.glm.first_level.design_matrix import (
 # from pypreprocess.reporting.base_reporter import ProgressReport
 # from pypreprocess.reporting.glm_reporter import generate_subject_stats_report
 
-from ibc_public.utils_contrasts import make_contrasts
+from ibc_public.utils_contrasts import make_contrasts, contrast_names
+from ibc_public.utils_io import (
+    MANIFEST_NAME, MapWriter, _stat_hash, file_hash, gifti_n_timepoints, image_hash,
+    is_up_to_date, read_gifti_textures, read_gifti_timeseries, read_manifest,
+    uncompressed_image, write_manifest)
 from ibc_public.utils_paradigm import make_paradigm
 from nilearn.reporting import make_glm_report
 
@@ -133,7 +139,8 @@ def fsl_topup(field_maps, fmri_files, mem, write_dir, modality='func'):
 
 
 def run_glm(dmtx, contrasts, fmri_data, mask_img, subject_dic,
-            subject_session_output_dir, tr, smoothing_fwhm=False):
+            subject_session_output_dir, tr, smoothing_fwhm=False,
+            writer=None):
     """ Run the GLM on a given session and compute contrasts
 
     Parameters
@@ -146,8 +153,13 @@ def run_glm(dmtx, contrasts, fmri_data, mask_img, subject_dic,
         the fMRI data fir by the model
     mask_img : Nifti1Image
         the mask used for the fMRI data
+    writer : MapWriter or None
+        the writer used for the output maps; maps are written
+        synchronously if None
     """
     from nilearn.glm.first_level import FirstLevelModel
+    if writer is None:
+        writer = MapWriter()
     fmri_4d = nib.load(fmri_data)
 
     # GLM analysis
@@ -156,9 +168,29 @@ def run_glm(dmtx, contrasts, fmri_data, mask_img, subject_dic,
                                smoothing_fwhm=smoothing_fwhm).fit(
         fmri_4d, design_matrices=dmtx)
 
-    # compute contrasts
+    # compute the t contrasts in one batch, F contrasts one at a time
+    t_contrasts = dict([(contrast_id, contrast_val) for
+                        (contrast_id, contrast_val) in contrasts.items()
+                        if np.asarray(contrast_val).ndim == 1])
+    names, estimates = batch_contrasts(
+        fmri_glm.labels_[0], fmri_glm.results_[0], t_contrasts)
     z_maps = {}
+    for map_type in ['z_score', 'stat', 'effect_size', 'effect_variance']:
+        map_dir = os.path.join(
+            subject_session_output_dir, '%s_maps' % map_type)
+        if not os.path.exists(map_dir):
+            os.makedirs(map_dir)
+        for contrast_id, estimate in zip(names, estimates[map_type]):
+            stat_map = fmri_glm.masker_.inverse_transform(estimate)
+            map_path = os.path.join(map_dir, '%s.nii.gz' % contrast_id)
+            print("\t\tWriting %s ..." % map_path)
+            writer.write(stat_map, map_path)
+            if map_type == 'z_score':
+                z_maps[contrast_id] = map_path
+
     for contrast_id, contrast_val in contrasts.items():
+        if contrast_id in t_contrasts:
+            continue
         print("\tcontrast id: %s" % contrast_id)
 
         # store stat maps to disk
@@ -167,11 +199,9 @@ def run_glm(dmtx, contrasts, fmri_data, mask_img, subject_dic,
                 contrast_val, output_type=map_type)
             map_dir = os.path.join(
                 subject_session_output_dir, '%s_maps' % map_type)
-            if not os.path.exists(map_dir):
-                os.makedirs(map_dir)
             map_path = os.path.join(map_dir, '%s.nii.gz' % contrast_id)
             print("\t\tWriting %s ..." % map_path)
-            stat_map.to_filename(map_path)
+            writer.write(stat_map, map_path)
 
             # collect zmaps for contrasts we're interested in
             if map_type == 'z_score':
@@ -179,25 +209,302 @@ def run_glm(dmtx, contrasts, fmri_data, mask_img, subject_dic,
     return z_maps, fmri_glm
 
 
-def run_surface_glm(dmtx, contrasts, fmri_path, subject_session_output_dir):
-    """ """
-    from nibabel.gifti import read, write, GiftiDataArray, GiftiImage
-    from nilearn.glm.first_level import run_glm
+def batch_contrasts(labels, results, contrasts):
+    """ Compute all the t contrasts of a fitted GLM in one pass
+
+    The contrast vectors are stacked into a (n_contrasts, n_regressors)
+    matrix, so that effects and variances of all contrasts are obtained
+    with one product per noise-model label instead of one call to
+    `compute_contrast` per contrast and per output type.
+
+    Parameters
+    ----------
+    labels : array of shape (n_voxels,)
+        labels of the noise models, as returned by nilearn's `run_glm`
+    results : dict
+        regression results indexed by labels, as returned by `run_glm`
+    contrasts : dict
+        holding the numerical specification of t contrasts (1D arrays)
+
+    Returns
+    -------
+    names : list of strings
+        the contrast ids, in the order of the rows of the estimates
+    estimates : dict
+        with keys 'z_score', 'stat', 'effect_size', 'effect_variance',
+        each holding an array of shape (n_contrasts, n_voxels)
+    """
+    from scipy.stats import norm, t as t_distribution
+    tiny, dofmax = 1.e-50, 1.e10
+    names = list(contrasts.keys())
+    n_voxels = np.size(labels)
+    if len(names) == 0:
+        empty = np.zeros((0, n_voxels))
+        return names, dict([(map_type, empty) for map_type in [
+            'z_score', 'stat', 'effect_size', 'effect_variance']])
+
+    con = np.array([np.asarray(contrasts[name], dtype=np.float64)
+                    for name in names])
+    effect = np.zeros((len(names), n_voxels))
+    variance = np.zeros((len(names), n_voxels))
+    for label_ in results:
+        label_mask = labels == label_
+        reg = results[label_]
+        n_regressors = reg.theta.shape[0]
+        con_ = con
+        if con.shape[1] < n_regressors:
+            # pad contrasts with zeros as nilearn does
+            con_ = np.hstack((
+                con, np.zeros((con.shape[0], n_regressors - con.shape[1]))))
+        effect[:, label_mask] = np.dot(con_, reg.theta)
+        con_var = np.sum(np.dot(con_, reg.cov) * con_, 1)
+        variance[:, label_mask] = np.outer(
+            con_var, np.ones(label_mask.sum())) * reg.dispersion
+    dof = min(results[label_].df_residuals, dofmax)
+
+    stat = effect / np.sqrt(np.maximum(variance, tiny))
+    p_value = np.clip(t_distribution.sf(stat, dof), 1.e-300, 1. - 1.e-16)
+    one_minus_p_value = np.clip(
+        t_distribution.cdf(stat, dof), 1.e-300, 1. - 1.e-16)
+    z_score = norm.isf(p_value)
+    use_cdf = z_score < 0
+    z_score[use_cdf] = norm.ppf(one_minus_p_value[use_cdf])
+    estimates = {'z_score': z_score, 'stat': stat, 'effect_size': effect,
+                 'effect_variance': variance}
+    return names, estimates
+
+
+def _fit_glm_chunk(Y, X, contrasts, signal_scaling=True):
+    """ Fit the GLM on a block of voxels and estimate all contrasts"""
+    from nilearn.glm.first_level import run_glm as run_glm_
+    from nilearn.glm.first_level import mean_scaling
     from nilearn.glm import compute_contrast
-    Y = np.array([darrays.data for darrays in read(fmri_path).darrays])
-    labels, res = run_glm(Y, dmtx.values)
-    # Estimate the contrasts
-    print('Computing contrasts...')
+    Y = np.asarray(Y, dtype=np.float64)
+    if signal_scaling:
+        Y, _ = mean_scaling(Y)
+    labels, results = run_glm_(Y, X)
+    t_contrasts = dict([(contrast_id, contrast_val) for
+                        (contrast_id, contrast_val) in contrasts.items()
+                        if np.asarray(contrast_val).ndim == 1])
+    names, t_estimates = batch_contrasts(labels, results, t_contrasts)
+    estimates = dict([(map_type, dict(zip(names, t_estimates[map_type])))
+                      for map_type in t_estimates])
+    for contrast_id, contrast_val in contrasts.items():
+        if contrast_id in t_contrasts:
+            continue
+        contrast = compute_contrast(labels, results, contrast_val)
+        estimates['z_score'][contrast_id] = contrast.z_score()
+        estimates['stat'][contrast_id] = contrast.stat()
+        estimates['effect_size'][contrast_id] = contrast.effect_size()
+        estimates['effect_variance'][contrast_id] = contrast.effect_variance()
+    return estimates
+
+
+def _chunk_size(n_scans, n_contrasts, memory_per_job):
+    """ Number of voxels that a job can fit within memory_per_job (in MB)
+
+    The GLM fit holds about 8 float64 copies of the data of a block
+    (scaling, OLS residuals, AR whitening), plus the contrast estimates."""
+    bytes_per_voxel = 8 * (8 * n_scans + 4 * max(n_contrasts, 1))
+    return max(1, int(memory_per_job * 2 ** 20 // bytes_per_voxel))
+
+
+def fit_glm_chunked(Y, X, contrasts, chunk_size=20000, signal_scaling=True,
+                    n_jobs=1, memory_per_job=None):
+    """ Fit a GLM on masked data by blocks of voxels
+
+    Blocks are fitted in parallel processes when n_jobs > 1; each block
+    gets its own AR(1) noise model estimation, and the contrasts of all
+    blocks are computed within the jobs, then concatenated.
+
+    Parameters
+    ----------
+    Y : array of shape (n_scans, n_voxels)
+        the data, possibly memory-mapped
+    X : array of shape (n_scans, n_regressors)
+        the design matrix
+    contrasts : dict
+        holding the numerical specification of contrasts
+    chunk_size : int, optional
+        number of voxels fitted at once
+    signal_scaling : bool, optional
+        whether the data are scaled to percent signal change, as
+        FirstLevelModel does
+    n_jobs : int, optional
+        number of parallel jobs
+    memory_per_job : float or None, optional
+        if provided, approximate bound (in MB) of the memory used by each
+        job; chunk_size is then derived from it
+
+    Returns
+    -------
+    estimates : dict
+        with keys 'z_score', 'stat', 'effect_size', 'effect_variance',
+        each holding a dict of arrays of shape (..., n_voxels)
+        indexed by contrast id
+    """
+    from joblib import Parallel, delayed
+    n_scans, n_voxels = Y.shape
+    if memory_per_job is not None:
+        chunk_size = _chunk_size(n_scans, len(contrasts), memory_per_job)
+    chunks = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_glm_chunk)(
+            Y[:, start: start + chunk_size], X, contrasts, signal_scaling)
+        for start in range(0, n_voxels, chunk_size))
+    return _merge_chunks(chunks)
+
+
+def _merge_chunks(chunks):
+    """ Concatenate the estimates of several blocks of voxels"""
+    return dict([
+        (map_type, dict([
+            (contrast_id, np.concatenate([np.atleast_1d(
+                chunk[map_type][contrast_id]) for chunk in chunks], -1))
+            for contrast_id in chunks[0][map_type]]))
+        for map_type in chunks[0]])
+
+
+def run_masked_glm(dmtx, contrasts, fmri_path, timeseries_store,
+                   subject_session_output_dir, smoothing_fwhm=None,
+                   writer=None, n_jobs=1, memory_per_job=None):
+    """ Run the GLM of a session on the timeseries of a masked store
+
+    Same outputs as run_glm, but the data are read from a
+    SessionTimeseriesStore, so that several passes on the same run
+    (e.g. with and without smoothing) mask the images only once.
+
+    Parameters
+    ----------
+    dmtx : DataFrame
+        the design matrix for the model
+    contrasts : dict
+        holding the numerical specification of contrasts
+    fmri_path : string
+        path of the fMRI run
+    timeseries_store : SessionTimeseriesStore
+        store holding the masked timeseries
+    smoothing_fwhm : float or None
+        fwhm (in mm) of the smoothing, see
+        SessionTimeseriesStore.smoothed_timeseries
+    writer : MapWriter or None
+        the writer used for the output maps
+    n_jobs : int
+        number of processes fitting blocks of voxels
+    memory_per_job : float or None
+        approximate memory bound (in MB) of each process
+
+    Returns
+    -------
+    z_maps : dict
+        paths of the z maps, indexed by contrast id
+    """
+    if writer is None:
+        writer = MapWriter()
+    Y = timeseries_store.smoothed_timeseries(fmri_path, smoothing_fwhm)
+    print('Fitting a GLM on masked data (this takes time)...')
+    estimates = fit_glm_chunked(Y, np.asarray(dmtx), contrasts, n_jobs=n_jobs,
+                                memory_per_job=memory_per_job)
+    z_maps = {}
+    for map_type in ['z_score', 'stat', 'effect_size', 'effect_variance']:
+        map_dir = os.path.join(
+            subject_session_output_dir, '%s_maps' % map_type)
+        for contrast_id in contrasts:
+            stat_map = timeseries_store.unmask(
+                estimates[map_type][contrast_id])
+            map_path = os.path.join(map_dir, '%s.nii.gz' % contrast_id)
+            print("\t\tWriting %s ..." % map_path)
+            writer.write(stat_map, map_path)
+            if map_type == 'z_score':
+                z_maps[contrast_id] = map_path
+    return z_maps
+
+
+def _figure_html(figure):
+    """ html img element holding a matplotlib figure, as png"""
+    import base64
+    import io
+    import matplotlib.pyplot as plt
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', bbox_inches='tight')
+    plt.close(figure)
+    return '<img src="data:image/png;base64,%s"/>' % (
+        base64.b64encode(buffer.getvalue()).decode('ascii'))
+
+
+def make_masked_glm_report(dmtx, contrasts, z_maps, output_file, bg_img,
+                           threshold=3.0, cluster_threshold=15, title=None):
+    """ Write the stats report of a GLM fitted by run_masked_glm
+
+    No FirstLevelModel is fitted on masked data, so the report is built
+    from the design and the z maps, with the same content as that of
+    make_glm_report: the design matrix and, for each contrast, its
+    weights, its z map thresholded at threshold and the table of the
+    clusters larger than cluster_threshold voxels.
+
+    Parameters
+    ----------
+    dmtx : DataFrame
+        the design matrix of the model
+    contrasts : dict
+        holding the numerical specification of contrasts
+    z_maps : dict
+        z maps (images or paths), indexed by contrast id
+    output_file : string
+        path of the html report
+    bg_img : Nifti1Image or string
+        background image of the maps, e.g. the anatomical image
+    """
+    from nilearn.plotting import (plot_contrast_matrix, plot_design_matrix,
+                                  plot_stat_map)
+    from nilearn.reporting import get_clusters_table
+    if title is None:
+        title = 'GLM report'
+    sections = ['<h1>%s</h1>' % title, '<h2>Design matrix</h2>',
+                _figure_html(plot_design_matrix(dmtx).figure)]
+    for contrast_id, contrast_val in contrasts.items():
+        z_map = z_maps[contrast_id]
+        display = plot_stat_map(z_map, bg_img=bg_img, threshold=threshold,
+                                title=contrast_id)
+        figure = display.frame_axes.figure
+        sections += [
+            '<h2>%s</h2>' % contrast_id,
+            _figure_html(plot_contrast_matrix(
+                np.asarray(contrast_val), design_matrix=dmtx).figure),
+            _figure_html(figure),
+            get_clusters_table(z_map, threshold,
+                               cluster_threshold=cluster_threshold).to_html()]
+    with open(output_file, 'w') as fid:
+        fid.write('<html><head><meta charset="UTF-8"><title>%s</title>'
+                  '</head><body>\n%s\n</body></html>' % (
+                      title, '\n'.join(sections)))
+
+
+def run_surface_glm(dmtx, contrasts, fmri_path, subject_session_output_dir,
+                    writer=None, n_jobs=1, memory_per_job=None):
+    """ Run the GLM on a given surface session and compute contrasts
+
+    Vertices are fitted by blocks (see fit_glm_chunked), in n_jobs
+    parallel processes, each using about memory_per_job MB.
+    """
+    from nibabel.gifti import GiftiDataArray, GiftiImage
+    Y = read_gifti_timeseries(fmri_path)
+    if writer is None:
+        writer = MapWriter()
+    print('Fitting a GLM and computing contrasts...')
+    chunk_size = Y.shape[1]
+    if n_jobs != 1:
+        # at least one block per job
+        chunk_size = int(np.ceil(Y.shape[1] / float(abs(n_jobs))))
+    estimates = fit_glm_chunked(
+        Y, dmtx.values, contrasts, chunk_size=chunk_size,
+        signal_scaling=False, n_jobs=n_jobs, memory_per_job=memory_per_job)
     side = fmri_path[-6:-4]
     for index, contrast_id in enumerate(contrasts):
         print('  Contrast % i out of %i: %s' %
               (index + 1, len(contrasts), contrast_id))
-        # compute contrasts
-        con_ = contrasts[contrast_id]
-        contrast_ = compute_contrast(labels, res, con_)
-        stats = [contrast_.z_score(), contrast_.stat_, contrast_.effect,
-                 contrast_.variance]
-        for map_type, out_map in zip(['z', 't', 'effects', 'variance'], stats):
+        for map_type, estimate in zip(
+                ['z', 't', 'effects', 'variance'],
+                ['z_score', 'stat', 'effect_size', 'effect_variance']):
             map_dir = os.path.join(
                 subject_session_output_dir, '%s_surf' % map_type)
             if not os.path.exists(map_dir):
@@ -206,8 +513,8 @@ def run_surface_glm(dmtx, contrasts, fmri_path, subject_session_output_dir):
             print("\t\tWriting %s ..." % map_path)
             tex = GiftiImage(
                 darrays=[GiftiDataArray().from_array(
-                    out_map, intent='t test')])
-            write(tex, map_path)
+                    estimates[estimate][contrast_id], intent='t test')])
+            writer.write(tex, map_path)
 
 
 def masking(func, output_dir):
@@ -229,8 +536,46 @@ def masking(func, output_dir):
     return mask_img
 
 
+def _make_design(onset, onset_hash, task_id, frametimes, hrf_model,
+                 drift_model, high_pass, add_regs, add_reg_names,
+                 code_version=None):
+    """ Create the paradigm, design matrix and contrasts of a session
+
+    onset_hash identifies the content of the onset file, and code_version
+    the code building designs and contrasts (see `_code_version`), so that
+    cached results are invalidated when either of them changes."""
+    if onset is None:
+        paradigm = None
+    else:
+        paradigm = make_paradigm(onset, task_id)
+    design_matrix = make_first_level_design_matrix(
+        frametimes, paradigm, hrf_model=hrf_model, drift_model=drift_model,
+        high_pass=high_pass, add_regs=add_regs,
+        add_reg_names=add_reg_names)
+    _, dmtx, names = check_design_matrix(design_matrix)
+    contrasts = make_contrasts(task_id, names)
+    return paradigm, design_matrix, contrasts
+
+
+def _code_version():
+    """ Identifier of the code producing the maps: hash of the sources
+    of the modules defining the designs, contrasts and models"""
+    import hashlib
+    from ibc_public import utils_contrasts, utils_paradigm
+    sha1 = hashlib.sha1()
+    for module_file in [__file__, utils_contrasts.__file__,
+                        utils_paradigm.__file__]:
+        if module_file.endswith('.pyc'):
+            module_file = module_file[:-1]
+        sha1.update(file_hash(module_file).encode('utf-8'))
+    return sha1.hexdigest()
+
+
 def first_level(subject_dic, additional_regressors=None, compcorr=False,
-                smooth=None, mesh=False, mask_img=None):
+                smooth=None, mesh=False, mask_img=None, writer=None,
+                bold_cache_dir=None, timeseries_store=None,
+                design_cache_dir=None, n_jobs=1, memory_per_job=None,
+                incremental=False, stats_report=True):
     """ Run the first-level analysis (GLM fitting + statistical maps)
     in a given subject
 
@@ -246,8 +591,45 @@ def first_level(subject_dic, additional_regressors=None, compcorr=False,
               whether confound estimation and removal should be done or not
     smooth: float or None, optional,
             how much the data should spatially smoothed during masking
+    writer: MapWriter or None, optional,
+            writer used for the output maps. With a threaded writer,
+            the writing of a session overlaps with the fit of the next one;
+            all maps are flushed to disk before returning
+    bold_cache_dir: string or None, optional,
+            if provided, the gzipped BOLD runs are decompressed once in this
+            directory and the memory-mapped copies are used for the fit
+    timeseries_store: SessionTimeseriesStore or None, optional,
+            if provided, volume GLMs are fit on the masked timeseries of
+            the store (whose mask then replaces mask_img), smoothed as
+            SessionTimeseriesStore.smoothed_timeseries does. The stats
+            report is then built by make_masked_glm_report
+    design_cache_dir: string or None, optional,
+            if provided, paradigms, design matrices and contrasts are cached
+            in this directory, keyed by the content of the onset file, the
+            frame times, the hrf, drift and high-pass settings, the
+            additional regressors (including motion parameters) and the
+            version of the code building them
+    n_jobs: int, optional,
+            number of processes used to fit surface GLMs and GLMs on the
+            timeseries store, by blocks of vertices or voxels
+    memory_per_job: float or None, optional,
+            approximate memory bound (in MB) of each of these processes
+    incremental: bool, optional,
+            if True, sessions whose outputs are up to date are skipped.
+            A manifest.json file is written in each output directory
+            (manifest_lh.json and manifest_rh.json on surfaces, as both
+            hemispheres share the directory), recording the BOLD run (path,
+            size and modification time), the hashes of the onset, motion,
+            additional regressor and mask files, the model settings, the
+            code version and the output files; a session is up to date when
+            all of these are unchanged and the outputs still exist
+    stats_report: bool, optional,
+            if True, a report_stats.html file is written in the output
+            directory of each volume session
     """
     start_time = time.ctime()
+    if writer is None:
+        writer = MapWriter()
     # experimental paradigm meta-params
     motion_names = ['tx', 'ty', 'tz', 'rx', 'ry', 'rz']
     hrf_model = subject_dic['hrf_model']
@@ -255,25 +637,98 @@ def first_level(subject_dic, additional_regressors=None, compcorr=False,
     drift_model = subject_dic['drift_model']
     tr = subject_dic['TR']
 
-    if not mesh and (mask_img is None):
+    if timeseries_store is not None:
+        mask_img = timeseries_store.mask_img
+    elif not mesh and (mask_img is None):
         mask_img = masking(subject_dic['func'], subject_dic['output_dir'])
 
     if additional_regressors is None:
         additional_regressors = dict(
             [(session_id, None) for session_id in subject_dic['session_id']])
 
+    make_design = _make_design
+    if design_cache_dir is not None:
+        from joblib import Memory
+        make_design = Memory(design_cache_dir, verbose=0).cache(
+            _make_design, ignore=['onset'])
+
+    code_version = _code_version()
+    mask_hash = None
+    if mask_img is not None:
+        mask_hash = image_hash(mask_img)
+    manifests = []
     for session_id, fmri_path, onset, motion_path in zip(
             subject_dic['session_id'], subject_dic['func'],
             subject_dic['onset'], subject_dic['realignment_parameters']):
 
         task_id = _session_id_to_task_id([session_id])[0]
 
+        if mesh  == 'fsaverage5':
+            # this is low-resolution data
+            subject_session_output_dir = os.path.join(
+                subject_dic['output_dir'],
+                'res_fsaverage5_%s' % session_id)
+        elif mesh == 'fsaverage7':
+                subject_session_output_dir = os.path.join(
+                    subject_dic['output_dir'], 'res_fsaverage7_%s' % session_id)
+        elif mesh == 'individual':
+            subject_session_output_dir = os.path.join(
+                    subject_dic['output_dir'], 'res_individual_%s' % session_id)
+        else:
+            subject_session_output_dir = os.path.join(
+                subject_dic['output_dir'], 'res_stats_%s' % session_id)
+
         if mesh is not False:
-            from nibabel.gifti import read
-            n_scans = np.array(
-                [darrays.data for darrays in read(fmri_path).darrays]).shape[0]
+            compcorr = False  # XXX Fixme
+
+        if onset is None:
+            warnings.warn('Onset file not provided. Trying to guess it')
+            task = os.path.basename(fmri_path).split('task')[-1][4:]
+            onset = os.path.join(
+                os.path.split(os.path.dirname(fmri_path))[0], 'model001',
+                'onsets', 'task' + task + '_run001', 'task%s.csv' % task)
+
+        if not os.path.exists(onset):
+            warnings.warn('non-existant onset file. proceeding without it')
+            onset, onset_hash = None, None
         else:
-            n_scans = nib.load(fmri_path).shape[3]
+            onset_hash = file_hash(onset)
+
+        # everything the outputs of the session depend on
+        inputs = {
+            'bold': _stat_hash(fmri_path),
+            'onset': onset_hash,
+            'motion': file_hash(motion_path),
+            'additional_regressors': None,
+            'mask': mask_hash,
+            'settings': {
+                'task_id': task_id, 'hrf_model': hrf_model,
+                'drift_model': drift_model, 'high_pass': high_pass,
+                'tr': tr, 'smooth': smooth, 'compcorr': compcorr,
+                'mesh': mesh, 'masked_store': timeseries_store is not None,
+                'masked_smoothing': getattr(timeseries_store,
+                                            'masked_smoothing', False)},
+            'code': code_version}
+        if additional_regressors[session_id] is not None:
+            inputs['additional_regressors'] = file_hash(
+                additional_regressors[session_id])
+        manifest_name = MANIFEST_NAME
+        if mesh is not False:
+            # both hemispheres of the session share the output directory
+            manifest_name = 'manifest_%s.json' % fmri_path[-6:-4]
+        if incremental and is_up_to_date(subject_session_output_dir, inputs,
+                                         manifest_name):
+            print('%s is up to date, skipping' % subject_session_output_dir)
+            continue
+
+        bold_path = fmri_path
+        if bold_cache_dir is not None and mesh is False:
+            bold_path = uncompressed_image(fmri_path, bold_cache_dir)
+
+        if mesh is not False:
+            n_scans = gifti_n_timepoints(fmri_path)
+        else:
+            n_scans = nib.load(bold_path).shape[3]
 
         # motion parameters
         motion = np.loadtxt(motion_path)
@@ -289,30 +744,19 @@ def first_level(subject_dic, additional_regressors=None, compcorr=False,
                 np.repeat(np.arange(n_cycles) * cycle_duration, mask.sum())
             frametimes = frametimes[:-2]  # for some reason...
 
-        if mesh is not False:
-            compcorr = False  # XXX Fixme
-
         if compcorr:
-            confounds = high_variance_confounds(fmri_path, mask_img=mask_img)
+            if timeseries_store is not None:
+                confounds = signal.high_variance_confounds(
+                    np.asarray(timeseries_store.timeseries(bold_path)))
+            else:
+                confounds = high_variance_confounds(
+                    bold_path, mask_img=mask_img)
             confounds = np.hstack((confounds, motion))
             confound_names = ['conf_%d' % i for i in range(5)] + motion_names
         else:
             confounds = motion
             confound_names = motion_names
 
-        if onset is None:
-            warnings.warn('Onset file not provided. Trying to guess it')
-            task = os.path.basename(fmri_path).split('task')[-1][4:]
-            onset = os.path.join(
-                os.path.split(os.path.dirname(fmri_path))[0], 'model001',
-                'onsets', 'task' + task + '_run001', 'task%s.csv' % task)
-
-        if not os.path.exists(onset):
-            warnings.warn('non-existant onset file. proceeding without it')
-            paradigm = None
-        else:
-            paradigm = make_paradigm(onset, task_id)
-
         # handle manually supplied regressors
         add_reg_names = []
         if additional_regressors[session_id] is None:
@@ -328,30 +772,10 @@ def first_level(subject_dic, additional_regressors=None, compcorr=False,
 
         add_reg_names += confound_names
 
-        # create the design matrix
-        design_matrix = make_first_level_design_matrix(
-            frametimes, paradigm, hrf_model=hrf_model, drift_model=drift_model,
-            high_pass=high_pass, add_regs=add_regs,
-            add_reg_names=add_reg_names)
-        _, dmtx, names = check_design_matrix(design_matrix)
-
-        # create the relevant contrasts
-        contrasts = make_contrasts(task_id, names)
-
-        if mesh  == 'fsaverage5':
-            # this is low-resolution data
-            subject_session_output_dir = os.path.join(
-                subject_dic['output_dir'],
-                'res_fsaverage5_%s' % session_id)
-        elif mesh == 'fsaverage7':
-                subject_session_output_dir = os.path.join(
-                    subject_dic['output_dir'], 'res_fsaverage7_%s' % session_id)
-        elif mesh == 'individual':
-            subject_session_output_dir = os.path.join(
-                    subject_dic['output_dir'], 'res_individual_%s' % session_id)
-        else:
-            subject_session_output_dir = os.path.join(
-                subject_dic['output_dir'], 'res_stats_%s' % session_id)
+        # create the design matrix and the relevant contrasts
+        paradigm, design_matrix, contrasts = make_design(
+            onset, onset_hash, task_id, frametimes, hrf_model, drift_model,
+            high_pass, add_regs, add_reg_names, code_version)
 
         if not os.path.exists(subject_session_output_dir):
             os.makedirs(subject_session_output_dir)
@@ -360,26 +784,50 @@ def first_level(subject_dic, additional_regressors=None, compcorr=False,
 
         if mesh is not False:
             run_surface_glm(
-                design_matrix, contrasts, fmri_path, subject_session_output_dir)
+                design_matrix, contrasts, fmri_path,
+                subject_session_output_dir, writer=writer, n_jobs=n_jobs,
+                memory_per_job=memory_per_job)
+        elif timeseries_store is not None:
+            z_maps = run_masked_glm(
+                design_matrix, contrasts, bold_path, timeseries_store,
+                subject_session_output_dir, smoothing_fwhm=smooth,
+                writer=writer, n_jobs=n_jobs, memory_per_job=memory_per_job)
+            if stats_report:
+                # the report reads the z maps back from disk
+                writer.flush()
+                make_masked_glm_report(
+                    design_matrix, contrasts, z_maps,
+                    os.path.join(subject_session_output_dir,
+                                 'report_stats.html'),
+                    bg_img=nib.load(subject_dic['anat']), threshold=3.0,
+                    cluster_threshold=15,
+                    title="GLM for subject %s" % session_id)
         else:
             z_maps, fmri_glm = run_glm(
-                design_matrix, contrasts, fmri_path, mask_img, subject_dic,
-                subject_session_output_dir, tr=tr, smoothing_fwhm=smooth)
-
-
-            # do stats report
-            anat_img = nib.load(subject_dic['anat'])
-            stats_report_filename = os.path.join(
-                 subject_session_output_dir, 'report_stats.html')
-
-            report = make_glm_report(fmri_glm,
-                                     contrasts,
-                                     threshold=3.0,
-                                     bg_img=anat_img,
-                                     cluster_threshold=15,
-                                     title="GLM for subject %s" % session_id,
-                                     )
-            report.save_as_html(stats_report_filename)
+                design_matrix, contrasts, bold_path, mask_img, subject_dic,
+                subject_session_output_dir, tr=tr, smoothing_fwhm=smooth,
+                writer=writer)
+
+            if stats_report:
+                # do stats report
+                anat_img = nib.load(subject_dic['anat'])
+                stats_report_filename = os.path.join(
+                     subject_session_output_dir, 'report_stats.html')
+
+                report = make_glm_report(fmri_glm,
+                                         contrasts,
+                                         threshold=3.0,
+                                         bg_img=anat_img,
+                                         cluster_threshold=15,
+                                         title="GLM for subject %s" %
+                                         session_id)
+                report.save_as_html(stats_report_filename)
+        manifests.append((subject_session_output_dir, inputs, manifest_name))
+    writer.flush()
+    # the manifests are written once all the maps are on disk
+    for subject_session_output_dir, inputs, manifest_name in manifests:
+        write_manifest(subject_session_output_dir, inputs,
+                       name=manifest_name)
 
 
 def _session_id_to_task_id(session_ids):
@@ -459,17 +907,44 @@ def _load_summary_stats(output_dir, sessions, contrast, data_available=True,
     return effect_size_maps, effect_variance_maps, data_available
 
 
+def _maps_hash(paths):
+    """ Identifier of the versions of a list of maps"""
+    import hashlib
+    sha1 = hashlib.sha1()
+    for path in paths:
+        sha1.update(_stat_hash(path).encode('utf-8'))
+    return sha1.hexdigest()
+
+
 def fixed_effects_analysis(subject_dic, mask_img=None,
-                           mesh=False):
-    """ Combine the AP and PA images """
-    from nibabel import load, save
+                           mesh=False, writer=None, incremental=False):
+    """ Combine the AP and PA images
+
+    The output maps are written through `writer` (synchronously if None),
+    and flushed to disk before returning.
+
+    A manifest.json file is written in each output directory, recording
+    for each contrast the versions of the session maps it combines, with
+    the mask, the sessions and the code version. If incremental is True,
+    only the contrasts whose inputs changed, or whose outputs are missing,
+    are recomputed.
+    """
+    from nibabel import load
     from nilearn.plotting import plot_stat_map
+    from ibc_public.utils_io import _outputs_exist
+    if writer is None:
+        writer = MapWriter()
 
     session_ids = subject_dic['session_id']
     task_ids = _session_id_to_task_id(session_ids)
     paradigms = np.unique(task_ids)
     if mask_img is None:
         mask_img = os.path.join(subject_dic['output_dir'], "mask.nii.gz")
+    mask_hash = None
+    if mesh is False:
+        mask_hash = image_hash(mask_img)
+    code_version = _code_version()
+    manifests = []
 
     # Guessing paradigm from file name
     for paradigm in paradigms:
@@ -478,7 +953,7 @@ def fixed_effects_analysis(subject_dic, mask_img=None,
                             zip(session_ids, task_ids)
                             if task_id == paradigm]
         # define the relevant contrasts
-        contrasts = make_contrasts(paradigm).keys()
+        contrasts = contrast_names(paradigm)
         # create write_dir
         if mesh is not False:
             if mesh == 'fsaverage5':
@@ -502,11 +977,30 @@ def fixed_effects_analysis(subject_dic, mask_img=None,
                 os.makedirs(dir_)
         print(write_dir)
 
-        # iterate across contrasts
-        for contrast in contrasts:
-            print('fixed effects for contrast %s. ' % contrast)
-            if mesh is not False:
-                from nibabel.gifti import write
+        # inputs and outputs of the previous run, if it used the same
+        # sessions, mask and code
+        settings = json.loads(json.dumps({
+            'sessions': session_paradigm, 'mask': mask_hash, 'mesh': mesh,
+            'code': code_version}))
+        inputs = {'settings': settings, 'contrasts': {}}
+        outputs = {}
+        previous_inputs, previous_outputs = {}, {}
+        manifest = read_manifest(write_dir)
+        if (incremental and manifest is not None and
+                manifest['inputs']['settings'] == settings):
+            previous_inputs = manifest['inputs']['contrasts']
+            previous_outputs = manifest['outputs']
+
+        def up_to_date(contrast):
+            return (previous_inputs.get(contrast) ==
+                    inputs['contrasts'][contrast] and
+                    contrast in previous_outputs and
+                    _outputs_exist(write_dir, previous_outputs[contrast]))
+
+        if mesh is not False:
+            # iterate across contrasts
+            for contrast in contrasts:
+                maps = {}
                 for side in ['lh', 'rh']:
                     effect_size_maps, effect_variance_maps, data_available =\
                         _load_summary_stats(
@@ -517,49 +1011,80 @@ def fixed_effects_analysis(subject_dic, mask_img=None,
                     if not data_available:
                         raise ValueError('Missing texture stats files for '
                                          'fixed effects computations')
+                    maps[side] = (effect_size_maps, effect_variance_maps)
+                inputs['contrasts'][contrast] = _maps_hash(
+                    sum([maps[side][0] + maps[side][1]
+                         for side in ['lh', 'rh']], []))
+                if up_to_date(contrast):
+                    outputs[contrast] = previous_outputs[contrast]
+                    continue
+                print('fixed effects for contrast %s. ' % contrast)
+                outputs[contrast] = []
+                for side in ['lh', 'rh']:
                     ffx_effects, ffx_variance, ffx_stat = fixed_effects_surf(
-                        effect_size_maps, effect_variance_maps)
-                    write(ffx_effects, os.path.join(
-                        write_dir, 'effect_surf/%s_%s.gii' % (contrast, side)))
-                    write(ffx_effects, os.path.join(
-                        write_dir, 'variance_surf/%s_%s.gii' %
-                        (contrast, side)))
-                    write(ffx_stat, os.path.join(
-                        write_dir, 'stat_surf/%s_%s.gii' % (contrast, side)))
-            else:
-                effect_size_maps, effect_variance_maps, data_available =\
-                    _load_summary_stats(
-                        subject_dic['output_dir'], session_paradigm, contrast,
-                        data_available=True)
-                shape = load(effect_size_maps[0]).shape
-                if len(shape) > 3:
-                    if shape[3] > 1:  # F contrast, skipping
-                        continue
-                ffx_effects, ffx_variance, ffx_stat = fixed_effects_img(
-                    effect_size_maps, effect_variance_maps, mask_img)
-                save(ffx_effects, os.path.join(
-                    write_dir, 'effect_size_maps/%s.nii.gz' % contrast))
-                save(ffx_variance, os.path.join(
-                    write_dir, 'effect_variance_maps/%s.nii.gz' % contrast))
-                save(ffx_stat, os.path.join(
-                    write_dir, 'stat_maps/%s.nii.gz' % contrast))
-                plot_stat_map(
-                    ffx_stat, bg_img=subject_dic['anat'], display_mode='z',
-                    dim=0, cut_coords=7, title=contrast, threshold=3.0,
-                    output_file=os.path.join(write_dir,
-                                             'stat_maps/%s.png' % contrast))
+                        *maps[side])
+                    for stat, img in zip(
+                            ['effect_surf', 'variance_surf', 'stat_surf'],
+                            [ffx_effects, ffx_variance, ffx_stat]):
+                        output = '%s/%s_%s.gii' % (stat, contrast, side)
+                        writer.write(img, os.path.join(write_dir, output))
+                        outputs[contrast].append(output)
+            manifests.append((write_dir, inputs, outputs))
+            continue
+
+        # gather the maps of all the contrasts to be (re)computed, then
+        # compute all the fixed effects at once
+        t_contrasts, effect_size_maps, effect_variance_maps = [], [], []
+        for contrast in contrasts:
+            effect_size_maps_, effect_variance_maps_, data_available =\
+                _load_summary_stats(
+                    subject_dic['output_dir'], session_paradigm, contrast,
+                    data_available=True)
+            shape = load(effect_size_maps_[0]).shape
+            if len(shape) > 3:
+                if shape[3] > 1:  # F contrast, skipping
+                    continue
+            inputs['contrasts'][contrast] = _maps_hash(
+                effect_size_maps_ + effect_variance_maps_)
+            if up_to_date(contrast):
+                outputs[contrast] = previous_outputs[contrast]
+                continue
+            t_contrasts.append(contrast)
+            effect_size_maps.append(effect_size_maps_)
+            effect_variance_maps.append(effect_variance_maps_)
+
+        print('fixed effects for %d contrasts. ' % len(t_contrasts))
+        for contrast, (ffx_effect, ffx_variance, ffx_stat) in zip(
+                t_contrasts, fixed_effects_img_batch(
+                    effect_size_maps, effect_variance_maps, mask_img)):
+            outputs[contrast] = [
+                'effect_size_maps/%s.nii.gz' % contrast,
+                'effect_variance_maps/%s.nii.gz' % contrast,
+                'stat_maps/%s.nii.gz' % contrast,
+                'stat_maps/%s.png' % contrast]
+            writer.write(ffx_effect, os.path.join(
+                write_dir, 'effect_size_maps/%s.nii.gz' % contrast))
+            writer.write(ffx_variance, os.path.join(
+                write_dir, 'effect_variance_maps/%s.nii.gz' % contrast))
+            writer.write(ffx_stat, os.path.join(
+                write_dir, 'stat_maps/%s.nii.gz' % contrast))
+            plot_stat_map(
+                ffx_stat, bg_img=subject_dic['anat'], display_mode='z',
+                dim=0, cut_coords=7, title=contrast, threshold=3.0,
+                output_file=os.path.join(write_dir,
+                                         'stat_maps/%s.png' % contrast))
+        manifests.append((write_dir, inputs, outputs))
+    writer.flush()
+    # the manifests are written once all the maps are on disk
+    for write_dir, inputs, outputs in manifests:
+        write_manifest(write_dir, inputs, outputs)
 
 
 def fixed_effects_surf(con_imgs, var_imgs):
     """Idem fixed_effects_img but for surfaces"""
-    from nibabel import load
     from nibabel.gifti import GiftiDataArray, GiftiImage
-    con, var = [], []
-    for (con_img, var_img) in zip(con_imgs, var_imgs):
-        con.append(np.ravel([
-            darrays.data for darrays in load(con_img).darrays]))
-        var.append(np.ravel([
-            darrays.data for darrays in load(var_img).darrays]))
+    con = read_gifti_textures(con_imgs)
+    var = read_gifti_textures(var_imgs)
 
     outputs = []
     intents = ['NIFTI_INTENT_ESTIMATE', 'NIFTI_INTENT_ESTIMATE', 't test']
@@ -597,7 +1122,7 @@ def fixed_effects_img(con_imgs, var_imgs, mask_img):
     con, var = [], []
     if isinstance(mask_img, str):
         mask_img = nib.load(mask_img)
-    mask = mask_img.get_data().astype(np.bool)
+    mask = mask_img.get_data().astype(bool)
     for (con_img, var_img) in zip(con_imgs, var_imgs):
         if isinstance(con_img, str):
             con_img = nib.load(con_img)
@@ -609,12 +1134,61 @@ def fixed_effects_img(con_imgs, var_imgs, mask_img):
     arrays = fixed_effects(con, var)
     outputs = []
     for array in arrays:
-        vol = mask.astype(np.float)
+        vol = mask.astype(float)
         vol[mask] = array.ravel()
         outputs.append(nib.Nifti1Image(vol, mask_img.affine))
     return outputs
 
 
+def fixed_effects_img_batch(con_imgs, var_imgs, mask_img):
+    """Compute the fixed effects of several contrasts
+
+    The maps of all (contrast, session) pairs are masked into two float32
+    arrays of shape (n_sessions, n_contrasts, n_voxels); the fixed effects
+    are then computed and scattered back to float32 volumes one contrast at
+    a time, so that only the volumes of one contrast are held at once.
+
+    Parameters
+    ----------
+    con_imgs: list of lists of Nifti1Images or strings
+              the input contrast images, one list of sessions per contrast
+    var_imgs: list of lists of Nifti1Images or strings
+              the input variance images, one list of sessions per contrast
+    mask_img: Nifti1Image or string,
+              mask image
+
+    yields
+    ------
+    (ffx_con, ffx_var, ffx_stat): tuple of Nifti1Images, for each contrast,
+        the fixed effects contrast, variance and t-test within the mask
+    """
+    if isinstance(mask_img, str):
+        mask_img = nib.load(mask_img)
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    n_contrasts = len(con_imgs)
+    if n_contrasts == 0:
+        return
+    n_sessions = len(con_imgs[0])
+    con = np.empty((n_sessions, n_contrasts, mask.sum()), dtype=np.float32)
+    var = np.empty((n_sessions, n_contrasts, mask.sum()), dtype=np.float32)
+    for j, (con_imgs_, var_imgs_) in enumerate(zip(con_imgs, var_imgs)):
+        for i, (con_img, var_img) in enumerate(zip(con_imgs_, var_imgs_)):
+            if isinstance(con_img, str):
+                con_img = nib.load(con_img)
+            if isinstance(var_img, str):
+                var_img = nib.load(var_img)
+            con[i, j] = np.asarray(con_img.dataobj)[mask]
+            var[i, j] = np.asarray(var_img.dataobj)[mask]
+
+    for j in range(n_contrasts):
+        outputs = []
+        for array in fixed_effects(con[:, j], var[:, j]):
+            vol = np.zeros(mask.shape, dtype=np.float32)
+            vol[mask] = array
+            outputs.append(nib.Nifti1Image(vol, mask_img.affine))
+        yield tuple(outputs)
+
+
 def fixed_effects(contrasts, variances):
     """Compute the fixed effets given arrays of effects and variance
     """
@@ -0,0 +1,508 @@
+"""
+Bulk resampling of images with precomputed interpolation operators.
+
+Resampling an image on the grid of a reference is a linear map from the
+source voxels to the target voxels, that only depends on the source affine
+and shape and on the target affine and shape. This map is computed once as
+a sparse matrix, cached in memory and on disk, and then applied to each
+volume of each image sharing the same grid, instead of recomputing the
+coordinate mapping for every file as resample_to_img does.
+
+Such operators need a local interpolation kernel ('linear' or 'nearest').
+The default interpolation is nilearn's 'continuous' (third-order spline),
+whose prefiltering couples all the voxels: it is delegated to
+nilearn.image.resample_img, so that switching to the cached operators is
+an explicit choice of the caller.
+"""
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+RESAMPLING_CACHE = os.path.join(os.path.expanduser('~'), '.cache',
+                                'ibc_public', 'resampling')
+
+
+def _grid_key(source_affine, source_shape, target_affine, target_shape,
+              interpolation):
+    """ Identifier of a (source grid -> target grid) mapping"""
+    key = hashlib.sha1()
+    for affine in [source_affine, target_affine]:
+        key.update(np.asarray(affine, dtype=np.float64).tobytes())
+    key.update(str((tuple(source_shape[:3]), tuple(target_shape[:3]),
+                    interpolation)).encode())
+    return key.hexdigest()
+
+
+def interpolation_operator(source_affine, source_shape, target_affine,
+                           target_shape, interpolation='linear'):
+    """ Sparse matrix resampling a volume on a target grid
+
+    Parameters
+    ----------
+    source_affine: array of shape (4, 4),
+                   affine of the images to be resampled
+    source_shape: tuple,
+                  shape of the images to be resampled (the first 3 values)
+    target_affine: array of shape (4, 4),
+                   affine of the target grid
+    target_shape: tuple of 3 ints,
+                  shape of the target grid
+    interpolation: 'linear' or 'nearest', optional,
+                   'linear' is trilinear interpolation. Values outside of
+                   the source field of view are 0
+
+    Returns
+    -------
+    operator: scipy.sparse.csr_matrix of shape (n_target, n_source),
+              maps the C-ordered raveled source volume to the C-ordered
+              raveled target volume
+    """
+    source_shape = tuple(source_shape[:3])
+    target_shape = tuple(target_shape[:3])
+    n_source = int(np.prod(source_shape))
+    n_target = int(np.prod(target_shape))
+    # voxel coordinates of the target grid in the source grid
+    transform = np.linalg.solve(np.asarray(source_affine, dtype=np.float64),
+                                np.asarray(target_affine, dtype=np.float64))
+    grid = np.indices(target_shape).reshape(3, -1).astype(np.float64)
+    coords = transform[:3, :3].dot(grid) + transform[:3, 3:]
+    del grid
+    bounds = np.array(source_shape)[:, np.newaxis]
+    # as resample_img, set to 0 the target voxels outside of the source
+    # field of view, including the last half voxel of the border
+    in_fov = np.all((coords > - 1e-6) & (coords < bounds - 1 + 1e-6), 0)
+    if interpolation == 'nearest':
+        corner = np.round(coords).astype(np.int64)
+        inside = in_fov & np.all((corner >= 0) & (corner < bounds), 0)
+        rows = np.where(inside)[0]
+        cols = np.ravel_multi_index(corner[:, inside], source_shape)
+        weights = np.ones(rows.size)
+    elif interpolation == 'linear':
+        floor = np.floor(coords)
+        fraction = coords - floor
+        floor = floor.astype(np.int64)
+        rows, cols, weights = [], [], []
+        for offset in np.ndindex(2, 2, 2):
+            offset = np.array(offset)[:, np.newaxis]
+            corner = floor + offset
+            weight = np.prod(np.where(offset, fraction, 1 - fraction), 0)
+            inside = in_fov & np.all((corner >= 0) & (corner < bounds), 0) \
+                & (weight > 0)
+            rows.append(np.where(inside)[0])
+            cols.append(np.ravel_multi_index(corner[:, inside],
+                                             source_shape))
+            weights.append(weight[inside])
+        rows, cols, weights = [np.concatenate(x)
+                               for x in [rows, cols, weights]]
+    else:
+        raise ValueError('Unknown interpolation %s' % interpolation)
+    return sparse.csr_matrix((weights, (rows, cols)),
+                             shape=(n_target, n_source))
+
+
+@lru_cache(maxsize=16)
+def _cached_operator(key, source_affine, source_shape, target_affine,
+                     target_shape, interpolation, cache_dir):
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, '%s.npz' % key)
+        if os.path.exists(path):
+            return sparse.load_npz(path)
+    operator = interpolation_operator(
+        np.array(source_affine), source_shape, np.array(target_affine),
+        target_shape, interpolation)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename, as several threads or processes may compute
+        # it at once: each writer has its own temporary file
+        fd, tmp_path = tempfile.mkstemp(prefix=key, suffix='.tmp.npz',
+                                        dir=cache_dir)
+        os.close(fd)
+        try:
+            sparse.save_npz(tmp_path, operator, compressed=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            # fine if another writer already produced it
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return operator
+
+
+def get_operator(source_affine, source_shape, target_affine, target_shape,
+                 interpolation='linear', cache_dir=RESAMPLING_CACHE):
+    """ Return the interpolation operator of a (source -> target) grid
+    pair, computed once and then read from the memory or disk cache
+    (cache_dir, None to disable it). See interpolation_operator."""
+    source_shape = tuple(int(x) for x in source_shape[:3])
+    target_shape = tuple(int(x) for x in target_shape[:3])
+    source_affine = tuple(map(tuple, np.asarray(source_affine, dtype=float)))
+    target_affine = tuple(map(tuple, np.asarray(target_affine, dtype=float)))
+    key = _grid_key(source_affine, source_shape, target_affine,
+                    target_shape, interpolation)
+    return _cached_operator(key, source_affine, source_shape, target_affine,
+                            target_shape, interpolation, cache_dir)
+
+
+def _same_grid(img, target_affine, target_shape):
+    return (tuple(img.shape[:3]) == tuple(target_shape[:3]) and
+            np.allclose(img.affine, target_affine))
+
+
+def _warm_operators(imgs, target_affine, target_shape, interpolation,
+                    cache_dir):
+    """ Compute the interpolation operators needed by imgs in the calling
+    thread, before the images are handed over to concurrent workers that
+    then only read them from the caches"""
+    if interpolation == 'continuous':
+        return
+    grids = set()
+    for img in imgs:
+        if isinstance(img, str):
+            img = nib.load(img)
+        if _same_grid(img, target_affine, target_shape):
+            continue
+        grid = (tuple(map(tuple, img.affine)), tuple(img.shape[:3]))
+        if grid not in grids:
+            grids.add(grid)
+            get_operator(img.affine, img.shape, target_affine,
+                         target_shape, interpolation, cache_dir)
+
+
+def _is_compressed(img):
+    """ Whether the data of an image lives in a gzipped file, that has to be
+    decompressed from its start for each partial read"""
+    filename = img.get_filename()
+    return filename is not None and filename.endswith('.gz')
+
+
+def resample_volumes(img, target_affine, target_shape,
+                     interpolation='continuous', cache_dir=RESAMPLING_CACHE,
+                     out=None, block_size=16):
+    """ Resample a 3D or 4D image on a target grid
+
+    With 'linear' or 'nearest' interpolation, the volumes of uncompressed
+    4D images are read and resampled block_size at a time, so that only
+    one block of source volumes is in memory at a time; compressed images
+    are read at once, as each partial read decompresses the file again.
+
+    Parameters
+    ----------
+    img: string or nibabel image,
+         image to be resampled
+    target_affine: array of shape (4, 4),
+                   affine of the target grid
+    target_shape: tuple of 3 ints,
+                  shape of the target grid
+    interpolation: 'continuous', 'linear' or 'nearest', optional,
+                   'continuous' uses nilearn.image.resample_img, the others
+                   the cached interpolation operators
+    cache_dir: string or None, optional,
+               disk cache of the interpolation operators
+    out: array or None, optional,
+         array of shape target_shape (+ the number of volumes for 4D
+         images) receiving the result; allocated if None
+    block_size: int, optional,
+                number of volumes of uncompressed images resampled at once
+
+    Returns
+    -------
+    data: array,
+          the resampled data
+    """
+    if isinstance(img, str):
+        img = nib.load(img)
+    target_shape = tuple(target_shape[:3])
+    n_volumes = img.shape[3] if len(img.shape) > 3 else None
+    shape = target_shape if n_volumes is None else \
+        target_shape + (n_volumes,)
+    if out is None:
+        dtype = np.result_type(img.get_data_dtype(), np.float32)
+        out = np.empty(shape, dtype=dtype)
+    if _same_grid(img, target_affine, target_shape):
+        operator = None
+    elif interpolation == 'continuous':
+        from nilearn.image import resample_img
+        out[...] = np.asarray(resample_img(
+            img, target_affine=np.asarray(target_affine),
+            target_shape=target_shape, interpolation='continuous').dataobj)
+        return out
+    else:
+        operator = get_operator(img.affine, img.shape, target_affine,
+                                target_shape, interpolation, cache_dir)
+    if n_volumes is None:
+        blocks = [Ellipsis]
+    else:
+        step = n_volumes if _is_compressed(img) else block_size
+        blocks = [(Ellipsis, slice(t, t + step))
+                  for t in range(0, n_volumes, step)]
+    for block in blocks:
+        data = np.asarray(img.dataobj[block])
+        target = out[block]
+        if operator is None:
+            target[...] = data
+        else:
+            n_columns = 1 if n_volumes is None else data.shape[3]
+            # one sparse product for all the volumes of the block
+            target[...] = operator.dot(
+                data.reshape(-1, n_columns)).reshape(target.shape)
+    return out
+
+
+def resample_image(img, target_affine, target_shape,
+                   interpolation='continuous', cache_dir=RESAMPLING_CACHE):
+    """ Resample an image on a target grid, see resample_volumes
+
+    Returns a nibabel image."""
+    if isinstance(img, str):
+        img = nib.load(img)
+    data = resample_volumes(img, target_affine, target_shape, interpolation,
+                            cache_dir)
+    header = img.header.copy()
+    header.set_data_dtype(data.dtype)
+    return nib.Nifti1Image(data, np.asarray(target_affine), header=header)
+
+
+def allocate_nifti(output_file, shape, affine, dtype=np.float32):
+    """ Create an (uncompressed) NIfTI file of a given shape and return its
+    data as a writable memory map
+
+    The data is allocated on disk without being written, and can be filled
+    piecewise, e.g. one volume at a time. Once the memory map is flushed,
+    nib.load(output_file) returns the image without loading its data.
+
+    Parameters
+    ----------
+    output_file: string,
+                 path of the image, ending with .nii
+    shape: tuple of ints,
+           shape of the image
+    affine: array of shape (4, 4),
+            affine of the image
+    dtype: numpy dtype, optional,
+           data type of the image
+
+    Returns
+    -------
+    data: numpy memmap of the given shape, in Fortran order as in NIfTI
+    """
+    if not output_file.endswith('.nii'):
+        raise ValueError('%s is not an uncompressed NIfTI file' %
+                         output_file)
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header['vox_offset'] = 352
+    dtype = header.get_data_dtype()
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    with open(output_file, 'wb') as fid:
+        header.write_to(fid)
+        # empty extension block, then the data
+        fid.write(b'\x00' * (352 - fid.tell()))
+        fid.truncate(352 + n_bytes)
+    return np.memmap(output_file, dtype=dtype, mode='r+', offset=352,
+                     shape=tuple(shape), order='F')
+
+
+def resample_to_stack(paths, target_affine, target_shape, output_file=None,
+                      n_jobs=1, interpolation='continuous', dtype=np.float32,
+                      cache_dir=RESAMPLING_CACHE):
+    """ Resample 3D images on a target grid into a single 4D image
+
+    The 4D output is allocated once, and each input image is resampled
+    directly into its volume, so that no intermediate image is kept.
+
+    Parameters
+    ----------
+    paths: list of strings or nibabel images,
+           3D images to be resampled
+    target_affine: array of shape (4, 4),
+                   affine of the target grid
+    target_shape: tuple of 3 ints,
+                  shape of the target grid
+    output_file: string or None, optional,
+                 if provided, path of an uncompressed NIfTI file (.nii)
+                 holding the output, that is filled through a memory map;
+                 the output is held in memory otherwise
+    n_jobs: int, optional,
+            number of images resampled concurrently (in threads)
+    interpolation: 'continuous', 'linear' or 'nearest', optional,
+                   see resample_volumes
+    dtype: numpy dtype, optional,
+           data type of the output
+    cache_dir: string or None, optional,
+               disk cache of the interpolation operators
+
+    Returns
+    -------
+    img: nibabel image of shape target_shape + (len(paths),),
+         lazily loaded from output_file if provided
+    """
+    shape = tuple(target_shape[:3]) + (len(paths),)
+    if output_file is None:
+        data = np.empty(shape, dtype=dtype, order='F')
+    else:
+        data = allocate_nifti(output_file, shape, target_affine, dtype)
+
+    def resample(i):
+        resample_volumes(paths[i], target_affine, shape[:3], interpolation,
+                         cache_dir, out=data[..., i])
+
+    if n_jobs == 1:
+        for i in range(len(paths)):
+            resample(i)
+    else:
+        _warm_operators(paths, target_affine, shape[:3], interpolation,
+                        cache_dir)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(resample, range(len(paths))))
+    if output_file is None:
+        return nib.Nifti1Image(data, np.asarray(target_affine))
+    data.flush()
+    del data
+    return nib.load(output_file)
+
+
+def running_means(groups, n_jobs=1, dtype=np.float32,
+                  interpolation='continuous', cache_dir=RESAMPLING_CACHE):
+    """ Average several groups of images in a single pass
+
+    Each image is read once, resampled on the grid of its group with a
+    cached interpolation operator, and added to a running sum; the images
+    are spread across n_jobs threads that keep their own partial sums.
+    As in nilearn.image.mean_img, 4D images are first averaged over time,
+    and each image has the same weight.
+
+    Parameters
+    ----------
+    groups: dict,
+            name -> (paths, target_affine, target_shape). If target_affine
+            is None, the grid of the first image of the group is used
+    n_jobs: int, optional,
+            number of threads
+    dtype: numpy dtype, optional,
+           data type of the accumulators and of the means
+    interpolation: 'continuous', 'linear' or 'nearest', optional,
+                   see resample_volumes
+    cache_dir: string or None, optional,
+               disk cache of the interpolation operators
+
+    Returns
+    -------
+    means: dict,
+           name -> mean image (nibabel image)
+    """
+    grids, tasks = {}, []
+    for name, (paths, target_affine, target_shape) in groups.items():
+        if len(paths) == 0:
+            raise ValueError('No image to average in group %s' % name)
+        if target_affine is None:
+            first = paths[0]
+            if isinstance(first, str):
+                first = nib.load(first)
+            target_affine, target_shape = first.affine, first.shape
+        grids[name] = (np.asarray(target_affine), tuple(target_shape[:3]))
+        tasks += [(name, path) for path in paths]
+    if n_jobs > 1:
+        for name, (paths, _, _) in groups.items():
+            _warm_operators(paths, grids[name][0], grids[name][1],
+                            interpolation, cache_dir)
+
+    def accumulate(tasks_):
+        sums = {}
+        for name, path in tasks_:
+            target_affine, target_shape = grids[name]
+            data = resample_volumes(path, target_affine, target_shape,
+                                    interpolation, cache_dir)
+            if data.ndim > 3:
+                data = data.mean(3)
+            if name in sums:
+                sums[name] += data
+            else:
+                sums[name] = data.astype(dtype)
+        return sums
+
+    n_jobs = max(1, min(n_jobs, len(tasks)))
+    sums = {}
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for sums_ in executor.map(accumulate, [tasks[i::n_jobs]
+                                               for i in range(n_jobs)]):
+            for name, sum_ in sums_.items():
+                if name in sums:
+                    sums[name] += sum_
+                else:
+                    sums[name] = sum_
+    return dict([(name, nib.Nifti1Image(
+        (sums[name] / len(groups[name][0])).astype(dtype, copy=False),
+        grids[name][0]))
+        for name in groups])
+
+
+def mean_images(paths, target_affine=None, target_shape=None, n_jobs=1,
+                dtype=np.float32, interpolation='continuous'):
+    """ Mean of images, resampled on a target grid (the grid of the first
+    image by default), see running_means"""
+    return running_means({'mean': (paths, target_affine, target_shape)},
+                         n_jobs=n_jobs, dtype=dtype,
+                         interpolation=interpolation)['mean']
+
+
+def _resample_file(path, target_affine, target_shape, target,
+                   interpolation, cache_dir):
+    resample_image(path, target_affine, target_shape, interpolation,
+                   cache_dir).to_filename(target)
+    return target
+
+
+def resample_files(paths, reference, targets=None, n_jobs=1,
+                   interpolation='continuous', cache_dir=RESAMPLING_CACHE):
+    """ Resample image files on the grid of a reference image
+
+    The files are resampled in a pool of n_jobs processes. With 'linear'
+    or 'nearest' interpolation, the interpolation operators of the
+    distinct source grids are computed once (in the calling process), and
+    the workers read them from the cache.
+
+    Parameters
+    ----------
+    paths: list of strings,
+           image files to be resampled
+    reference: string or nibabel image,
+               image defining the target grid
+    targets: list of strings or None, optional,
+             output files; the input files are overwritten if None
+    n_jobs: int, optional,
+            number of processes
+    interpolation: 'continuous', 'linear' or 'nearest', optional,
+                   see resample_volumes
+    cache_dir: string or None, optional,
+               disk cache of the interpolation operators; with None, each
+               process computes the operators it needs
+
+    Returns
+    -------
+    targets: list of strings,
+             the files written
+    """
+    if isinstance(reference, str):
+        reference = nib.load(reference)
+    target_affine, target_shape = reference.affine, reference.shape[:3]
+    if targets is None:
+        targets = list(paths)
+    _warm_operators(paths, target_affine, target_shape, interpolation,
+                    cache_dir)
+    args = [(path, target_affine, target_shape, target, interpolation,
+             cache_dir) for path, target in zip(paths, targets)]
+    if n_jobs == 1 or len(args) < 2:
+        return [_resample_file(*arg) for arg in args]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(_resample_file, *zip(*args)))
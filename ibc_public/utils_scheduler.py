@@ -0,0 +1,209 @@
+"""
+A small scheduler for the IBC pipeline: runs a graph of
+(subject, session, pass) tasks in parallel processes, with memory-aware
+admission and a state file that makes interrupted runs resumable.
+"""
+import json
+import os
+import time
+import traceback
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait)
+
+
+def _physical_memory():
+    """ Total physical memory, in MB"""
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') /
+                2. ** 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Task(object):
+    """ A unit of work of the pipeline
+
+    Parameters
+    ----------
+    name: string,
+          unique identifier of the task, e.g. 'glm_sub-01_ses-03_smooth'
+    func: callable,
+          function run by the task; must be importable by the workers
+    args: tuple,
+          positional arguments of func
+    kwargs: dict,
+          keyword arguments of func
+    deps: list of strings,
+          names of the tasks that must be done before this one
+    memory: float,
+          estimated peak memory of the task, in MB
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, deps=(), memory=0):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.memory = memory
+
+
+class Scheduler(object):
+    """ Run a graph of tasks with bounded parallelism and memory
+
+    Tasks are started as soon as their dependencies are done, as long as
+    fewer than n_jobs tasks run and the sum of their estimated memory stays
+    below max_memory (a task is always admitted when nothing runs). The
+    status of each task is saved in state_file after it completes, so that
+    a new run skips the tasks already done; use reset to run tasks again,
+    e.g. after a change of their code or inputs. A failed task does not
+    stop the others, but the tasks depending on it are not run.
+
+    Parameters
+    ----------
+    state_file: string or None,
+                json file recording the completed tasks
+    n_jobs: int,
+            maximal number of tasks running at the same time
+    max_memory: float or None,
+                memory budget in MB; defaults to 80% of the physical memory
+    """
+
+    def __init__(self, state_file=None, n_jobs=1, max_memory=None):
+        self.state_file = state_file
+        self.n_jobs = n_jobs
+        if max_memory is None:
+            physical_memory = _physical_memory()
+            if physical_memory is not None:
+                max_memory = .8 * physical_memory
+        self.max_memory = max_memory
+        self.tasks = {}
+        self._order = []
+        self.state = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as fid:
+                self.state = json.load(fid)
+
+    def add(self, name, func, *args, **kwargs):
+        """ Add a task; `deps` and `memory` keyword arguments are
+        consumed by the scheduler, others are passed to func.
+
+        Returns the name of the task, to be used in the deps of others."""
+        deps = kwargs.pop('deps', ())
+        memory = kwargs.pop('memory', 0)
+        if name in self.tasks:
+            raise ValueError('Task %s already defined' % name)
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('Unknown dependency %s of task %s' %
+                                 (dep, name))
+        self.tasks[name] = Task(name, func, args, kwargs, deps, memory)
+        self._order.append(name)
+        return name
+
+    def is_done(self, name):
+        return self.state.get(name, {}).get('status') == 'done'
+
+    def reset(self, names=None):
+        """ Forget the status of some tasks (all of them by default), so
+        that the next run executes them again
+
+        Parameters
+        ----------
+        names: list of strings or None,
+               names of the tasks to reset; a task is also reset when one
+               of its dependencies is
+        """
+        if names is None:
+            names = list(self.state)
+        reset = set(names)
+        for name in self._order:
+            if any(dep in reset for dep in self.tasks[name].deps):
+                reset.add(name)
+        for name in reset:
+            self.state.pop(name, None)
+        self._save_state()
+
+    def _save_state(self):
+        if self.state_file is None:
+            return
+        tmp_file = '%s.tmp' % self.state_file
+        with open(tmp_file, 'w') as fid:
+            json.dump(self.state, fid, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+    def _set_status(self, name, status, message=None):
+        self.state[name] = {'status': status, 'time': time.ctime()}
+        if message is not None:
+            self.state[name]['message'] = message
+        self._save_state()
+
+    def plan(self):
+        """ Return the names of the tasks that a run would execute"""
+        return [name for name in self._order if not self.is_done(name)]
+
+    def run(self, dry_run=False):
+        """ Run all the tasks that are not done yet
+
+        Parameters
+        ----------
+        dry_run: bool, optional,
+                 if True, only print what would be run
+
+        Returns
+        -------
+        results: dict,
+                 return values of the tasks run, indexed by task name
+        """
+        if dry_run:
+            for name in self._order:
+                task = self.tasks[name]
+                status = 'done' if self.is_done(name) else 'to run'
+                print('%-8s %s (%d MB)%s' % (
+                    status, name, task.memory,
+                    ', after ' + ', '.join(task.deps) if task.deps else ''))
+            return {}
+
+        pending = self.plan()
+        results, running, failed = {}, {}, set()
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            while pending or running:
+                # drop the tasks that depend on failed ones
+                for name in list(pending):
+                    if any(dep in failed for dep in self.tasks[name].deps):
+                        pending.remove(name)
+                        failed.add(name)
+                        print('Skipping %s: a dependency failed' % name)
+                # admit ready tasks within the job and memory budgets
+                used_memory = sum(self.tasks[name].memory
+                                  for name in running.values())
+                for name in list(pending):
+                    task = self.tasks[name]
+                    if len(running) >= self.n_jobs:
+                        break
+                    if not all(self.is_done(dep) for dep in task.deps):
+                        continue
+                    if (running and self.max_memory is not None and
+                            used_memory + task.memory > self.max_memory):
+                        continue
+                    future = executor.submit(task.func, *task.args,
+                                             **task.kwargs)
+                    running[future] = name
+                    used_memory += task.memory
+                    pending.remove(name)
+                    print('Started %s' % name)
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                        self._set_status(name, 'done')
+                        print('Done %s' % name)
+                    except Exception:
+                        message = traceback.format_exc()
+                        self._set_status(name, 'failed', message)
+                        failed.add(name)
+                        print('Failed %s\n%s' % (name, message))
+        return results
@@ -0,0 +1,466 @@
+"""
+On-disk stores of masked data, shared across analyses.
+"""
+import fcntl
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+from ibc_public.utils_io import _stat_hash
+
+MASKED_MAPS = os.path.join(os.path.expanduser('~'), '.cache', 'ibc_public',
+                           'masked_maps')
+
+
+def _mask_hash(mask, affine):
+    """ Identifier of a mask: hash of its voxels and affine"""
+    sha1 = hashlib.sha1(np.packbits(mask).tobytes())
+    sha1.update(np.asarray(affine, dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+def _axis_smoothing_operator(mask, axis, sigma):
+    """ Sparse 1D Gaussian smoothing along one axis, restricted to the mask
+
+    Rows are normalized to one, so that voxels at the border of the mask
+    are averaged over their in-mask neighbours only."""
+    n_voxels = mask.sum()
+    index = - np.ones(mask.shape, dtype=np.int64)
+    index[mask] = np.arange(n_voxels)
+    coords = np.array(np.where(mask)).T
+    radius = int(4. * sigma + .5)  # same truncation as scipy.ndimage
+    rows, cols, vals = [], [], []
+    for offset in range(- radius, radius + 1):
+        neighbours = coords.copy()
+        neighbours[:, axis] += offset
+        valid = ((neighbours[:, axis] >= 0) &
+                 (neighbours[:, axis] < mask.shape[axis]))
+        col = - np.ones(n_voxels, dtype=np.int64)
+        col[valid] = index[tuple(neighbours[valid].T)]
+        valid = col >= 0
+        rows.append(np.where(valid)[0])
+        cols.append(col[valid])
+        vals.append(np.exp(- .5 * (offset / sigma) ** 2) *
+                    np.ones(valid.sum(), dtype=np.float32))
+    operator = sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_voxels, n_voxels))
+    norm = np.asarray(operator.sum(1)).ravel()
+    return sparse.diags(1. / norm).dot(operator).tocsr().astype(np.float32)
+
+
+class SessionTimeseriesStore(object):
+    """ Masked float32 timeseries of fMRI runs, stored once on disk
+
+    Each run is masked the first time it is requested and stored as a
+    (n_scans, n_voxels) .npy matrix, keyed by the run file version and the
+    mask. Runs that are not sampled like the mask are first resampled on
+    its grid, as NiftiMasker does. Later requests, e.g. the compcorr
+    confounds and the unsmoothed GLM pass of glm_only.py, memory-map that
+    matrix instead of reloading the 4D image. Smoothed timeseries are
+    stored separately, one matrix per fwhm: the volumes are smoothed before
+    masking, as in FirstLevelModel(smoothing_fwhm=fwhm). Nothing is
+    evicted automatically: use `utils_io.purge_cache` on store_dir to bound
+    its size.
+
+    Parameters
+    ----------
+    mask_img: Nifti1Image or string,
+              the mask defining the stored voxels,
+              e.g. ibc_data/gm_mask_1_5mm.nii.gz
+    store_dir: string,
+               directory where the masked timeseries are written
+    block_size: int, optional,
+                number of volumes read at once when masking a run
+    masked_smoothing: bool, optional,
+                      if True, smoothing is applied on the stored unsmoothed
+                      timeseries with sparse operators restricted to the
+                      mask. This avoids storing smoothed timeseries, but
+                      differs from smoothing the volumes: each voxel is
+                      averaged over its in-mask neighbours only, which
+                      matters for thin masks such as grey matter
+    """
+
+    def __init__(self, mask_img, store_dir, block_size=32,
+                 masked_smoothing=False):
+        if isinstance(mask_img, str):
+            mask_img = nib.load(mask_img)
+        self.mask_img = mask_img
+        self.mask = np.asarray(mask_img.dataobj).astype(bool)
+        self.affine = mask_img.affine
+        self.store_dir = store_dir
+        self.block_size = block_size
+        self.masked_smoothing = masked_smoothing
+        self._mask_key = _mask_hash(self.mask, self.affine)[:16]
+        self._smoothing_operators = {}
+
+    @property
+    def n_voxels(self):
+        return int(self.mask.sum())
+
+    def _path(self, fmri_path, fwhm=None):
+        """ Path of the stored timeseries of a run"""
+        basename = os.path.basename(fmri_path).split('.')[0]
+        if fwhm:
+            basename = '%s_fwhm%g' % (basename, fwhm)
+        return os.path.join(self.store_dir, '%s_%s_%s.npy' % (
+            _stat_hash(fmri_path)[:16], self._mask_key, basename))
+
+    def timeseries(self, fmri_path, fwhm=None):
+        """ Return the masked timeseries of a run, masking it if needed
+
+        Parameters
+        ----------
+        fmri_path: string,
+                   path of the 4D image of the run
+        fwhm: float or None, optional,
+              if given, the volumes are smoothed (in mm) before masking
+
+        Returns
+        -------
+        data: memory-mapped array of shape (n_scans, n_voxels), float32
+        """
+        path = self._path(fmri_path, fwhm)
+        if not os.path.exists(path):
+            if not os.path.exists(self.store_dir):
+                os.makedirs(self.store_dir, exist_ok=True)
+            img = nib.load(fmri_path, keep_file_open=True)
+            n_scans = img.shape[3]
+            if img.shape[:3] == self.mask.shape and \
+                    np.allclose(img.affine, self.affine):
+                volumes = img.dataobj
+            else:
+                from ibc_public.utils_resample import resample_volumes
+                volumes = resample_volumes(img, self.affine, self.mask.shape)
+            tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+            data = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32,
+                shape=(n_scans, self.n_voxels))
+            for start in range(0, n_scans, self.block_size):
+                stop = min(start + self.block_size, n_scans)
+                block = np.asarray(volumes[..., start:stop])
+                if fwhm:
+                    from nilearn.image import smooth_img
+                    block = np.asarray(smooth_img(
+                        nib.Nifti1Image(block, self.affine), fwhm).dataobj)
+                data[start:stop] = block[self.mask].T
+            data.flush()
+            del data
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def smoothing_operators(self, fwhm):
+        """ Sparse separable smoothing operators for a given fwhm (in mm)"""
+        if fwhm not in self._smoothing_operators:
+            voxel_size = np.sqrt(np.sum(self.affine[:3, :3] ** 2, 0))
+            sigmas = fwhm / np.sqrt(8 * np.log(2)) / voxel_size
+            self._smoothing_operators[fwhm] = [
+                _axis_smoothing_operator(self.mask, axis, sigma)
+                for axis, sigma in enumerate(sigmas)]
+        return self._smoothing_operators[fwhm]
+
+    def smoothed_timeseries(self, fmri_path, fwhm=None):
+        """ Return the masked timeseries of a run, optionally smoothed
+
+        Smoothing is applied on the volumes before masking, unless the
+        store was created with masked_smoothing=True.
+
+        Returns
+        -------
+        data: array of shape (n_scans, n_voxels), float32
+        """
+        if not fwhm:
+            return self.timeseries(fmri_path)
+        if not self.masked_smoothing:
+            return self.timeseries(fmri_path, fwhm)
+        data = self.timeseries(fmri_path)
+        data = np.array(data.T)
+        for operator in self.smoothing_operators(fwhm):
+            data = operator.dot(data)
+        return np.ascontiguousarray(data.T)
+
+    def unmask(self, data):
+        """ Bring masked data (1D or 2D) back to a Nifti image"""
+        data = np.asarray(data)
+        vol = np.zeros(self.mask.shape + data.shape[:-1], dtype=data.dtype)
+        vol[self.mask] = data.T
+        return nib.Nifti1Image(vol, self.affine)
+
+
+class MaskedMapStore(object):
+    """ Masked float32 maps (e.g. stat_maps/*.nii.gz), stored once on disk
+
+    Drop-in replacement of a fitted NiftiMasker(mask_img=mask_img) for 3D
+    maps given as paths: each map is decompressed and masked the first time
+    it is requested, and its masked values are appended as one row of a
+    memory-mapped (n_maps, n_voxels) matrix shared by all the analyses using
+    the same mask. Rows are indexed by the map file version (path, size and
+    mtime), so that a rewritten map is masked again; the rows of its former
+    versions are only dropped by `purge`.
+
+    Parameters
+    ----------
+    mask_img: Nifti1Image or string,
+              the mask defining the stored voxels,
+              e.g. ibc_data/gm_mask_1_5mm.nii.gz
+    store_dir: string, optional,
+               directory of the stores, one subdirectory per mask
+    n_jobs: int, optional,
+            number of maps masked concurrently (in threads)
+    """
+
+    def __init__(self, mask_img, store_dir=MASKED_MAPS, n_jobs=4):
+        if isinstance(mask_img, str):
+            mask_img = nib.load(mask_img)
+        self.mask = np.asarray(mask_img.dataobj).astype(bool)
+        self.affine = mask_img.affine
+        self.mask_img_ = nib.Nifti1Image(self.mask.astype(np.uint8),
+                                         self.affine)
+        self.store_dir = os.path.join(
+            store_dir, _mask_hash(self.mask, self.affine)[:16])
+        self.n_jobs = n_jobs
+        self._data_path = os.path.join(self.store_dir, 'rows.f32')
+        self._index_path = os.path.join(self.store_dir, 'index.json')
+
+    @property
+    def n_voxels(self):
+        return int(self.mask.sum())
+
+    def fit(self, *args, **kwargs):
+        """ Nothing to fit, for compatibility with NiftiMasker"""
+        return self
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path):
+            return {}
+        with open(self._index_path) as fid:
+            return json.load(fid)
+
+    def _mask_map(self, img):
+        """ Masked values of a 3D map, resampled on the mask if needed"""
+        if isinstance(img, str):
+            img = nib.load(img)
+        if img.shape[:3] == self.mask.shape and \
+                np.allclose(img.affine, self.affine):
+            data = np.asarray(img.dataobj)
+        else:
+            from ibc_public.utils_resample import resample_volumes
+            data = resample_volumes(img, self.affine, self.mask.shape)
+        data = data.reshape(self.mask.shape)
+        return data[self.mask].astype(np.float32)
+
+    def _add(self, paths):
+        """ Mask maps and append them to the store, in one locked write"""
+        with ThreadPoolExecutor(max_workers=max(1, self.n_jobs)) as executor:
+            rows = list(executor.map(self._mask_map, paths))
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(os.path.join(self.store_dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            with open(self._data_path, 'ab') as fid:
+                n_rows = fid.tell() // (4 * self.n_voxels)
+                for path, row in zip(paths, rows):
+                    key = _stat_hash(path)
+                    if key in index:
+                        # stored meanwhile by another process
+                        continue
+                    fid.write(row.tobytes())
+                    index[key] = n_rows
+                    n_rows += 1
+            tmp_path = '%s.%d.tmp' % (self._index_path, os.getpid())
+            with open(tmp_path, 'w') as fid:
+                json.dump(index, fid)
+            os.replace(tmp_path, self._index_path)
+        return index
+
+    def rows(self):
+        """ All the stored rows, as a read-only memory map"""
+        n_rows = os.path.getsize(self._data_path) // (4 * self.n_voxels)
+        return np.memmap(self._data_path, dtype=np.float32, mode='r',
+                         shape=(n_rows, self.n_voxels))
+
+    def purge(self, paths):
+        """ Compact the store, keeping only the rows of the current version
+        of some maps
+
+        Rows of maps that were rewritten or deleted since they were stored
+        are never read again, but stay in the store until it is purged.
+        Must not run while other processes use the store.
+
+        Parameters
+        ----------
+        paths: list of strings,
+               maps whose rows are kept, e.g. all the maps still analysed
+
+        Returns
+        -------
+        n_removed: int,
+                   number of rows removed
+        """
+        if not os.path.exists(self._index_path):
+            return 0
+        with open(os.path.join(self.store_dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            keep = set(_stat_hash(path) for path in paths
+                       if os.path.exists(path))
+            kept = sorted((row, key) for key, row in index.items()
+                          if key in keep)
+            if len(kept) == len(index):
+                return 0
+            rows = self.rows()
+            new_index = {}
+            tmp_data_path = '%s.%d.tmp' % (self._data_path, os.getpid())
+            with open(tmp_data_path, 'wb') as fid:
+                for new_row, (row, key) in enumerate(kept):
+                    fid.write(np.asarray(rows[row]).tobytes())
+                    new_index[key] = new_row
+            del rows
+            tmp_path = '%s.%d.tmp' % (self._index_path, os.getpid())
+            with open(tmp_path, 'w') as fid:
+                json.dump(new_index, fid)
+            os.replace(tmp_data_path, self._data_path)
+            os.replace(tmp_path, self._index_path)
+        return len(index) - len(kept)
+
+    def transform(self, imgs):
+        """ Return the masked maps, masking those not stored yet
+
+        Parameters
+        ----------
+        imgs: string, nibabel image or list of them,
+              3D maps; only maps given as paths are stored
+
+        Returns
+        -------
+        X: array of shape (n_maps, n_voxels), float32
+        """
+        if isinstance(imgs, (str, nib.spatialimages.SpatialImage)):
+            imgs = [imgs]
+        imgs = list(imgs)
+        keys = [_stat_hash(img) if isinstance(img, str) else None
+                for img in imgs]
+        index = self._read_index()
+        missing = sorted(set(
+            img for img, key in zip(imgs, keys)
+            if key is not None and key not in index))
+        if missing:
+            index = self._add(missing)
+        X = np.empty((len(imgs), self.n_voxels), dtype=np.float32)
+        stored = [i for i, key in enumerate(keys) if key is not None]
+        if stored:
+            X[stored] = self.rows()[[index[keys[i]] for i in stored]]
+        for i, key in enumerate(keys):
+            if key is None:
+                X[i] = self._mask_map(imgs[i])
+        return X
+
+    def fit_transform(self, imgs, *args, **kwargs):
+        return self.transform(imgs)
+
+    def inverse_transform(self, X):
+        """ Bring masked data (1D or 2D) back to a Nifti image"""
+        X = np.asarray(X)
+        vol = np.zeros(self.mask.shape + X.shape[:-1], dtype=X.dtype)
+        vol[self.mask] = X.T
+        return nib.Nifti1Image(vol, self.affine)
+
+
+class ParcelDataStore(object):
+    """ Masked maps of several subjects, laid out parcel by parcel
+
+    All the maps are masked once (through a MaskedMapStore) into a
+    (n_subjects, n_maps, n_voxels) float32 array, whose voxels are sorted by
+    parcel, so that the data of one parcel is a slice of the last axis of
+    the array rather than a new masking of all the maps. That slice is a
+    strided view: each of its (subject, map) rows is contiguous, but rows
+    are n_voxels apart.
+
+    Parameters
+    ----------
+    labels_img: Nifti1Image or string,
+                parcellation of the brain, 0 being the background,
+                e.g. the labels_img_ of a fitted nilearn Parcellations
+    paths: array-like of shape (n_subjects, n_maps),
+           the 3D maps of each subject, in the same order for all subjects
+    data_file: string, optional,
+               .npy file holding the array; when given, the array is a
+               read-only memory map, shared by reference (not copied) with
+               the processes of joblib.Parallel
+    store_dir: string, optional,
+               directory of the MaskedMapStore
+    n_jobs: int, optional,
+            number of maps masked concurrently (in threads)
+    block_size: int, optional,
+                number of maps masked and copied into the array at a time,
+                which bounds the memory used beyond the array itself
+
+    Attributes
+    ----------
+    data: array of shape (n_subjects, n_maps, n_voxels)
+    parcels: array of shape (n_parcels,),
+             the labels of the parcels, in the order of the voxels of data
+    """
+
+    def __init__(self, labels_img, paths, data_file=None,
+                 store_dir=MASKED_MAPS, n_jobs=4, block_size=64):
+        if isinstance(labels_img, str):
+            labels_img = nib.load(labels_img)
+        labels = np.round(np.asarray(labels_img.dataobj)).astype(np.int64)
+        self.mask = labels > 0
+        self.affine = labels_img.affine
+        voxel_labels = labels[self.mask]
+        self._order = np.argsort(voxel_labels, kind='stable')
+        self.parcels, starts, counts = np.unique(
+            voxel_labels[self._order], return_index=True, return_counts=True)
+        self._slices = dict((parcel, slice(start, start + count))
+                            for parcel, start, count in
+                            zip(self.parcels, starts, counts))
+
+        paths = np.asarray(paths)
+        shape = paths.shape + (self._order.size,)
+        if data_file is None:
+            data = np.empty(shape, dtype=np.float32)
+        else:
+            data = np.lib.format.open_memmap(
+                data_file, mode='w+', dtype=np.float32, shape=shape)
+        masker = MaskedMapStore(
+            nib.Nifti1Image(self.mask.astype(np.uint8), self.affine),
+            store_dir=store_dir, n_jobs=n_jobs)
+        flat_data = data.reshape(-1, shape[-1])
+        flat_paths = list(paths.ravel())
+        for start in range(0, len(flat_paths), block_size):
+            block = masker.transform(flat_paths[start: start + block_size])
+            flat_data[start: start + len(block)] = block[:, self._order]
+        if data_file is not None:
+            data.flush()
+            del flat_data, data
+            data = np.load(data_file, mmap_mode='r')
+        self.data = data
+
+    def n_voxels(self, parcel):
+        """ Number of voxels of a parcel"""
+        return self._slices[parcel].stop - self._slices[parcel].start
+
+    def parcel(self, parcel):
+        """ Data of one parcel, of shape (n_subjects, n_maps, n_voxels)
+
+        This is a view of data, not a copy."""
+        return self.data[..., self._slices[parcel]]
+
+    def inverse_transform(self, values):
+        """ Bring values of shape (..., n_voxels) back to a Nifti image
+
+        values follow the voxel order of data, e.g. the concatenation of
+        per-parcel values in the order of parcels."""
+        values = np.asarray(values)
+        unsorted = np.empty_like(values)
+        unsorted[..., self._order] = values
+        vol = np.zeros(self.mask.shape + values.shape[:-1],
+                       dtype=values.dtype)
+        vol[self.mask] = np.moveaxis(unsorted, -1, 0)
+        return nib.Nifti1Image(vol, self.affine)
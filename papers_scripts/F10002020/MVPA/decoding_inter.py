@@ -9,7 +9,6 @@ import matplotlib.pyplot as plt
 from joblib import Parallel, delayed
 
 from nilearn.input_data import NiftiMasker
-from nistats.first_level_model import FirstLevelModel
 from sklearn.feature_selection import SelectPercentile, f_classif
 from sklearn.metrics import plot_confusion_matrix
 from sklearn.model_selection import LeavePGroupsOut, LeaveOneGroupOut, \
@@ -19,7 +18,7 @@ from sklearn.svm import LinearSVC
 
 import ibc_public.utils_data
 from ibc_public.utils_data import get_subject_session
-from utils_tonotopy import make_dmtx, make_dmtxs, parse_z
+from utils_tonotopy import make_dmtx, parse_z, single_trial_glm
 
 # IBC package path
 ibc = '/storage/store/data/ibc'
@@ -72,36 +71,40 @@ def mask_data(masker, file):
     return masked_file
 
 
-def _fit_glms(fmri, run, trial, dmtx, conds, sub_dir, model, save=False, mumford=False):
-    if mumford:
-        conditions = conds
-    else:
-        conditions = [condition + "_00" for condition in conds]
-
-    column = dmtx.columns.intersection(conditions)
-    assert len(column) == 1
-    label = column[0].strip('_00')
-    full_trial = "{}_{}".format(label, trial)
-    filename = os.path.join(sub_dir, "{}_{}.nii.gz".format(run, full_trial))
+def _single_trial_maps(fmri, run, events, confounds, conds, sub_dir, mask,
+                       t_r, save=False, mumford=False, noise_model='ar1'):
+    """Single-trial z-maps of a run, masked, with their filenames
 
-    if os.path.exists(filename):
-        print("Image {} already computed! Skipping...".format(filename))
-        image = []
-
-    else:
-        model.fit(fmri, design_matrices=[dmtx])
+    noise_model='ar1' reproduces the former per-trial FirstLevelModel fits;
+    'ols' solves all the trials at once, much faster but without the AR(1)
+    prewhitening"""
+    bad_trials = ['silence', 'catch', 'fixation']
+    trial_names, z_maps = single_trial_glm(fmri, events, mask, confounds,
+                                           t_r=t_r, method='lss',
+                                           mumford=mumford, smoothing_fwhm=5,
+                                           noise_model=noise_model)
+    labels = [name.split('_')[0] for name in trial_names]
+    keep = [i for i, label in enumerate(labels)
+            if label not in bad_trials and label in conds]
 
-        image = model.compute_contrast(dmtx.columns == column[0])
-
-        if save:
-            image.to_filename(filename)
+    masker = NiftiMasker(mask_img=mask).fit()
+    images = []
+    filenames = []
+    for j, i in enumerate(keep):
+        full_trial = "{}_{}".format(labels[i], j)
+        filename = os.path.join(sub_dir, "{}_{}.nii.gz".format(run, full_trial))
+        images.append(z_maps[i][np.newaxis])
+        filenames.append(filename)
+        if save and not os.path.exists(filename):
+            masker.inverse_transform(z_maps[i]).to_filename(filename)
             print("Saved {}".format(filename))
 
-    return image, filename
+    return images, filenames
 
 
 def get_images_inter(session_list, conditions, data_dir, write_dir,
-                     mask, t_r, use_3mm=False, save=True, glm_mode='z_maps'):
+                     mask, t_r, use_3mm=False, save=True, glm_mode='z_maps',
+                     noise_model='ar1'):
     """
     Run first level model for one subject and return images and filenames.
 
@@ -138,6 +141,9 @@ def get_images_inter(session_list, conditions, data_dir, write_dir,
               averaged trials for every condition, while 'glms' will create
               one design matrix for every trial, and fit hte model separately.
 
+    noise_model: str, ['ar1', 'ols'], default: 'ar1'
+                 temporal noise model of the single-trial GLMs of 'glms'
+
     Returns
     -------
 
@@ -155,18 +161,6 @@ def get_images_inter(session_list, conditions, data_dir, write_dir,
 
     elif glm_mode == 'glms':
 
-        try:
-            model = FirstLevelModel(mask_img=mask,
-                                    smoothing_fwhm=5,
-                                    t_r=t_r, high_pass=.01)
-        except:
-            print("There was an error generating a model with high-pass filter "
-                  ", generating alternative model...")
-
-            model = FirstLevelModel(mask_img=mask,
-                                    smoothing_fwhm=5,
-                                    t_r=t_r, period_cut=128, )
-
         images = []
         names = []
 
@@ -210,25 +204,11 @@ def get_images_inter(session_list, conditions, data_dir, write_dir,
                 # Get run number from filename
                 run = os.path.basename(fmri).strip('.nii.gz').split('_')[-2][-2:]
 
-                dmtx_list, _ = make_dmtxs(events, fmri, confounds, mumford=False)
-
-                bad_trials = ['silence_00', 'catch_00', 'fixation_00']
-                dmtx_list = [dmtx for dmtx in dmtx_list if not any(bad_trial in dmtx.columns
-                                                                   for bad_trial in bad_trials)]
-
-                this_images = []
-                this_filenames = []
+                # all the trials of the run are fitted at once
                 print("Starting fit for subject {}, run {}".format(subject, run))
-                for j, dmtx in enumerate(dmtx_list):
-                    image, filename = _fit_glms(fmri, run, j, dmtx, conditions,
-                                                sub_dir, model, mumford=False, save=save)
-
-                    if not image:
-                        this_images.extend(image)
-                    else:
-                        this_images.append(image)
-
-                    this_filenames.append(filename)
+                this_images, this_filenames = _single_trial_maps(
+                    fmri, run, events, confounds, conditions, sub_dir, mask,
+                    t_r, save=save, mumford=False, noise_model=noise_model)
 
                 images.extend(this_images)
                 names.extend(this_filenames)
@@ -336,8 +316,8 @@ def decode_inter(imgs, names, mask, pipeline, conf_matrix=False):
     masker = NiftiMasker(mask_img=mask).fit()
 
     if imgs:
-        fmri_masked = Parallel(n_jobs=15, verbose=True)(delayed(mask_data)(masker, img)
-                                                        for img in imgs)
+        # single-trial maps are already masked
+        fmri_masked = imgs
     else:
         fmri_masked = Parallel(n_jobs=15, verbose=True)(delayed(mask_data)(masker, filename)
                                                         for filename in names)
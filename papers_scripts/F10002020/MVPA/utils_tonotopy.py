@@ -180,6 +180,21 @@ def sort_by_chunk(string: str, chunk_n: int = -2, sep: str = '_') -> str:
     return string.split(sep)[chunk_n]
 
 
+def _frame_times(n_scans, t_r=2, task='audio'):
+    """Acquisition times of the scans of a run"""
+    frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
+    if task == 'audio':
+        mask = np.array([1, 0, 1, 1, 0, 1, 1, 0, 1, 1])
+        n_cycles = 28
+        cycle_duration = 20
+        t_r = 2
+        cycle = np.arange(0, cycle_duration, t_r)[mask > 0]
+        frame_times = np.tile(cycle, n_cycles) +\
+            np.repeat(np.arange(n_cycles) * cycle_duration, mask.sum())
+        frame_times = frame_times[:-2]  # for some reason...
+    return frame_times
+
+
 def make_dmtxs(events, fmri, confounds=None,
                t_r=2, mumford=True, task='audio'):
     """
@@ -228,17 +243,7 @@ def make_dmtxs(events, fmri, confounds=None,
     n_scans = nib.load(fmri).shape[3]
     
     # define the time stamps for different images
-    frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
-    
-    if task == 'audio':
-        mask = np.array([1, 0, 1, 1, 0, 1, 1, 0, 1, 1])
-        n_cycles = 28
-        cycle_duration = 20
-        t_r = 2
-        cycle = np.arange(0, cycle_duration, t_r)[mask > 0]
-        frame_times = np.tile(cycle, n_cycles) +\
-            np.repeat(np.arange(n_cycles) * cycle_duration, mask.sum())
-        frame_times = frame_times[:-2]  # for some reason...
+    frame_times = _frame_times(n_scans, t_r, task)
 
     paradigm = read_csv(events, sep='\t')
     split_trials = [condition.split('_')[0] for condition in paradigm['trial_type']]
@@ -322,16 +327,7 @@ def make_dmtx(events, fmri, mask_img, confounds=None,
     n_scans = nib.load(fmri).shape[3]
 
     # define the time stamps for different images
-    frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
-    if task == 'audio':
-        mask = np.array([1, 0, 1, 1, 0, 1, 1, 0, 1, 1])
-        n_cycles = 28
-        cycle_duration = 20
-        t_r = 2
-        cycle = np.arange(0, cycle_duration, t_r)[mask > 0]
-        frame_times = np.tile(cycle, n_cycles) +\
-            np.repeat(np.arange(n_cycles) * cycle_duration, mask.sum())
-        frame_times = frame_times[:-2]  # for some reason...
+    frame_times = _frame_times(n_scans, t_r, task)
 
     paradigm = read_csv(events, sep='\t')
 
@@ -363,3 +359,211 @@ def make_dmtx(events, fmri, mask_img, confounds=None,
                                           add_regs=conf,
                                           add_reg_names=motion)
     return dmtx
+
+
+def _trial_designs(categories, method='lss', mumford=False):
+    """
+    Express the single-trial designs as combinations of the trial regressors
+
+    Returns a list of (weights, contrast, trials) tuples, one per model:
+    the columns of the events part of the design are trial_regressors @
+    weights, and the beta of trial trials[j] is estimated by contrast[j]
+    """
+    n_trials = len(categories)
+    if method == 'lsa':
+        return [(np.eye(n_trials), np.eye(n_trials), np.arange(n_trials))]
+    elif method != 'lss':
+        raise ValueError("Invalid method! It must be 'lss' or 'lsa', "
+                         "it was: {}".format(method))
+
+    categories = np.asarray(categories)
+    unique_categories = sorted(set(categories))
+    designs = []
+    for i in range(n_trials):
+        others = np.arange(n_trials) != i
+        if mumford:
+            groups = [others]
+        else:
+            groups = [others & (categories == category)
+                      for category in unique_categories]
+        # drop empty regressors, as make_first_level_design_matrix does
+        weights = [np.arange(n_trials) == i] + \
+            [group for group in groups if group.any()]
+        weights = np.array(weights, dtype=np.float64).T
+        contrast = np.zeros((1, weights.shape[1]))
+        contrast[0, 0] = 1
+        designs.append((weights, contrast, np.array([i])))
+    return designs
+
+
+def _t_to_z(t_values, dof):
+    """z-scores with the same p-values as t statistics"""
+    from scipy import stats
+    p_values = stats.t.sf(t_values, dof)
+    one_minus_p_values = stats.t.cdf(t_values, dof)
+    return np.where(p_values < .5, stats.norm.isf(p_values),
+                    - stats.norm.isf(one_minus_p_values))
+
+
+def _ar1_trial_maps(data, trials, nuisance, designs, output_type):
+    """Single-trial statistics of AR(1) models, fitted one design at a time
+    as FirstLevelModel(noise_model='ar1') does"""
+    from nistats.contrasts import compute_contrast
+    from nistats.first_level_model import run_glm
+
+    maps = np.zeros((trials.shape[1], data.shape[1]))
+    for weights, contrast, trial_index in designs:
+        design = np.hstack((trials.dot(weights), nuisance))
+        labels, results = run_glm(data, design, noise_model='ar1')
+        for con_val, trial in zip(contrast, trial_index):
+            con_val = np.concatenate((con_val, np.zeros(nuisance.shape[1])))
+            estimate = compute_contrast(labels, results, con_val)
+            maps[trial] = np.ravel(getattr(estimate, output_type)())
+    return maps
+
+
+def single_trial_glm(fmri, events, mask_img, confounds=None, t_r=2,
+                     task='audio', method='lss', mumford=False,
+                     smoothing_fwhm=5, signal_scaling=True,
+                     output_type='z_score', noise_model='ar1'):
+    """
+    Estimate single-trial effects of a run, loading and masking it once
+
+    The HRF-convolved regressor of each trial is computed once, and the
+    design of each single-trial model is built from these regressors. With
+    noise_model='ols', all the models are solved together: the nuisance
+    regressors (confounds, drifts and constant) are projected out of the
+    data and of the trial regressors, after which every model only involves
+    small Gram matrices of the trial regressors. This gives the same
+    estimates as fitting one ordinary least squares model per design of
+    make_dmtxs. With noise_model='ar1', each model is fitted with the AR(1)
+    prewhitening of FirstLevelModel, whose coefficients depend on the
+    residuals of each design: this is slower, but reproduces the former
+    per-trial FirstLevelModel fits.
+
+    Parameters
+    ----------
+
+    fmri: 4D nifti file
+          neuroimaging data
+
+    events: tsv file
+            contains information about the onset, duration and condition
+            of the images
+
+    mask_img: nifti-like object
+              mask of the voxels to be modeled
+
+    confounds: txt file, default=None
+               file with information about the confounds
+
+    t_r: int, default=2
+         repetition time of the acquisition in seconds
+
+    method: str, ['lss', 'lsa'], default='lss'
+            'lss' (least squares separate) fits one model per trial, with
+            the trial of interest and the other trials grouped as in
+            make_dmtxs; 'lsa' (least squares all) fits a single model with
+            one regressor per trial
+
+    mumford: bool, default False
+             grouping of the other trials for 'lss', see make_dmtxs
+
+    smoothing_fwhm: float or None, default=5
+                    smoothing of the data, in mm
+
+    signal_scaling: bool, default=True
+                    If True, the data are expressed in percent of their
+                    mean, as in FirstLevelModel
+
+    output_type: str, ['z_score', 'stat', 'effect_size'], default='z_score'
+                 statistic returned for each trial
+
+    noise_model: str, ['ar1', 'ols'], default='ar1'
+                 temporal noise model, as in FirstLevelModel
+
+    Returns
+    -------
+
+    trial_names: list of str
+                 Original names of the trials
+
+    maps: np.array of shape (n_trials, n_voxels)
+          single-trial statistics in the mask
+    """
+    from nilearn.masking import apply_mask
+
+    if output_type not in ['z_score', 'stat', 'effect_size']:
+        raise ValueError("Invalid output_type! It must be 'z_score', "
+                         "'stat' or 'effect_size', it was: {}"
+                         .format(output_type))
+    if noise_model not in ['ar1', 'ols']:
+        raise ValueError("Invalid noise_model! It must be 'ar1' or 'ols', "
+                         "it was: {}".format(noise_model))
+
+    data = apply_mask(fmri, mask_img, smoothing_fwhm=smoothing_fwhm)
+    data = data.astype(np.float64)
+    n_scans = data.shape[0]
+    if signal_scaling:
+        mean = data.mean(0)
+        mean[mean == 0] = 1
+        data = 100 * (data / mean - 1)
+
+    paradigm = read_csv(events, sep='\t')
+    trial_names = list(paradigm['trial_type'])
+    categories = [condition.split('_')[0] for condition in trial_names]
+    n_trials = len(trial_names)
+
+    if confounds:
+        motion = ['tx', 'ty', 'tz', 'rx', 'ry', 'rz']
+        conf = np.loadtxt(confounds)
+    else:
+        motion, conf = None, None
+
+    # one regressor per trial, plus the nuisance regressors
+    trial_columns = ['trial_%05d' % i for i in range(n_trials)]
+    paradigm['trial_type'] = trial_columns
+    dmtx = make_first_level_design_matrix(_frame_times(n_scans, t_r, task),
+                                          events=paradigm,
+                                          hrf_model='spm',
+                                          add_regs=conf,
+                                          add_reg_names=motion)
+    trials = dmtx[trial_columns].values
+    nuisance = dmtx.drop(columns=trial_columns).values
+    designs = _trial_designs(categories, method, mumford)
+    if noise_model == 'ar1':
+        return trial_names, _ar1_trial_maps(data, trials, nuisance, designs,
+                                            output_type)
+
+    # project the nuisance regressors out of the data and of the trials
+    nuisance_pinv = np.linalg.pinv(nuisance)
+    data -= nuisance.dot(nuisance_pinv.dot(data))
+    trials = trials - nuisance.dot(nuisance_pinv.dot(trials))
+    nuisance_rank = np.linalg.matrix_rank(nuisance)
+
+    gram = trials.T.dot(trials)
+    projections = trials.T.dot(data)
+    sum_squares = np.sum(data ** 2, 0)
+    del data
+
+    maps = np.zeros((n_trials, projections.shape[1]))
+    for weights, contrast, trial_index in designs:
+        design_gram = weights.T.dot(gram).dot(weights)
+        design_projections = weights.T.dot(projections)
+        inv_gram = np.linalg.pinv(design_gram)
+        betas = inv_gram.dot(design_projections)
+        effects = contrast.dot(betas)
+        if output_type == 'effect_size':
+            maps[trial_index] = effects
+            continue
+        dof = n_scans - nuisance_rank - np.linalg.matrix_rank(design_gram)
+        residual_variance = np.maximum(
+            sum_squares - np.sum(betas * design_projections, 0), 0) / dof
+        variances = np.diag(contrast.dot(inv_gram).dot(contrast.T))
+        stats = effects / np.sqrt(np.maximum(
+            variances[:, np.newaxis] * residual_variance, 1e-300))
+        if output_type == 'z_score':
+            stats = _t_to_z(stats, dof)
+        maps[trial_index] = stats
+
+    return trial_names, maps
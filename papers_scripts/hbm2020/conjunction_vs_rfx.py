@@ -11,78 +11,132 @@ Compatibility: Python 3.5
 """
 
 import os
-import pandas as pd
+from functools import partial
 import numpy as np
 from joblib import Memory, Parallel, delayed
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from nilearn import plotting
 import matplotlib.pyplot as plt
 import ibc_public
 from ibc_public.utils_data import (
-    data_parser, SMOOTH_DERIVATIVES, DERIVATIVES, SUBJECTS, CONTRASTS)
-from nistats.thresholding import map_threshold
-from nistats.second_level_model import SecondLevelModel
-from sklearn.metrics import jaccard_similarity_score
+    data_parser, SMOOTH_DERIVATIVES, DERIVATIVES, SUBJECTS, CONTRASTS,
+    CATALOG)
 
 
-def one_sample_test(imgs, glm, threshold=3.1, height_control='none'):
-    """ Do a one sample t-test of the contrast images in dataframe
+def _t_to_z(t, dof):
+    """ z-values with the same p-values as t-values with dof degrees of
+    freedom, clipped as in nistats"""
+    from scipy.stats import norm, t as t_distribution
+    p_values = np.clip(t_distribution.sf(t, dof), 1.e-300, 1. - 1.e-16)
+    return norm.isf(p_values)
+
+
+def one_sample_z(Z):
+    """ z-transformed one-sample t-test of each set of maps
+
+    Same statistic as a SecondLevelModel with an intercept-only design.
 
     Parameters
     ----------
-    imgs: list of strings,
-          input images
-    glm: nistats.SecondLevelModel instance
-         the model used for analysis (with preset mask)
-
-    verbose: bool, optional,
-             verbosity mode
+    Z: array of shape (n_tests, n_samples, n_voxels),
+       masked contrast maps
 
     Returns
     -------
-    z: array of shape (mask.sum()),
-       the z-transformed contrast values within the mask
+    z: array of shape (n_tests, n_voxels)
     """
-    n_samples = len(imgs)
-    dmtx = pd.DataFrame(np.ones(n_samples), columns=['intercept'])
-    glm.fit(imgs, design_matrix=dmtx)
-    rfx_img = glm.compute_contrast([1], output_type='z_score')
-    _, threshold_ = map_threshold(
-        rfx_img, threshold=threshold, height_control=height_control)
-    rfx = glm.masker_.transform(rfx_img)
-    rfx = rfx * (np.abs(rfx) > threshold)
-    return rfx_img, threshold_, rfx
+    n_samples = Z.shape[1]
+    mean = Z.mean(1, dtype=np.float64)
+    std = Z.std(1, ddof=1, dtype=np.float64)
+    t = np.zeros_like(mean)
+    np.divide(mean * np.sqrt(n_samples), std, out=t, where=std > 0)
+    return _t_to_z(t, n_samples - 1)
 
 
-def conjunction_img(imgs, masker, contrast, percentile=50, threshold=3.1,
-                    height_control='none'):
-    """ generate conjunction statsitics of the contrat images in dataframe
+def conjunction_z(Z, percentile=50):
+    """ Conjunction statistic of each set of maps, signed
 
     Parameters
     ----------
-    df: pandas dataframe,
-        holding information on the database indexed by task, contrast, subject
-
-    contrasts: list of strings,
-               The contrasts to be tested
-    masker: niftimasker instance,
-            to define the spatial context of the analysis
-    precentile:  float,
-        Percentile used for the conjunction analysis
+    Z: array of shape (n_tests, n_samples, n_voxels),
+       masked contrast maps
+    percentile: float,
+                percentile used for the conjunction analysis
+
+    Returns
+    -------
+    conj: array of shape (n_tests, n_voxels)
     """
     from conjunction import _conjunction_inference_from_z_values
-    contrast_mask = (df.contrast.values == contrast)
-    Z = masker.transform(imgs).T
-    pos_conj = _conjunction_inference_from_z_values(Z, percentile * .01)
-    neg_conj = _conjunction_inference_from_z_values(-Z, percentile * .01)
+    n_tests, n_samples, n_voxels = Z.shape
+    # the statistic is voxel-wise: all the tests are stacked as voxels
+    Z_ = np.reshape(np.transpose(Z, (0, 2, 1)), (-1, n_samples))
+    pos_conj = _conjunction_inference_from_z_values(Z_, percentile * .01)
+    neg_conj = _conjunction_inference_from_z_values(-Z_, percentile * .01)
     conj = pos_conj
     conj[conj < 0] = 0
     conj[neg_conj > 0] = - neg_conj[neg_conj > 0]
-    conj_img = masker.inverse_transform(conj)
-    _, threshold_ = map_threshold(
-        conj_img, threshold=threshold, height_control=height_control)
-    conj = conj * (np.abs(conj) > threshold)
-    return conj_img, threshold_, conj
+    return np.reshape(conj, (n_tests, n_voxels))
+
+
+def map_thresholds(stats, level, height_control='fdr', two_sided=True):
+    """ Threshold of each map, for a given height control
+
+    Unlike nistats.map_threshold, the Benjamini-Hochberg procedure runs on
+    all the voxels of the maps, not on a background mask computed from
+    each image. With two_sided=False, it runs on the signed statistics, as
+    nistats does; by default, it runs on their absolute values, so that
+    the threshold applies to |stats|.
+
+    Parameters
+    ----------
+    stats: array of shape (n_maps, n_voxels),
+           z-like statistics
+    level: float,
+           the desired FDR ('fdr') or family-wise ('bonferroni') error
+           rate, or the threshold itself ('none')
+    height_control: string, 'fdr', 'bonferroni' or 'none'
+    two_sided: bool, optional,
+               whether the procedure runs on the absolute values
+
+    Returns
+    -------
+    thresholds: array of shape (n_maps,)
+    """
+    from scipy.stats import norm
+    n_maps, n_voxels = stats.shape
+    if height_control == 'none':
+        return np.repeat(float(level), n_maps)
+    if height_control == 'bonferroni':
+        return np.repeat(norm.isf(level / n_voxels), n_maps)
+    if height_control != 'fdr':
+        raise ValueError('Unknown height_control %s' % height_control)
+    # Benjamini-Hochberg, map by map
+    if two_sided:
+        stats = np.abs(stats)
+    z_sorted = - np.sort(- stats, 1)
+    pos = norm.sf(z_sorted) < level * np.linspace(
+        1. / n_voxels, 1, n_voxels)
+    last = n_voxels - 1 - np.argmax(pos[:, ::-1], 1)
+    return np.where(pos.any(1),
+                    z_sorted[np.arange(n_maps), last] - 1.e-12, np.inf)
+
+
+def _jaccard(ref, samples):
+    """ Jaccard index of a boolean map with each row of samples
+
+    Two empty maps have an index of 1."""
+    intersection = np.sum(samples & ref, 1)
+    union = np.sum(samples | ref, 1)
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.)
+
+
+def _accuracy(ref, samples):
+    """ Fraction of voxels where a boolean map and each row of samples
+    agree, i.e. the former sklearn jaccard_similarity_score of binary
+    vectors"""
+    return np.mean(samples == ref, 1)
+
 
 # caching
 main_parent_dir = '/neurospin/tmp/'
@@ -115,57 +169,81 @@ _package_directory = os.path.dirname(
 mask_gm = os.path.join(
     _package_directory, '../ibc_data', 'gm_mask_1_5mm.nii.gz')
 
-masker = NiftiMasker(mask_img=mask_gm).fit()
-glm = SecondLevelModel(mask=mask_gm)
+masker = MaskedMapStore(mask_gm).fit()
 qval = .05
 height_control = 'fdr'
 n_bootstrap = 100
+# The published analysis cut the maps at |z| > qval (the FDR threshold was
+# only used for display) and scored overlaps with the accuracy of the
+# binary maps. Set threshold_mode = 'height_control' and score = 'jaccard'
+# to cut at the threshold given by height_control and use Jaccard indices.
+threshold_mode = 'qval'
+score = 'accuracy'
+
+
+def analyse_contrast(df, masker, contrast, n_bootstrap, qval,
+                     height_control, threshold_mode='qval', score='accuracy',
+                     block_size=10):
+    """ Stability of RFX and conjunction maps under bootstrap resampling
 
+    The contrast maps are masked once, all the bootstrap samples are drawn
+    up front and their statistics, thresholds and overlaps with the
+    original maps are computed block_size samples at a time.
 
-def analyse_contrast(df, masker, glm, contrast, n_bootstrap, qval,
-                     height_control):
+    Parameters
+    ----------
+    threshold_mode: string, 'qval' or 'height_control', optional,
+                    whether maps are cut at |z| > qval, as in the published
+                    analysis, or at the threshold of height_control
+    score: string, 'accuracy' or 'jaccard', optional,
+           overlap measure of the bootstrap and original maps
+
+    Returns
+    -------
+    scores: array of shape (3, n_bootstrap),
+            average overlap of the positive and negative suprathreshold
+            maps with those of the original sample, for the RFX, 25% and
+            50% conjunction statistics
+    """
     print(contrast)
     contrast_mask = (df.contrast.values == contrast) &\
                     (df.acquisition == 'ffx')
     imgs = df.path[contrast_mask].values.tolist()
-    img1, threshold, ref1 = one_sample_test(imgs, glm, threshold=qval,
-                                            height_control=height_control)
-    plotting.plot_stat_map(img1, threshold=threshold, title='RFX',
-                           vmax=10)
-    img2, threshold, ref2 = conjunction_img(
-        imgs, masker, contrast, percentile=25,  threshold=qval,
-        height_control=height_control)
-    plotting.plot_stat_map(img2, threshold=threshold, title='conj 25%',
-                           vmax=10)
-    img3, threshold, ref3 = conjunction_img(
-        imgs, masker, contrast, percentile=50, threshold=qval,
-        height_control=height_control)
-    plotting.plot_stat_map(img3, threshold=threshold, title='conj 50%',
-                           vmax=10)
-
-    score1, score2, score3 = [], [], []
-    for b in range(n_bootstrap):
-        bootstrap = np.random.randint(0, len(imgs), len(imgs))
-        imgs_ = [imgs[b] for b in bootstrap]
-        _, _, sample1 = one_sample_test(imgs_, glm, threshold=qval,
-                                        height_control=height_control)
-        score1.append(.5 * (
-            jaccard_similarity_score(ref1 > 0, sample1 > 0) +
-            jaccard_similarity_score(ref1 < 0, sample1 < 0)))
-
-        _, _, sample2 = conjunction_img(
-            imgs_, masker, contrast, percentile=25,  threshold=qval,
-            height_control=height_control)
-        score2.append(.5 * (jaccard_similarity_score(ref2 > 0, sample2 > 0) +
-                            jaccard_similarity_score(ref2 < 0, sample2 < 0)))
-
-        _, _, sample3 = conjunction_img(
-            imgs_, masker, contrast, percentile=50,  threshold=qval,
-            height_control=height_control)
-        score3.append(.5 * (jaccard_similarity_score(ref3 > 0, sample3 > 0) +
-                            jaccard_similarity_score(ref3 < 0, sample3 < 0)))
-
-    return score1, score2, score3
+    Z = masker.transform(imgs)
+    bootstraps = np.random.randint(0, len(imgs), (n_bootstrap, len(imgs)))
+    statistics = [one_sample_z,
+                  partial(conjunction_z, percentile=25),
+                  partial(conjunction_z, percentile=50)]
+    titles = ['RFX', 'conj 25%', 'conj 50%']
+
+    if threshold_mode not in ['qval', 'height_control']:
+        raise ValueError('Unknown threshold_mode %s' % threshold_mode)
+    overlap = {'accuracy': _accuracy, 'jaccard': _jaccard}[score]
+    # the displayed threshold is one-sided, as computed by nistats, when
+    # it does not cut the maps
+    two_sided = threshold_mode == 'height_control'
+
+    scores = np.zeros((len(statistics), n_bootstrap))
+    for statistic, title, score_ in zip(statistics, titles, scores):
+        ref = statistic(Z[np.newaxis])
+        threshold = map_thresholds(ref, qval, height_control, two_sided)[0]
+        plotting.plot_stat_map(masker.inverse_transform(ref[0]),
+                               threshold=threshold, title=title, vmax=10)
+        if threshold_mode == 'qval':
+            threshold = qval
+        ref = ref[0] * (np.abs(ref[0]) > threshold)
+        for start in range(0, n_bootstrap, block_size):
+            samples = statistic(Z[bootstraps[start: start + block_size]])
+            if threshold_mode == 'qval':
+                threshold = qval
+            else:
+                threshold = map_thresholds(
+                    samples, qval, height_control)[:, np.newaxis]
+            samples *= np.abs(samples) > threshold
+            score_[start: start + block_size] = .5 * (
+                overlap(ref > 0, samples > 0) +
+                overlap(ref < 0, samples < 0))
+    return scores
 
 # ******************************************************************************
 # Use this snippet of code to compute the bootsprap set and, then,
@@ -173,23 +251,23 @@ def analyse_contrast(df, masker, glm, contrast, n_bootstrap, qval,
 
 # Smooth derivatives
 df = data_parser(derivatives=SMOOTH_DERIVATIVES, subject_list=SUBJECTS,
-                 conditions=CONTRASTS, task_list=task_list)
+                 conditions=CONTRASTS, task_list=task_list, catalog=CATALOG)
 df = df[df.modality == 'bold']
 
 scores_ = Parallel(n_jobs=6)(delayed(analyse_contrast)(
-    df, masker, glm, contrast, n_bootstrap, qval, height_control)
-                            for contrast in df.contrast.unique())
+    df, masker, contrast, n_bootstrap, qval, height_control, threshold_mode,
+    score) for contrast in df.contrast.unique())
 scores = np.rollaxis(np.array(scores_), 1)
 smooth_rfx, smooth_c25, smooth_c50 = scores
 
 # Non-smooth derivatives
 df = data_parser(derivatives=DERIVATIVES, subject_list=SUBJECTS,
-                 conditions=CONTRASTS, task_list=task_list)
+                 conditions=CONTRASTS, task_list=task_list, catalog=CATALOG)
 df = df[df.modality == 'bold']
 
 scores_ = Parallel(n_jobs=6)(delayed(analyse_contrast)(
-    df, masker, glm, contrast, n_bootstrap, qval, height_control)
-                            for contrast in df.contrast.unique())
+    df, masker, contrast, n_bootstrap, qval, height_control, threshold_mode,
+    score) for contrast in df.contrast.unique())
 scores = np.rollaxis(np.array(scores_), 1)
 rfx, c25, c50 = scores
 plt.close('all')
@@ -16,7 +16,7 @@ import matplotlib
 matplotlib.use('Agg')
 import pandas as pd
 from matplotlib import pyplot as plt
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from ibc_public.utils_data import (
     data_parser, SMOOTH_DERIVATIVES, SUBJECTS, CONTRASTS, LABELS)
 import ibc_public
@@ -66,7 +66,7 @@ mask_gm = os.path.join(
     _package_directory, '../ibc_data', 'gm_mask_1_5mm.nii.gz')
 
 data_dir = SMOOTH_DERIVATIVES
-masker = NiftiMasker(mask_img=mask_gm, memory=write_dir).fit()
+masker = MaskedMapStore(mask_gm).fit()
 
 
 def append_correlation(imgs, masker, correlations=[]):
@@ -12,7 +12,7 @@ Compatibility: Python 3.5
 import os
 import json
 import matplotlib.pyplot as plt
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from nilearn import plotting
 import nibabel as nib
 import numpy as np
@@ -20,8 +20,9 @@ from joblib import Memory
 # from utils_group_analysis import sorted_contrasts
 from ibc_public.utils_data import (
     data_parser, SMOOTH_DERIVATIVES, DERIVATIVES, SUBJECTS, CONTRASTS,
-    make_surf_db, all_contrasts)
+    make_surf_db, all_contrasts, CATALOG)
 import ibc_public
+from ibc_public.utils_io import read_gifti_textures
 from utils_dictionary import make_dictionary, dictionary2labels, _make_labels
 
 
@@ -61,12 +62,14 @@ do_surface = True
 
 if do_surface:
     db = make_surf_db(derivatives=DERIVATIVES, conditions=CONTRASTS,
-                      subject_list=subject_list, task_list=TASKS)
+                      subject_list=subject_list, task_list=TASKS,
+                      catalog=CATALOG)
     # db = db[db.subject != 'sub-15']
 else:
     # Mask of the grey matter across subjects
     db = data_parser(derivatives=SMOOTH_DERIVATIVES, subject_list=subject_list,
-                     conditions=CONTRASTS, task_list=task_list)
+                     conditions=CONTRASTS, task_list=task_list,
+                     catalog=CATALOG)
     _package_directory = os.path.dirname(
         os.path.abspath(ibc_public.utils_data.__file__))
     mask_gm = os.path.join(
@@ -96,8 +99,7 @@ def make_surf_data(df, subject_list):
                 print(subject, contrast)
             paths.append(df[mask][df.side == 'lh'].path.values[-1])
             paths.append(df[mask][df.side == 'rh'].path.values[-1])
-    Xr = np.array([nib.load(texture).darrays[0].data
-                  for texture in list(paths)])
+    Xr = read_gifti_textures(list(paths))
     n_voxels = Xr.shape[1]
     Xr = Xr.reshape(n_contrasts, int(2 * n_subjects * n_voxels))
     return Xr, n_voxels
@@ -116,8 +118,7 @@ else:
                 print(subject, contrast)
             paths.append(df[mask].path.values[-1])
     # image masking
-    masker = NiftiMasker(
-        mask_img=mask_gm, memory=write_dir, smoothing_fwhm=None).fit()
+    masker = MaskedMapStore(mask_gm).fit()
     Xr = masker.transform(paths).reshape(
         n_contrasts, int(n_subjects * n_voxels))
 
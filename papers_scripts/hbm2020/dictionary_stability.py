@@ -13,7 +13,7 @@ Compatibility: Python 3.5
 import os
 import json
 import matplotlib.pyplot as plt
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 import nibabel as nib
 import numpy as np
 from joblib import Memory
@@ -102,8 +102,7 @@ for contrast in contrasts:
         pa_paths.append(df[mask].path.values[-1])
 
 # image masking
-masker = NiftiMasker(
-    mask_img=mask_gm, memory=write_dir, smoothing_fwhm=None).fit()
+masker = MaskedMapStore(mask_gm).fit()
 X1 = masker.transform(ap_paths).reshape(
     n_contrasts, int(n_subjects * n_voxels))
 X2 = masker.transform(pa_paths).reshape(
@@ -117,10 +116,10 @@ X2[np.isnan(X2)] = 0
 
 dictionary1, components_1 = make_dictionary(
     X1, n_components=n_components, alpha=alpha, write_dir=write_dir,
-    contrasts=contrasts, method='multitask', l1_ratio=.25)
+    contrasts=contrasts, method='multitask', l1_ratio=.25, n_jobs=4)
 dictionary2, components_2 = make_dictionary(
     X2, n_components=n_components, alpha=alpha, write_dir=write_dir,
-    contrasts=contrasts, method='multitask', l1_ratio=.25)
+    contrasts=contrasts, method='multitask', l1_ratio=.25, n_jobs=4)
 
 components1 = np.reshape(components_1, (n_subjects, n_voxels, n_components))
 mean_components1 = np.median(components1, 0).T
@@ -14,10 +14,10 @@ import numpy as np
 from math import *
 
 from joblib import Memory
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from ibc_public.utils_data import (
     data_parser, SMOOTH_DERIVATIVES, DERIVATIVES, SUBJECTS, CONTRASTS,
-    LABELS)
+    LABELS, CATALOG)
 import ibc_public
 import matplotlib
 # matplotlib.use('Agg')
@@ -62,7 +62,7 @@ TASKS = [task_dic[tkey] for tkey in task_list]
 TASKS = flatten(TASKS)
 
 df = data_parser(derivatives=SMOOTH_DERIVATIVES, subject_list=SUBJECTS,
-                 conditions=CONTRASTS, task_list=TASKS)
+                 conditions=CONTRASTS, task_list=TASKS, catalog=CATALOG)
 
 # Mask of the grey matter across subjects
 _package_directory = os.path.dirname(
@@ -71,7 +71,7 @@ mask_gm = os.path.join(
     _package_directory, '../ibc_data', 'gm_mask_1_5mm.nii.gz')
 
 data_dir = SMOOTH_DERIVATIVES
-masker = NiftiMasker(mask_img=mask_gm, memory=cache).fit()
+masker = MaskedMapStore(mask_gm).fit()
 fig = plt.figure(figsize=(17, 11))
 q = 0
 column = 0
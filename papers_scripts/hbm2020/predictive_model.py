@@ -16,7 +16,6 @@ from joblib import Memory, Parallel, delayed
 import numpy as np
 import nibabel as nib
 
-from sklearn.linear_model import RidgeCV
 from sklearn.model_selection import GroupKFold
 from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
 from sklearn.dummy import DummyClassifier
@@ -36,7 +35,8 @@ from nilearn import surface
 
 from ibc_public.utils_data import (
     data_parser, SMOOTH_DERIVATIVES, DERIVATIVES, SUBJECTS, LABELS, CONTRASTS,
-    make_surf_db)
+    make_surf_db, CATALOG)
+from ibc_public.utils_store import ParcelDataStore
 import ibc_public
 
 
@@ -65,7 +65,7 @@ task_tags = [item for sublist in task_tags for item in sublist]
 
 # Mask of the grey matter across subjects
 db = data_parser(derivatives=SMOOTH_DERIVATIVES, subject_list=subject_list,
-                 conditions=CONTRASTS, task_list=task_tags)
+                 conditions=CONTRASTS, task_list=task_tags, catalog=CATALOG)
 df = db[db.task.isin(task_list)]
 df = df.sort_values(by=['subject', 'task', 'contrast'])
 
@@ -106,53 +106,122 @@ ward = Parcellations(method='ward', n_parcels=n_parcels, mask=mask_gm,
 # Call fit on functional dataset: single subject (less samples).
 ward.fit(paths)
 
-
-def _scorer(clf, X, Y):
-    """ Custom scorer"""
-    if Y.ndim > 1:
-        return 1 - np.sum((Y - clf.predict(X)) ** 2, 1) / np.sum((Y) ** 2, 1)
-    else:
-        return 1 - (Y - clf.predict(X)) ** 2 / Y ** 2
-
-
-def _cross_val_score(clf, X, Y, cv, groups, _scorer):
-    """ Custom cross_val score"""
-    scores = []
-    n_voxels = np.sum(groups == 0)
-    for train, test in cv.split(X, Y, groups):
-        X_train, X_test = X[train], X[test]
-        Y_train, Y_test = Y[train], Y[test]
-        clf.fit(X_train, Y_train)
-        #  print(clf.alpha_)
-        n_tests = len(np.unique(groups[test]))
-        score = _scorer(clf, X_test, Y_test).reshape(n_tests, n_voxels)
-        scores.append(score.mean(0))
-    return np.mean(scores, 0)
+# mask all the contrast maps once, voxels grouped by parcel
+store = ParcelDataStore(
+    ward.labels_img_, paths.reshape(n_subjects, n_contrasts),
+    data_file=os.path.join(cache, 'parcel_data.npy'))
 
 
 def _permute_Y(Y, groups):
-    """"""
+    """ Shuffle the blocks of rows of Y corresponding to the groups"""
     permutation = np.unique(groups)
     np.random.shuffle(permutation)
-    return np.vstack((Y[groups == i] for i in permutation))
-
-
-def get_cv_score(i, ward, paths, clf, gkf, permutation=False):
-    score = {}
-    mask_i = math_img('img == %d' % i, img=ward.labels_img_)
-    masker = NiftiMasker(
-        mask_img=mask_i, memory=cache, smoothing_fwhm=None).fit()
-    Z = np.array([masker.transform(paths[subjects == subject]).T
-                 for subject in subject_list])
-    Z = np.reshape(Z, (len(subject_list) * Z.shape[1], n_contrasts)).T
-    groups = np.repeat(np.arange(n_subjects), Z.shape[1] / n_subjects)
+    return np.vstack([Y[groups == i] for i in permutation])
+
+
+def _ridge_gcv(XV, eigvals, Yc, Q, alphas):
+    """ Index of the penalty with the lowest leave-one-out error
+
+    Same criterion as RidgeCV (efficient leave-one-out, one alpha for all
+    the targets), written in the eigenbasis of the Gram matrix of the
+    centered features Xc = XV V^T, with Q = V^T Xc^T Yc."""
+    n_samples = XV.shape[0]
+    XV2 = XV ** 2
+    errors = []
+    for alpha in alphas:
+        shrink = 1. / (eigvals + alpha)
+        residuals = Yc - XV.dot(shrink[:, np.newaxis] * Q)
+        # the intercept is not penalized
+        leverage = XV2.dot(shrink) + 1. / n_samples
+        errors.append(np.mean((residuals / (1 - leverage)[:, np.newaxis])
+                              ** 2))
+    return np.argmin(errors)
+
+
+def _score(Y, prediction):
+    """ R2 of the prediction of each sample, across target contrasts"""
+    return 1 - np.sum((Y - prediction) ** 2, 1) / np.sum(Y ** 2, 1)
+
+
+def ridge_cv_scores(Z, groups, cv, alphas=(.1, 1., 10.), n_permutations=0):
+    """ Cross-validated scores of a ridge prediction of each task's
+    contrasts from the other contrasts
+
+    Equivalent to fitting RidgeCV(alphas) on each task and each split of
+    cv, but the Gram matrix of each training set is computed once for all
+    the tasks, and the eigendecomposition of the features of each task is
+    shared by all the penalties, all the target contrasts and the targets
+    permuted across subjects.
+
+    Parameters
+    ----------
+    Z: array of shape (n_contrasts, n_subjects * n_voxels),
+       the data of one parcel, subject after subject
+    groups: array of shape (n_subjects * n_voxels,),
+            the subject of each voxel
+    cv: cross-validation object, e.g. GroupKFold
+    alphas: sequence of float, the candidate penalties
+    n_permutations: int, the number of runs with permuted targets
+
+    Returns
+    -------
+    scores: dict,
+            per-voxel score (array of shape (n_voxels,)) of each task
+    permuted_scores: dict,
+                     per-voxel scores of each task with permuted targets,
+                     array of shape (n_permutations, n_voxels)
+    """
+    Z = np.asarray(Z, dtype=np.float64).T
+    n_voxels = np.sum(groups == groups[0])
+    targets = {}
     for task in task_list:
-        X = Z[tasks != task].T
-        Y = Z[tasks == task].T
-        if permutation:
-            Y = _permute_Y(Y, groups)
-        score[task] = _cross_val_score(clf, X, Y, gkf, groups, _scorer)
-    return score
+        Y = Z[:, tasks == task]
+        targets[task] = [Y] + [_permute_Y(Y, groups)
+                               for _ in range(n_permutations)]
+    scores = dict((task, np.zeros((1 + n_permutations, n_voxels)))
+                  for task in task_list)
+    n_splits = 0
+    for train, test in cv.split(Z, groups=groups):
+        n_splits += 1
+        offset = Z[train].mean(0)
+        Zc = Z[train] - offset
+        gram = Zc.T.dot(Zc)
+        n_tests = len(np.unique(groups[test]))
+        for task in task_list:
+            features = tasks != task
+            eigvals, V = np.linalg.eigh(gram[features][:, features])
+            eigvals = np.maximum(eigvals, 0)
+            Xc = Zc[:, features]
+            XV = Xc.dot(V)
+            X_test = Z[test][:, features] - offset[features]
+            for k, Y in enumerate(targets[task]):
+                Y_offset = Y[train].mean(0)
+                Yc = Y[train] - Y_offset
+                if k == 0:
+                    XtY = gram[features][:, tasks == task]
+                else:
+                    XtY = Xc.T.dot(Yc)
+                Q = V.T.dot(XtY)
+                alpha = alphas[_ridge_gcv(XV, eigvals, Yc, Q, alphas)]
+                coef = V.dot(Q / (eigvals + alpha)[:, np.newaxis])
+                prediction = X_test.dot(coef) + Y_offset
+                score = _score(Y[test], prediction)
+                scores[task][k] += score.reshape(n_tests, n_voxels).mean(0)
+    scores = dict((task, scores[task] / n_splits) for task in task_list)
+    return (dict((task, scores[task][0]) for task in task_list),
+            dict((task, scores[task][1:]) for task in task_list))
+
+
+def get_cv_score(data, gkf, alphas, n_permutations=0):
+    """ Cross-validated prediction scores of each task in one parcel
+
+    data is the (n_subjects, n_contrasts, n_voxels) data of the parcel,
+    see ridge_cv_scores for the outputs"""
+    n_voxels = data.shape[2]
+    Z = np.reshape(np.transpose(data, (1, 0, 2)),
+                   (n_contrasts, n_subjects * n_voxels))
+    groups = np.repeat(np.arange(n_subjects), n_voxels)
+    return ridge_cv_scores(Z, groups, gkf, alphas, n_permutations)
 
 
 # affix = 'loocv'
@@ -168,38 +237,25 @@ nsplits = n_subjects // 3
 # nsplits = n_subjects // 6
 
 gkf = GroupKFold(n_splits=nsplits)
-clf = RidgeCV()
-# clf = DummyClassifier(strategy="most_frequent")
-# clf = GradientBoostingRegressor()
-# clf = RandomForestRegressor()
-scores = Parallel(n_jobs=2)(
-    delayed(get_cv_score)(i, ward, paths, clf, gkf)
-    for i in range(1, 1 + n_parcels))
+alphas = (.1, 1., 10.)  # those of RidgeCV()
+# the run with scrambled subjects shares the decompositions of the true one
+scores, scores_ = zip(*Parallel(n_jobs=2)(
+    delayed(get_cv_score)(store.parcel(i), gkf, alphas, n_permutations=1)
+    for i in store.parcels))
 
 score_imgs = []
 for task in task_list:
-    score_map = math_img('0. * img ', img=ward.labels_img_).get_data()
-    for i in range(1, 1 + n_parcels):
-        score_map[ward.labels_img_.get_data() == i] = scores[i - 1][task]
-
-    score_img = nib.Nifti1Image(score_map, ward.labels_img_.affine)
+    score_img = store.inverse_transform(
+        np.concatenate([score[task] for score in scores]))
     filename = os.path.join(write_dir, 'score_' + affix + '_%s.nii.gz' % task)
     score_img.to_filename(filename)
     score_imgs.append(score_img)
 
 
 # Run with scrambled subjects to see the difference
-scores_ = Parallel(n_jobs=2)(
-    delayed(get_cv_score)(i, ward, paths, clf, gkf, permutation=True)
-    for i in range(1, 1 + n_parcels))
-
 for task in task_list:
-    diff_score_map = math_img('0. * img ', img=ward.labels_img_).get_data()
-    for i in range(1, 1 + n_parcels):
-        diff_score_map[ward.labels_img_.get_data() == i] = scores_[i - 1][task]
-
-    diff_score_img = nib.Nifti1Image(diff_score_map,
-                                     ward.labels_img_.affine)
+    diff_score_img = store.inverse_transform(
+        np.concatenate([score[task][0] for score in scores_]))
     filename = os.path.join(write_dir, 'diff_score_' + affix +
                             '_%s.nii.gz' % task)
     diff_score_img.to_filename(filename)
@@ -32,13 +32,122 @@ def initial_dictionary(n_clusters, X,):
     return dictionary
 
 
+def _multitask_enet_chunk(gram, projections, sq_norms, l1_reg, l2_reg,
+                          max_iter=1000, tol=1e-4):
+    """Block coordinate descent of MultiTaskElasticNet for many voxels
+
+    Same updates and stopping rule (duality gap) as scikit-learn, applied
+    to all the voxels of the chunk at once: all the voxels share the
+    design, whose Gram matrix is gram, and projections[v] is the product
+    of the (centered) design with the data of voxel v.
+
+    Parameters
+    ----------
+    gram: array of shape (n_features, n_features)
+    projections: array of shape (n_voxels, n_features, n_tasks)
+    sq_norms: array of shape (n_voxels,)
+              squared norms of the (centered) data of each voxel
+    l1_reg, l2_reg: float
+                    penalties, scaled by the number of samples
+
+    Returns
+    -------
+    coefs: array of shape (n_voxels, n_features, n_tasks)
+    """
+    n_voxels, n_features, n_tasks = projections.shape
+    coefs = np.zeros_like(projections)
+    # correlation of the residuals with the design, X^T (Y - X W)
+    corr = projections.copy()
+    active = np.arange(n_voxels)
+    for _ in range(max_iter):
+        W, C = coefs[active], corr[active]
+        w_max = np.zeros(active.size)
+        d_w_max = np.zeros(active.size)
+        for j in range(n_features):
+            if gram[j, j] == 0:
+                continue
+            w_old = W[:, j].copy()
+            tmp = C[:, j] + gram[j, j] * w_old
+            norm = np.sqrt(np.sum(tmp ** 2, 1))
+            shrink = np.maximum(1 - l1_reg / np.maximum(norm, 1e-300), 0)
+            W[:, j] = tmp * (shrink / (gram[j, j] + l2_reg))[:, np.newaxis]
+            delta = W[:, j] - w_old
+            C -= gram[:, j][np.newaxis, :, np.newaxis] * \
+                delta[:, np.newaxis, :]
+            d_w_max = np.maximum(d_w_max, np.abs(delta).max(1))
+            w_max = np.maximum(w_max, np.abs(W[:, j]).max(1))
+        coefs[active], corr[active] = W, C
+        check = (w_max == 0) | (d_w_max / np.maximum(w_max, 1e-300) < tol)
+        # duality gap of the voxels that may have converged
+        B, sq = projections[active], sq_norms[active]
+        wb = np.sum(W * B, (1, 2))
+        r_norm2 = np.maximum(sq - 2 * wb + np.sum(W * (B - C), (1, 2)), 0)
+        xta = C - l2_reg * W
+        dual_norm = np.sqrt(np.sum(xta ** 2, 2)).max(1)
+        const = np.where(dual_norm > l1_reg,
+                         l1_reg / np.maximum(dual_norm, 1e-300), 1.)
+        gap = np.where(dual_norm > l1_reg,
+                       .5 * r_norm2 * (1 + const ** 2), r_norm2)
+        gap += l1_reg * np.sqrt(np.sum(W ** 2, 2)).sum(1) - \
+            const * (sq - wb) + \
+            .5 * l2_reg * (1 + const ** 2) * np.sum(W ** 2, (1, 2))
+        converged = check & (gap < tol * sq)
+        active = active[~converged]
+        if active.size == 0:
+            break
+    return coefs
+
+
+def multitask_encode(dictionary, X, n_subjects, alpha=5., l1_ratio=.5,
+                     n_jobs=1, chunk_size=5000, max_iter=1000, tol=1e-4):
+    """Encode all voxels on a dictionary with a group-sparse penalty
+
+    Equivalent to fitting, for each voxel, a
+    MultiTaskElasticNet(alpha, l1_ratio) of its values across subjects on
+    the dictionary, but solves the voxels by chunks of chunk_size at once,
+    in n_jobs parallel jobs.
+
+    Parameters
+    ----------
+    dictionary: array of shape (n_components, n_contrasts)
+    X: array of shape (n_contrasts, n_subjects * n_voxels)
+       data, subject after subject
+    n_subjects: int
+
+    Returns
+    -------
+    components: array of shape (n_subjects * n_voxels, n_components)
+    """
+    from joblib import Parallel, delayed
+    n_contrasts, n_components = dictionary.shape[1], dictionary.shape[0]
+    n_voxels = X.shape[1] // n_subjects
+    # fit_intercept: center the design and the data
+    design = dictionary.T - dictionary.T.mean(0)
+    Y = X.reshape(n_contrasts, n_subjects, n_voxels)
+    Y = Y - Y.mean(0)
+    gram = design.T.dot(design)
+    l1_reg = alpha * l1_ratio * n_contrasts
+    l2_reg = alpha * (1. - l1_ratio) * n_contrasts
+
+    def chunk_problem(start):
+        y = Y[:, :, start: start + chunk_size]
+        projections = np.einsum('nk,nsv->vks', design, y)
+        sq_norms = np.sum(y ** 2, (0, 1))
+        return gram, projections, sq_norms, l1_reg, l2_reg, max_iter, tol
+
+    coefs = Parallel(n_jobs=n_jobs)(
+        delayed(_multitask_enet_chunk)(*chunk_problem(start))
+        for start in range(0, n_voxels, chunk_size))
+    coefs = np.concatenate(coefs)  # (n_voxels, n_components, n_subjects)
+    return np.reshape(np.transpose(coefs, (2, 0, 1)),
+                      (n_subjects * n_voxels, n_components))
+
+
 def make_dictionary(X, n_components=20, alpha=5., write_dir='/tmp/',
                     contrasts=[], method='multitask', l1_ratio=.5,
-                    n_subjects=13):
+                    n_subjects=13, n_jobs=1):
     """Create dictionary + encoding"""
     from sklearn.decomposition import dict_learning_online, sparse_encode
-    from sklearn.preprocessing import StandardScaler
-    from sklearn.linear_model import MultiTaskLasso, MultiTaskElasticNet
 
     mem = Memory(write_dir, verbose=0)
     dictionary = mem.cache(initial_dictionary)(n_components, X)
@@ -61,15 +170,9 @@ def make_dictionary(X, n_components=20, alpha=5., write_dir='/tmp/',
             X.T, dictionary, alpha=alpha, max_iter=10, n_jobs=1,
             check_input=True, verbose=0, positive=True)
     elif method == 'multitask':
-        # too many hard-typed parameters !!!
-        n_voxels = X.shape[1] // n_subjects
-        components = np.zeros((X.shape[1], n_components))
-        clf = MultiTaskLasso(alpha=alpha)
-        clf = MultiTaskElasticNet(alpha=alpha, l1_ratio=l1_ratio)
-        for i in range(n_voxels):
-            x = X[:, i: i + n_subjects * n_voxels: n_voxels]
-            components[i: i + n_subjects * n_voxels: n_voxels] =\
-                clf.fit(dictionary.T, x).coef_
+        # MultiTaskElasticNet of each voxel across subjects, batched
+        components = multitask_encode(dictionary, X, n_subjects, alpha=alpha,
+                                      l1_ratio=l1_ratio, n_jobs=n_jobs)
     return dictionary, components
 
 
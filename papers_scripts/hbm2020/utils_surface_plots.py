@@ -1,16 +1,15 @@
 """ Various utilities for surface-based plotting of brain maps
 """
 import numpy as np
-import nibabel as nib
 import os
 from nilearn import plotting
+from ibc_public.utils_io import read_gifti_textures
 
 
 def surface_one_sample(df, contrast, side):
     from scipy.stats import ttest_1samp, norm
     mask = (df.contrast.values == contrast) * (df.side.values == side)
-    X = np.array([nib.load(texture).darrays[0].data
-                  for texture in list(df.path[mask].values)])
+    X = read_gifti_textures(list(df.path[mask].values))
     # print (X.shape, np.sum(np.isnan(X)))
     t_values, p_values = ttest_1samp(X, 0)
     p_values = .5 * (1 - (1 - p_values) * np.sign(t_values))
@@ -21,8 +20,7 @@ def surface_one_sample(df, contrast, side):
 def surface_conjunction(df, contrast, side, percentile=25):
     from conjunction import _conjunction_inference_from_z_values
     mask = (df.contrast.values == contrast) * (df.side.values == side)
-    Z = np.array([nib.load(texture).darrays[0].data
-                  for texture in list(df.path[mask].values)]).T
+    Z = read_gifti_textures(list(df.path[mask].values)).T
     pos_conj = _conjunction_inference_from_z_values(Z, percentile * .01)
     neg_conj = _conjunction_inference_from_z_values(-Z, percentile * .01)
     conj = pos_conj
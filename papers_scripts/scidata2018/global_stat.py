@@ -10,7 +10,7 @@ import os
 import numpy as np
 import pandas as pd
 import nibabel as nib
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from joblib import Memory, Parallel, delayed
 from nilearn import plotting
 from nilearn.image import math_img
@@ -19,7 +19,8 @@ from nistats.thresholding import map_threshold
 import matplotlib.pyplot as plt
 
 from ibc_public.utils_data import (
-    CONDITIONS, data_parser, SUBJECTS, DERIVATIVES, SMOOTH_DERIVATIVES)
+    CONDITIONS, data_parser, SUBJECTS, DERIVATIVES, SMOOTH_DERIVATIVES,
+    CATALOG)
 
 cache = '/neurospin/tmp/bthirion'
 mem = Memory(cachedir=cache, verbose=0)
@@ -309,9 +310,9 @@ def condition_similarity_across_subjects(db, masker):
     
     
 if __name__ == '__main__':
-    db = data_parser(derivatives=SMOOTH_DERIVATIVES)
+    db = data_parser(derivatives=SMOOTH_DERIVATIVES, catalog=CATALOG)
     mask_gm = nib.load(os.path.join(DERIVATIVES, 'group', 'anat', 'gm_mask.nii.gz'))
-    masker = NiftiMasker(mask_img=mask_gm, memory=mem).fit()
+    masker = MaskedMapStore(mask_gm).fit()
     """
     design_matrix, subject_map, contrast_map, acq_map = anova(db, masker)
     subject_map.to_filename(os.path.join('output', 'subject_effect.nii.gz'))
@@ -18,7 +18,7 @@ import numpy as np
 import pandas as pd
 
 import nibabel as nib
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from nilearn import plotting
 
 
@@ -170,7 +170,7 @@ def eoi_parser(derivatives=DERIVATIVES):
 if __name__ == '__main__':
     db = eoi_parser(derivatives=SMOOTH_DERIVATIVES)
     mask_gm = nib.load(os.path.join(DERIVATIVES, 'group', 'anat', 'gm_mask.nii.gz'))
-    masker = NiftiMasker(mask_img=mask_gm).fit()
+    masker = MaskedMapStore(mask_gm).fit()
     df = db[db.modality == 'bold']
     X = masker.transform(df.path.values)
     # per-subject EoI
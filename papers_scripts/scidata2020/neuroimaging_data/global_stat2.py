@@ -25,14 +25,14 @@ import matplotlib.pyplot as plt
 
 from sklearn.preprocessing import OneHotEncoder, LabelEncoder
 from sklearn.manifold import TSNE
-from nilearn.input_data import NiftiMasker
+from ibc_public.utils_store import MaskedMapStore
 from nilearn import plotting
 from nilearn.image import math_img
 from nistats.second_level_model import SecondLevelModel
 from nistats.thresholding import map_threshold
 
 from ibc_public.utils_data import (data_parser, DERIVATIVES,
-                                   SMOOTH_DERIVATIVES, ALL_CONTRASTS)
+                                   SMOOTH_DERIVATIVES, ALL_CONTRASTS, CATALOG)
 
 # ############################### INPUTS ######################################
 
@@ -473,10 +473,10 @@ def condition_similarity_across_subjects(db, masker):
 
 if __name__ == '__main__':
     db = data_parser(derivatives=SMOOTH_DERIVATIVES, subject_list = PTS,
-                     task_list=TASKS)
+                     task_list=TASKS, catalog=CATALOG)
     mask_gm = nib.load(os.path.join(DERIVATIVES, 'group', 'anat',
                                     'gm_mask.nii.gz'))
-    masker = NiftiMasker(mask_img=mask_gm, memory=mem).fit()
+    masker = MaskedMapStore(mask_gm).fit()
 
     ### ANOVAs ###
     # ## Compute the ANOVAs
@@ -8,10 +8,13 @@ Compatibility: Python 3.5
 """
 
 import os
+import sys
 import glob
-from joblib import Parallel, delayed
 from pypreprocess.conf_parser import _generate_preproc_pipeline
 from ibc_public.utils_pipeline import fixed_effects_analysis, first_level
+from ibc_public.utils_io import MapWriter, purge_cache
+from ibc_public.utils_store import SessionTimeseriesStore
+from ibc_public.utils_scheduler import Scheduler
 from pipeline import (clean_subject, clean_anatomical_images, _adapt_jobfile,
                       prepare_derivatives)
 from ibc_public.utils_data import get_subject_session
@@ -26,6 +29,21 @@ RETINO_REG = dict(
     [(session_id, None) for session_id in
         ['clips_trn10', 'clips_trn11', 'clips_trn12']])
 IBC = '/neurospin/ibc'
+BOLD_CACHE = '/neurospin/tmp/ibc/bold_cache'
+TIMESERIES_STORE = '/neurospin/tmp/ibc/timeseries_store'
+DESIGN_CACHE = '/neurospin/tmp/ibc/design_cache'
+# maximal size (MB) of each of BOLD_CACHE and TIMESERIES_STORE, enforced
+# before and after each run by removing the least recently used files
+CACHE_MAX_SIZE = 500000
+
+# GLM passes run on each (subject, session), with the pass they depend on
+# (the unsmoothed pass reuses the timeseries stored by the smoothed one)
+# and their estimated peak memory in MB
+GLM_PASSES = [('3mm', dict(lowres=True, smooth=5)),
+              ('smooth', dict(smooth=5)),
+              ('unsmoothed', dict(smooth=None))]
+GLM_DEPS = {'3mm': None, 'smooth': None, 'unsmoothed': 'smooth'}
+GLM_MEMORY = {'3mm': 4000, 'smooth': 16000, 'unsmoothed': 16000}
 # IBC = '/storage/store2/data/ibc/'
 
 
@@ -108,8 +126,10 @@ def run_subject_glm(jobfile, protocol, subject, session=None, smooth=None,
         jobfile = 'ini_files/IBC_preproc_preference_sub-11.ini'
     elif protocol == 'stanford3' and subject in ['sub-15']:
         jobfile = 'ini_files/IBC_preproc_stanford3_sub-15.ini'
+    # one jobfile per process, as several passes may run concurrently
     output_name = os.path.join(
-        '/tmp', os.path.basename(jobfile)[:-4] + '_%s.ini' % subject)
+        '/tmp', os.path.basename(jobfile)[:-4] + '_%s_%d.ini' % (
+            subject, os.getpid()))
     _adapt_jobfile(jobfile, subject, output_name, session)
     list_subjects_update = generate_glm_input(output_name, smooth, lowres)
     clean_anatomical_images(IBC)
@@ -118,6 +138,9 @@ def run_subject_glm(jobfile, protocol, subject, session=None, smooth=None,
     else:
         mask_img = '../ibc_data/gm_mask_1_5mm.nii.gz'
 
+    # masked timeseries are shared by the smoothed and unsmoothed passes
+    timeseries_store = SessionTimeseriesStore(mask_img, TIMESERIES_STORE)
+    writer = MapWriter(n_threads=2, compress_level=1)
     for subject in list_subjects_update:
         subject['onset'] = [onset for onset in subject['onset']
                             if onset is not None]
@@ -126,37 +149,50 @@ def run_subject_glm(jobfile, protocol, subject, session=None, smooth=None,
             if protocol == 'clips4':
                 first_level(subject, compcorr=True,
                             additional_regressors=RETINO_REG,
-                            smooth=smooth, mask_img=mask_img)
+                            smooth=smooth, mask_img=mask_img, writer=writer,
+                            bold_cache_dir=BOLD_CACHE,
+                            timeseries_store=timeseries_store,
+                            design_cache_dir=DESIGN_CACHE,
+                            incremental=True)
             else:
                 first_level(subject, compcorr=True, smooth=smooth,
-                            mask_img=mask_img)
-                fixed_effects_analysis(subject, mask_img=mask_img)
+                            mask_img=mask_img, writer=writer,
+                            bold_cache_dir=BOLD_CACHE,
+                            timeseries_store=timeseries_store,
+                            design_cache_dir=DESIGN_CACHE,
+                            incremental=True)
+                fixed_effects_analysis(subject, mask_img=mask_img,
+                                       writer=writer, incremental=True)
+    writer.close()
 
 
 if __name__ == '__main__':
     prepare_derivatives(IBC)
     protocols = ['fbirn']
+    # one task per (subject, session, pass), scheduled within the memory
+    # budget of the machine; no state file is kept, as first_level and
+    # fixed_effects_analysis already skip the sessions and contrasts whose
+    # inputs did not change (incremental=True)
+    scheduler = Scheduler(state_file=None, n_jobs=4)
     for protocol in protocols:
         jobfile = 'ini_files/IBC_preproc_%s.ini' % protocol
         subject_session = get_subject_session(protocol)
-        Parallel(n_jobs=1)(
-            delayed(run_subject_glm)(
-                jobfile, protocol, subject, session, lowres=True, smooth=5)
-            for (subject, session) in subject_session)
-    smooth = 5
-    for protocol in protocols:
-        jobfile = 'ini_files/IBC_preproc_%s.ini' % protocol
-        # subject_session = get_subject_session(protocol)
-        Parallel(n_jobs=4)(
-            delayed(run_subject_glm)(
-                jobfile, protocol, subject, session, smooth=smooth)
-            for (subject, session) in subject_session)
-
-    smooth = None
-    for protocol in protocols:
-        jobfile = 'ini_files/IBC_preproc_%s.ini' % protocol
-        #subject_session = get_subject_session(protocol)
-        Parallel(n_jobs=4)(
-            delayed(run_subject_glm)(
-                jobfile, protocol, subject, session, smooth=smooth)
-            for (subject, session) in subject_session)
+        for (subject, session) in subject_session:
+            for pass_, kwargs in GLM_PASSES:
+                deps = []
+                if GLM_DEPS[pass_] is not None:
+                    deps = ['glm_%s_%s_%s_%s' % (
+                        protocol, subject, session, GLM_DEPS[pass_])]
+                scheduler.add(
+                    'glm_%s_%s_%s_%s' % (protocol, subject, session, pass_),
+                    run_subject_glm, jobfile, protocol, subject, session,
+                    deps=deps, memory=GLM_MEMORY[pass_], **kwargs)
+    dry_run = '--dry-run' in sys.argv
+    if not dry_run:
+        # no task runs yet: drop the leftovers of interrupted runs
+        for cache_dir in [BOLD_CACHE, TIMESERIES_STORE]:
+            purge_cache(cache_dir, CACHE_MAX_SIZE)
+    scheduler.run(dry_run=dry_run)
+    if not dry_run:
+        for cache_dir in [BOLD_CACHE, TIMESERIES_STORE]:
+            purge_cache(cache_dir, CACHE_MAX_SIZE)
@@ -6,8 +6,8 @@ import os
 import glob
 from pypreprocess.nipype_preproc_spm_utils import (do_subjects_preproc,
                                                    SubjectData)
-from nilearn.image import mean_img
 import nibabel as nib
+from ibc_public.utils_resample import running_means
 
 # Set firectories first
 data_dir = '/neurospin/ibc/derivatives'
@@ -65,9 +65,6 @@ do_subjects_preproc(
 # Create mean images for masking and display
 wanats = sorted(glob.glob(os.path.join(data_dir, 'sub-*', 'ses-*', 'anat', 'dartel',
                                 'w*_ses-*_acq-highres_T1w.nii.gz')))
-template = mean_img(wanats)
-template.to_filename(os.path.join(output_dir, 'highres_T1avg.nii.gz'))
-
 mgms = sorted(glob.glob(os.path.join(data_dir, 'sub-*', 'ses-*', 'anat', 'dartel',
                                      'mwc1*_ses-*_acq-highres_T1w.nii.gz')))
 
@@ -75,9 +72,13 @@ mgms = sorted(glob.glob(os.path.join(data_dir, 'sub-*', 'ses-*', 'anat', 'dartel
 ref_image = nib.load(ref_img)
 ref_affine = ref_image.affine
 ref_shape = ref_image.shape
-mean_gm = mean_img(
-    mgms, target_affine=ref_affine, target_shape=ref_shape) 
-gm_mask = nib.Nifti1Image((mean_gm.get_data() > .25).astype('uint8'),
+
+# average the anatomies and the gm maps in one pass
+means = running_means({'template': (wanats, None, None),
+                       'gm': (mgms, ref_affine, ref_shape)}, n_jobs=8)
+template, mean_gm = means['template'], means['gm']
+template.to_filename(os.path.join(output_dir, 'highres_T1avg.nii.gz'))
+gm_mask = nib.Nifti1Image((mean_gm.get_fdata() > .25).astype('uint8'),
                           ref_affine)
 mean_gm.to_filename(os.path.join(output_dir, 'mean_highres_gm.nii.gz'))
 gm_mask.to_filename(os.path.join(output_dir, 'highres_gm_mask.nii.gz'))
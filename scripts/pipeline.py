@@ -6,6 +6,7 @@ on IBC datasets
 
 """
 import os
+import sys
 import json
 import glob
 from pypreprocess.nipype_preproc_spm_utils import (do_subjects_preproc,
@@ -15,6 +16,7 @@ from joblib import Memory, Parallel, delayed
 from ibc_public.utils_pipeline import (
     fixed_effects_analysis, first_level, fsl_topup)
 from ibc_public.utils_data import get_subject_session
+from ibc_public.utils_scheduler import Scheduler
 from script_resample_normalized_data import resample_func_and_anat
 
 
@@ -192,8 +194,10 @@ def _adapt_jobfile(jobfile, subject, output_name, session=None):
 
 def run_subject_preproc(jobfile, subject, session=None):
     """ Create jobfile and run it on """
+    # one jobfile per process, as several sessions may run concurrently
     output_name = os.path.join(
-        '/tmp', os.path.basename(jobfile)[:-4] + '_%s.ini' % subject)
+        '/tmp', os.path.basename(jobfile)[:-4] + '_%s_%d.ini' % (
+            subject, os.getpid()))
     _adapt_jobfile(jobfile, subject, output_name, session)
     # Read the jobfile
     list_subjects, params = _generate_preproc_pipeline(output_name)
@@ -202,6 +206,29 @@ def run_subject_preproc(jobfile, subject, session=None):
     return subject_data
 
 
+def run_subject_preproc_dump(jobfile, subject, session=None,
+                             output_file=None):
+    """ Run the preprocessing and return its json-serializable outputs,
+    that can be sent back from a worker process
+
+    If output_file is provided, the outputs are also written there, so that
+    they outlive the run that produced them."""
+    list_subject_update = []
+    for dict_subject in run_subject_preproc(jobfile, subject, session):
+        dict_subject = dict_subject.__dict__
+        update_dict_subject_data = {
+            k: v for (k, v) in dict_subject.items()
+            if v.__class__.__module__ == 'builtins'}
+        update_dict_subject_data.pop('nipype_results', None)
+        list_subject_update.append(update_dict_subject_data)
+    if output_file is not None:
+        tmp_file = '%s.%d.tmp' % (output_file, os.getpid())
+        with open(tmp_file, 'w') as fid:
+            json.dump(list_subject_update, fid)
+        os.replace(tmp_file, output_file)
+    return list_subject_update
+
+
 if __name__ == '__main__':
     # correction of distortion_parameters
     # custom solution, to be improved in the future
@@ -217,39 +244,62 @@ if __name__ == '__main__':
                         ('sub-15', 'ses-35')]
 
     # subject_session = [('sub-15', 'ses-33')]
-    if do_topup:
-        acq = None
-        if protocol in ['rs']:
-            acq = 'mb6'
-        elif protocol in ['mtt1', 'mtt2']:
-            acq = 'mb3'
-        apply_topup(main_dir, cache_dir, subject_session, acq=acq)
-
-    subject_data = []
+    # topup, preprocessing and resampling run as a graph of tasks: each
+    # session is preprocessed as soon as its own topup is done, and the
+    # state file lets an interrupted run resume where it stopped
+    # (use --dry-run to only print the plan, --reset to run everything
+    # again)
+    dry_run = '--dry-run' in sys.argv
+    scheduler = Scheduler(
+        state_file=os.path.join(cache_dir,
+                                'pipeline_%s_state.json' % protocol),
+        n_jobs=1)
+    # outputs of each preprocessed session, kept across resumed runs
+    dump_dir = os.path.join(cache_dir, 'subjects_data_%s' % protocol)
+    if not os.path.exists(dump_dir):
+        os.makedirs(dump_dir)
+    acq = None
+    if protocol in ['rs']:
+        acq = 'mb6'
+    elif protocol in ['mtt1', 'mtt2']:
+        acq = 'mb3'
+    mem = Memory(cache_dir)
     jobfile = 'ini_files/IBC_preproc_%s.ini' % protocol
-    subject_data_ = Parallel(n_jobs=1)(
-        delayed(run_subject_preproc)(jobfile, subject, session)
-        for subject, session in subject_session)
-    subject_data = subject_data + subject_data_[0]
-
-    list_subject_update = []
-    list_files_parameter = []
-    for dict_subject in subject_data:
-        dict_subject = dict_subject.__dict__
-        update_dict_subject_data = {
-            k: v for (k, v) in dict_subject.items()
-            if v.__class__.__module__ == 'builtins'}
-        update_dict_subject_data.pop('nipype_results')
-        list_subject_update.append(update_dict_subject_data)
+    preproc_tasks = []
+    for subject, session in subject_session:
+        deps = []
+        if do_topup:
+            deps = [scheduler.add('topup_%s_%s' % (subject, session),
+                                  run_topup, mem, main_dir, subject, session,
+                                  acq=acq, memory=4000)]
+        preproc_tasks.append(scheduler.add(
+            'preproc_%s_%s_%s' % (protocol, subject, session),
+            run_subject_preproc_dump, jobfile, subject, session,
+            output_file=os.path.join(dump_dir, '%s_%s.json' % (
+                subject, session)),
+            deps=deps, memory=8000))
+    # resampling toward pre-defined shape, once all sessions are done
+    scheduler.add('resample_%s' % protocol, resample_func_and_anat,
+                  deps=preproc_tasks, memory=8000)
+    if '--reset' in sys.argv:
+        scheduler.reset()
+    scheduler.run(dry_run=dry_run)
 
-    # FileName for the dumped dictionnary from the preproc
-    json_file_name = 'subjects_data.json'
-    json_file = open(json_file_name, "w")
-    json.dump(list_subject_update, json_file)
-    json_file.flush()
+    if not dry_run:
+        # gather the outputs of all the sessions done so far, including
+        # those of previous runs
+        list_subject_update = []
+        for subject, session in subject_session:
+            dump_file = os.path.join(dump_dir, '%s_%s.json' % (
+                subject, session))
+            if os.path.exists(dump_file):
+                with open(dump_file) as fid:
+                    list_subject_update += json.load(fid)
 
-    # resampling toward pre-defined shape
-    resample_func_and_anat()
+        # FileName for the dumped dictionnary from the preproc
+        json_file_name = 'subjects_data.json'
+        with open(json_file_name, "w") as json_file:
+            json.dump(list_subject_update, json_file)
     """
     # Load the dump data
     list_subjects_update = json.load(open(json_file_name))
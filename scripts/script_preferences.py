@@ -6,6 +6,7 @@ import os
 import nibabel as nib
 import numpy as np
 from ibc_public.utils_pipeline import fixed_effects_img, fixed_effects_surf
+from ibc_public.utils_io import read_gifti_textures
 from pipeline import get_subject_session
 from nilearn.plotting import plot_stat_map
 from nilearn.image import math_img
@@ -77,12 +78,12 @@ def elementary_contrasts_surf(con_imgs, var_imgs):
     from nibabel.gifti import GiftiDataArray, GiftiImage
     outputs = []
     n_contrasts = 4
+    cons = read_gifti_textures(con_imgs[:n_contrasts])
+    vars_ = read_gifti_textures(var_imgs[:n_contrasts])
     for i in range(n_contrasts):
-        con = nib.load(con_imgs[i]).darrays[0].data
-        var = nib.load(var_imgs[i]).darrays[0].data
-        effects = [con - nib.load(con_imgs[j]).darrays[0].data
+        effects = [cons[i] - cons[j]
                    for j in range(n_contrasts) if j != i]
-        variance = [var + nib.load(var_imgs[j]).darrays[0].data
+        variance = [vars_[i] + vars_[j]
                     for j in range(n_contrasts) if j != i]
 
         fixed_con = np.array(effects).sum(0)
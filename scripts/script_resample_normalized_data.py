@@ -1,11 +1,14 @@
 """
 This script resampled normalized data to a reference shape: (105, 127, 105)
+
+The runs are resampled in a process pool by
+ibc_public.utils_resample.resample_files, with the interpolation of
+resample_to_img ('continuous').
 """
 import glob
-from nilearn.image import resample_to_img
-from joblib import Parallel, delayed
 import nibabel as nib
 import os
+from ibc_public.utils_resample import resample_files
 
 SMOOTH_DERIVATIVES = '/neurospin/ibc/smooth_derivatives'
 DERIVATIVES = '/neurospin/ibc/derivatives'
@@ -13,15 +16,6 @@ THREE_MM = '/neurospin/ibc/3mm'
 _package_directory = os.path.dirname(os.path.abspath(__file__))
 
 
-def _resample(img, reference, target=None):
-    rimg = resample_to_img(img, reference)
-    if target is not None:
-        rimg.to_filename(target)
-    else:
-        rimg.to_filename(img)
-    print(img)
-
-
 def _prepare_targets(imgs):
     """Prepare target filenames"""
     targets = []
@@ -49,10 +43,10 @@ def resample_func_data(n_jobs=2):
         _package_directory, '../ibc_data', 'gm_mask_1_5mm.nii.gz')
     imgs = glob.glob(os.path.join(DERIVATIVES,
                      'sub-*', 'ses-*', 'func', 'wrdcsub-*.nii.gz'))
-    Parallel(n_jobs=n_jobs)(
-        delayed(_resample)(img, reference) for img in imgs
-        if (nib.load(img).shape[2] != 105)
-        and ('RestingState' not in img))
+    imgs = [img for img in imgs
+            if (nib.load(img).shape[2] != 105)
+            and ('RestingState' not in img)]
+    resample_files(imgs, reference, n_jobs=n_jobs)
 
 
 def resample_anat_data(n_jobs=2):
@@ -61,9 +55,8 @@ def resample_anat_data(n_jobs=2):
     imgs = glob.glob(os.path.join(DERIVATIVES, 'sub-*', 'ses-*', 'anat',
                      'mwc*sub-*_ses-*_T1w.nii.gz'))
     reference_shape = nib.load(reference).shape
-    Parallel(n_jobs=n_jobs)(
-        delayed(_resample)(img, reference) for img in imgs
-        if nib.load(img).shape != reference_shape)
+    imgs = [img for img in imgs if nib.load(img).shape != reference_shape]
+    resample_files(imgs, reference, n_jobs=n_jobs)
 
 
 def resample_3mm_func_data(n_jobs=2):
@@ -72,10 +65,10 @@ def resample_3mm_func_data(n_jobs=2):
     wc = os.path.join(DERIVATIVES, 'sub-*/ses-*/func/wrdcsub-*.nii.gz')
     imgs = glob.glob(wc)
     targets = _prepare_targets(imgs)
-    Parallel(n_jobs=n_jobs)(
-        delayed(_resample)(img, reference, target) for (img, target) in
-        zip(imgs, targets)
-        if not os.path.exists(target))
+    todo = [(img, target) for (img, target) in zip(imgs, targets)
+            if not os.path.exists(target)]
+    resample_files([img for img, _ in todo], reference,
+                   [target for _, target in todo], n_jobs=n_jobs)
 
 
 def resample_func_and_anat(n_jobs=4):
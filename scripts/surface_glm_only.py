@@ -5,9 +5,11 @@
 
 """
 import os
+import sys
 from pypreprocess.conf_parser import _generate_preproc_pipeline
-from joblib import Parallel, delayed
 from ibc_public.utils_pipeline import fixed_effects_analysis, first_level
+from ibc_public.utils_io import MapWriter
+from ibc_public.utils_scheduler import Scheduler
 
 from pipeline import (clean_subject, clean_anatomical_images,
                       _adapt_jobfile, get_subject_session)
@@ -19,6 +21,11 @@ retino_sessions = ['wedge_anti_pa', 'wedge_clock_ap', 'cont_ring_ap',
 RETINO_REG = dict([(session_id, 'sin_cos_regressors.csv')
                    for session_id in retino_sessions])
 IBC = 'neurospin/ibc'
+DESIGN_CACHE = '/neurospin/tmp/ibc/design_cache'
+# approximate memory (MB) used to fit one block of fsaverage7 vertices
+MEMORY_PER_JOB = 2000
+# processes fitting the blocks of vertices of each GLM
+GLM_N_JOBS = 2
 
 
 def generate_glm_input(jobfile, mesh=None):
@@ -79,27 +86,38 @@ def generate_glm_input(jobfile, mesh=None):
 
 def run_subject_surface_glm(jobfile, subject, session, protocol, mesh=None):
     """ Create jobfile and run it """
+    # one jobfile per process, as several sessions may run concurrently
     output_name = os.path.join(
-        '/tmp', os.path.basename(jobfile)[:-4] + '_%s.ini' % subject)
+        '/tmp', os.path.basename(jobfile)[:-4] + '_%s_%d.ini' % (
+            subject, os.getpid()))
     _adapt_jobfile(jobfile, subject, output_name, session)
     list_subjects_update = generate_glm_input(output_name, mesh)
     clean_anatomical_images(IBC)
+    writer = MapWriter(n_threads=2)
     for subject in list_subjects_update:
         clean_subject(subject)
-        if len(subject['session_id']) > 0:
-            print(len(subject['session_id']))
         if len(subject['session_id']) > 0:
             if protocol == 'retino':
                 subject['onset'] = [''] * len(subject['onset'])
                 first_level(subject, compcorr=True,
                             additional_regressors=RETINO_REG,
-                            smooth=None, mesh=mesh)
+                            smooth=None, mesh=mesh, writer=writer,
+                            design_cache_dir=DESIGN_CACHE, n_jobs=GLM_N_JOBS,
+                            memory_per_job=MEMORY_PER_JOB, incremental=True)
             else:
-                first_level(subject, compcorr=True, smooth=None, mesh=mesh)
-                fixed_effects_analysis(subject, mesh=mesh)
+                first_level(subject, compcorr=True, smooth=None, mesh=mesh,
+                            writer=writer, design_cache_dir=DESIGN_CACHE,
+                            n_jobs=GLM_N_JOBS, memory_per_job=MEMORY_PER_JOB,
+                            incremental=True)
+                fixed_effects_analysis(subject, mesh=mesh, writer=writer,
+                                       incremental=True)
+    writer.close()
 
 
 if __name__ == '__main__':
+    # no state file: first_level and fixed_effects_analysis already skip
+    # the sessions and contrasts whose inputs did not change
+    scheduler = Scheduler(state_file=None, n_jobs=6)
     protocols = ['enumeration', 'lyon1', 'lyon2', 'audio1', 'audio2', 'stanford1']
     protocols += ['stanford2', 'stanford3']
     protocols += ['screening', 'rsvp-language', 'hcp1', 'hcp2', 'archi']
@@ -114,7 +132,10 @@ if __name__ == '__main__':
             acquisition = 'clips4'
         mesh = 'fsaverage7'
         subject_session = sorted(get_subject_session(acquisition))
-        Parallel(n_jobs=6)(
-            delayed(run_subject_surface_glm)(
-                jobfile, subject, session, protocol, mesh=mesh)
-            for (subject, session) in subject_session)
+        for (subject, session) in subject_session:
+            # memory of the GLM processes, plus the timeseries of the task
+            scheduler.add(
+                'surface_glm_%s_%s_%s_%s' % (protocol, subject, session, mesh),
+                run_subject_surface_glm, jobfile, subject, session, protocol,
+                mesh=mesh, memory=(GLM_N_JOBS + 1) * MEMORY_PER_JOB)
+    scheduler.run(dry_run='--dry-run' in sys.argv)